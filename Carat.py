@@ -1,3 +1,4 @@
+import asyncio
 import io
 import logging
 import os
@@ -11,6 +12,10 @@ from dotenv import load_dotenv
 from nextcord.ext import commands
 from nextcord.ext.commands import DefaultHelpCommand, CommandError
 
+import games
+import logindex
+import logsink
+import storage
 import utility
 
 LogFile = "Carat.log"
@@ -22,9 +27,13 @@ LogLevelMapping = {'DEBUG': logging.DEBUG,
                    'ERROR': logging.ERROR,
                    'CRITICAL': logging.CRITICAL}
 
-logging.basicConfig(filename=LogFile, filemode="w",
-                    format="%(asctime)s - %(levelname)s: %(message)s",
-                    level=logging.INFO)
+load_dotenv()
+# written on a background thread, remembering where records of each level are for SendLogs
+log_handler = logindex.start_logging(LogFile,
+                                     json_lines=os.environ.get('LOG_FORMAT', "text").lower() == "json",
+                                     max_bytes=int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+                                     backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 5)),
+                                     when=os.environ.get('LOG_ROTATE_WHEN'))
 
 try:
     load_dotenv()
@@ -43,13 +52,22 @@ allowedMentions = nextcord.AllowedMentions.all()
 allowedMentions.everyone = False
 help_command = DefaultHelpCommand(verify_checks=False, dm_help=None, dm_help_threshold=600)
 load_dotenv()
-bot = commands.Bot(command_prefix="<",
-                   case_insensitive=True,
-                   intents=intents,
-                   allowed_mentions=allowedMentions,
-                   activity=nextcord.Game("<HelpMe or <help"),
-                   help_command=help_command,
-                   owner_id=ownerID)
+
+
+class Carat(commands.Bot):
+    async def close(self):
+        # however Carat is stopped, send buffered log lines while still connected
+        await logsink.flush_all()
+        await super().close()
+
+
+bot = Carat(command_prefix="<",
+            case_insensitive=True,
+            intents=intents,
+            allowed_mentions=allowedMentions,
+            activity=nextcord.Game("<HelpMe or <help"),
+            help_command=help_command,
+            owner_id=ownerID)
 
 
 # load cogs and print ready message
@@ -58,6 +76,7 @@ async def on_ready():
     print('Logged in as')
     print(bot.user.name)
     print(bot.user.id)
+    utility.loop_monitor.start()
     print('Loading cogs')
     cog_paths = ["Cogs." + os.path.splitext(file)[0] for file in os.listdir("Cogs") if file.endswith(".py")]
     load_extensions(cog_paths)
@@ -66,6 +85,26 @@ async def on_ready():
     logging.info("Carat online")
 
 
+@bot.event
+async def on_message(message: nextcord.Message):
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message)
+    if ctx.valid:
+        # every command runs in its own task, so this selects the game for the whole command, and its state is
+        # loaded before the checks and the command run
+        await games.registry.select(message.channel, message.author)
+    await bot.invoke(ctx)
+
+
+@bot.check
+async def check_game(ctx: commands.Context) -> bool:
+    # runs before the cogs' checks; commands of the cogs act on a game, unless marked with extras={"needs_game": False}
+    if games.current_game.get() is None and ctx.command.extras.get("needs_game", ctx.cog is not None):
+        raise games.NotAGameChannel(f"{ctx.channel} belongs to no game")
+    return True
+
+
 def load_extensions(paths: List[str]):
     for extension in paths:
         try:
@@ -84,7 +123,11 @@ async def on_command_error(ctx: commands.Context, error: CommandError):
     elif isinstance(error, commands.UserInputError):
         await utility.dm_user(ctx.author, f"There was an issue with your input. Usage: "
                                           f"`<{ctx.command.name} {ctx.command.signature}`.")
-        logging.info(f"Command {ctx.command.name} was used with incorrect input: {ctx.message.content}")
+        logging.info(f"Command {ctx.command.name} was used with incorrect input: {ctx.message.content}",
+                     extra=utility.command_log_fields(ctx))
+    elif isinstance(error, games.NotAGameChannel):
+        await utility.deny_command(ctx, "This is not a game channel. Use the command in the channel of your game, "
+                                        "or in a DM")
     elif isinstance(error, commands.errors.CheckFailure):
         logging.warning(
             f"{ctx.command.name} command was ignored due to the command's check failing")
@@ -92,13 +135,13 @@ async def on_command_error(ctx: commands.Context, error: CommandError):
         traceback_buffer = io.StringIO()
         traceback.print_exception(type(error), error, error.__traceback__, file=traceback_buffer)
         traceback_text = traceback_buffer.getvalue()
-        logging.exception(f"Ignoring exception in command {ctx.command}:\n{traceback_text}")
+        logging.exception(f"Ignoring exception in command {ctx.command}:\n{traceback_text}",
+                          extra=utility.command_log_fields(ctx))
 
 
-def get_level(line: str):
-    line_without_time = line.split(" - ")[1]
-    line_without_message = line_without_time.split(": ")[0]
-    return LogLevelMapping[line_without_message.strip().upper()]
+def read_logs(log_level: int, limit: int) -> str:
+    # only the wanted records are read, found through the handler's index, and older ones from rotated files
+    return "\n".join(log_handler.tail(log_level, limit))
 
 
 @bot.command()
@@ -112,21 +155,9 @@ async def SendLogs(ctx: commands.Context, limit: int, level: Optional[str] = "ER
             (ctx.author.id in devIDs and level.upper() in ["WARNING", "ERROR", "CRITICAL"]):
         log_level = LogLevelMapping[level.upper()]
         await utility.start_processing(ctx)
-        with open(LogFile, "r") as logs:
-            lines = logs.readlines()
-        items = []
-        for line in lines:
-            try:
-                level = get_level(line)
-                if level >= log_level:
-                    items.append(line)
-            except (KeyError, IndexError):
-                # exception traces occupy several lines, and for all but the first get_level should fail
-                if level >= log_level:
-                    items[-1] += "\n" + line
-        if limit < len(items):
-            items = items[-limit:]
-        bytes_data = io.BytesIO("\n".join(items).encode("utf-8"))
+        # reading the log file happens off the event loop
+        logs = await asyncio.get_running_loop().run_in_executor(None, read_logs, log_level, limit)
+        bytes_data = io.BytesIO(logs.encode("utf-8"))
         await ctx.author.send("Logs", file=nextcord.File(bytes_data, f"Carat_{log_level}_{limit}.log"))
         await utility.finish_processing(ctx)
     else:
@@ -238,10 +269,23 @@ async def SendLogs(ctx: commands.Context, limit: int, level: Optional[str] = "ER
 #         await utility.deny_command(ctx, "Could not connect to GitHub")
 
 
+@bot.command()
+async def Metrics(ctx: commands.Context):
+    """Sends Carat's internal performance counters as a DM. Restricted to developers."""
+    if ctx.author.id == ownerID or ctx.author.id in devIDs:
+        await utility.start_processing(ctx)
+        bytes_data = io.BytesIO(utility.format_metrics().encode("utf-8"))
+        await ctx.author.send("Metrics", file=nextcord.File(bytes_data, "Carat_metrics.txt"))
+        await utility.finish_processing(ctx)
+    else:
+        await utility.deny_command(ctx, "You lack permission for this command")
+
+
 @bot.command()
 async def Restart(ctx: commands.Context):
     if ctx.author.id == ownerID or ctx.author.id in devIDs:
         logging.warning("Trying to restart Carat...")
+        storage.flush_all()
         # bot.close() finishes execution of bot.run(), so Carat terminates and is restarted by the loop in AutoRestart
         await bot.close()
     else:
@@ -249,4 +293,6 @@ async def Restart(ctx: commands.Context):
         logging.warning(f"{ctx.author.display_name} (id: {ctx.author.id}) attempted to restart Carat")
 
 
-bot.run(token)
\ No newline at end of file
+bot.run(token)
+# guaranteed final write of anything still pending once the bot has stopped, however it stopped
+storage.flush_all()
\ No newline at end of file
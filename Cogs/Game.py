@@ -3,7 +3,10 @@ from typing import Optional
 
 from nextcord.ext import commands
 
+import storage
 import utility
+from roles import RoleChange
+from Cogs.Other import Other
 from Cogs.Townsquare import Townsquare
 from Cogs.Reminders import Reminders
 
@@ -82,29 +85,37 @@ class Game(commands.Cog):
         """Opens Kibitz to the public and cleans up after the game.
         This includes removing the game role from players and the kibitz role from kibitzers, sending a message
         reminding players to give feedback for the ST with a link to do so,
-        and resetting the town square if there is one.
+        and resetting the town square if there is one, after keeping a binary snapshot of it in the storage location.
+        Also sets the start time as SetStart does, so CreateThreads, SendToThreads and SubstitutePlayer of the next
+        game do not consider the threads of this one.
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
 
             #kibitz_role = self.helper.KibitzRole
             game_role = self.helper.PlayerRole
-            members = game_role.members #+ kibitz_role.members
+            members = self.helper.role_members(game_role) #+ kibitz_role.members
 
-            for member in members:
-                if not member.bot:
-                    #await member.remove_roles(kibitz_role)
-                    await member.remove_roles(game_role)
+            await self.helper.change_roles(ctx.author, [RoleChange(member, game_role, False)
+                                                        for member in members if not member.bot])
 
             townsquare: Optional[Townsquare] = self.bot.get_cog("Townsquare")
             if townsquare:
+                await townsquare.write_snapshot()
                 townsquare.town_square = None
-                townsquare.update_storage()
 
             reminders: Optional[Reminders] = self.bot.get_cog("Reminders")
             if reminders:
-                reminders.reminder_list = []
-                reminders.update_storage()
+                reminders.reset_reminders()
+
+            self.helper.game_state().threads.clear()
+            # town square, reminders and registered threads are reset together in one transaction
+            storage.get_store(self.helper.StorageLocation).end_game(self.helper.GameChannel.id)
+            # as SetStart, so threads of this game are no longer reused by the next game's CreateThreads and
+            # SendToThreads
+            other: Optional[Other] = self.bot.get_cog("Other")
+            if other:
+                await other.record_time()
 
             # Change permission of Kibitz to allow Townsfolk to view
             # townsfolk_role = self.helper.Guild.default_role
@@ -5,6 +5,7 @@ import nextcord
 from nextcord.ext import commands
 
 import utility
+from roles import RoleChange
 from Cogs.Townsquare import Townsquare, Player
 from Cogs.Game import Game
 
@@ -18,9 +19,10 @@ class Grimoire(commands.Cog):
         """Grants you the ST role. Fails if there is already an ST.
         """
         st_role = self.helper.STRole
-        if len(st_role.members) == 0 or self.helper.authorize_mod_command(ctx.author):
+        sts = self.helper.role_members(st_role)
+        if len(sts) == 0 or self.helper.authorize_mod_command(ctx.author):
             await utility.start_processing(ctx)
-            await ctx.author.add_roles(st_role)
+            await self.helper.change_roles(ctx.author, [RoleChange(ctx.author, st_role, True)])
             await utility.dm_user(ctx.author, "You are now the current livetext ST")
             # print(self.helper.KibitzChannel.type, self.helper.KibitzChannel.type == 0)
             # if self.helper.KibitzChannel.type == 0:
@@ -33,8 +35,8 @@ class Grimoire(commands.Cog):
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx,
-                                       f"This channel already has {len(st_role.members)} STs. These users are: " +
-                                           "\n".join([st.display_name for st in st_role.members]))                
+                                       f"This channel already has {len(sts)} STs. These users are: " +
+                                           "\n".join([st.display_name for st in sts]))                
         await self.helper.log(f"{ctx.author.mention} has run the ClaimGrimoire Command for livetext")
         
     @commands.command(aliases=["GiveGrim"])
@@ -44,12 +46,12 @@ class Grimoire(commands.Cog):
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
             st_role = self.helper.STRole
-            await new_st.add_roles(st_role)
-            await ctx.author.remove_roles(st_role)
+            await self.helper.change_roles(ctx.author, [RoleChange(new_st, st_role, True),
+                                                        RoleChange(ctx.author, st_role, False)])
             townsquare: Optional[Townsquare] = self.bot.get_cog('Townsquare')
             if townsquare.town_square:
-                townsquare.town_square.sts.remove(ctx.author)
-                townsquare.town_square.sts.append(Player(new_st.id, new_st.display_name))
+                townsquare.town_square.remove_st(ctx.author.id)
+                townsquare.town_square.add_st(Player(new_st.id, new_st.display_name))
                 townsquare.update_storage()
             await utility.dm_user(ctx.author,
                                   "You have assigned the livetext ST role to" + new_st.display_name)
@@ -69,14 +71,14 @@ class Grimoire(commands.Cog):
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
             st_role = self.helper.STRole
-            await ctx.author.remove_roles(st_role)
-            if len(st_role.members) == 1:
+            await self.helper.change_roles(ctx.author, [RoleChange(ctx.author, st_role, False)])
+            if len(self.helper.role_members(st_role)) == 1:
                 townsquare: Optional[Townsquare] = self.bot.get_cog('Townsquare')
                 if townsquare.town_square:
                     dm_content = "You have removed the current ST role from yourself however you have "\
                     "not yet ended the game, if this is how it's supposed to be carry on, otherwise please "\
                     "reclaim the ST role and run <EndGame."
-                    townsquare.town_square.sts.remove(ctx.author)
+                    townsquare.town_square.remove_st(ctx.author.id)
                     townsquare.update_storage()
                 else:
                     #game_cog: Optional[Game] = self.bot.get_cog("Game") #*
@@ -100,10 +102,10 @@ class Grimoire(commands.Cog):
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
-            await member.add_roles(self.helper.STRole)
+            await self.helper.change_roles(ctx.author, [RoleChange(member, self.helper.STRole, True)])
             townsquare: Optional[Townsquare] = self.bot.get_cog('Townsquare')
             if townsquare.town_square:
-                townsquare.town_square.sts.append(Player(member.id, member.display_name))
+                townsquare.town_square.add_st(Player(member.id, member.display_name))
                 townsquare.update_storage()
             dm_content = f"You have assigned the livetext ST role to {member.display_name}"
             dm_success = await utility.dm_user(ctx.author, dm_content)
@@ -123,12 +125,12 @@ class Grimoire(commands.Cog):
         if self.helper.authorize_mod_command(ctx.author):
             await utility.start_processing(ctx)
             st_role = self.helper.STRole
-            await member.remove_roles(st_role)
+            await self.helper.change_roles(ctx.author, [RoleChange(member, st_role, False)])
             townsquare: Optional[Townsquare] = self.bot.get_cog('Townsquare')
             if townsquare.town_square:
-                townsquare.town_square.sts.remove(member)
+                townsquare.town_square.remove_st(member.id)
                 townsquare.update_storage()
-            if len(st_role.members) == 0:
+            if len(self.helper.role_members(st_role)) == 0:
                 dm_content = f"You have removed the current ST role from {member.display_name}, however "\
                 "the game has not yet been ended, if this is how it's supposed to be carry on, otherwise "\
                 "please claim the ST role and run <EndGame.""" 
@@ -149,7 +151,7 @@ class Grimoire(commands.Cog):
         """
         await utility.start_processing(ctx)
         st_role = self.helper.STRole
-        sts = st_role.members
+        sts = self.helper.role_members(st_role)
         if len(sts) == 0:
             await utility.dm_user(ctx.author, "There are no current livetext story tellers.")
         else:
@@ -1,8 +1,13 @@
+import asyncio
 import typing
 
 import nextcord
 from nextcord.ext import commands
 
+import games
+import outbound
+import storage
+import threads
 import utility
 from Cogs.Townsquare import Townsquare, TownSquare
 
@@ -15,27 +20,52 @@ class Other(commands.Cog):
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
-        self.StarttimeStorage = os.path.join(self.helper.StorageLocation, "starttime.json")
+        self.store = storage.get_store(self.helper.StorageLocation)
+        self.migrate_legacy_storage()
+        self.helper.Games.register(self.load_state)
 
-        if not os.path.exists(self.StarttimeStorage):
-            self.start_time = utcnow()
-            with open(self.StarttimeStorage, 'w') as f:
-                f.write(self.start_time.strftime("%d/%m/%Y, %H:%M:%S"))
+    async def load_state(self, state: games.GameState):
+        stored_time = await self.store.load_start_time(state.config.channel.id)
+        if stored_time is None:
+            state.start_time = utcnow()
+            self.store.save_start_time(state.config.channel.id, state.start_time.isoformat())
         else:
-            with open(self.StarttimeStorage, 'r') as f:
-                self.start_time: datetime.datetime = datetime.datetime.strptime(f.read(), "%d/%m/%Y, %H:%M:%S").astimezone(tz=None)
+            state.start_time = datetime.datetime.fromisoformat(stored_time)
+        state.threads = threads.ThreadRegistry(state.config.channel.id, self.store)
+        await state.threads.load()
+
+    @property
+    def start_time(self) -> datetime.datetime:
+        return self.helper.game_state().start_time
+
+    @property
+    def thread_registry(self) -> threads.ThreadRegistry:
+        return self.helper.game_state().threads
+
+    def migrate_legacy_storage(self):
+        """Imports the start time from the file used before the database existed."""
+        legacy_storage = os.path.join(self.helper.StorageLocation, "starttime.json")
+        if not os.path.exists(legacy_storage):
+            return
+        with open(legacy_storage, 'r') as f:
+            # the file holds the UTC time without a timezone
+            start_time = datetime.datetime.strptime(f.read(), "%d/%m/%Y, %H:%M:%S").replace(
+                tzinfo=datetime.timezone.utc)
+        self.store.save_start_time(self.helper.Games.default.channel.id, start_time.isoformat())
+        os.replace(legacy_storage, legacy_storage + ".migrated")
 
     async def record_time(self):
         """Records current UTC time and stores it
         """
-        self.start_time = utcnow()
-        with open(self.StarttimeStorage, 'w') as f:
-            f.write(self.start_time.strftime("%d/%m/%Y, %H:%M:%S"))
+        state = self.helper.game_state()
+        state.start_time = utcnow()
+        self.store.save_start_time(state.config.channel.id, state.start_time.isoformat())
 
     @commands.command()
     async def SetStart(self, ctx: commands.Context):
         """Allows the bot to know when to consider threads from for <subplayer and <sendtothreads
         Run this command before any ST threads are made even if the bots systems are not being used
+        EndGame also sets the start time, so threads of the finished game are not considered for the next one.
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
@@ -60,9 +90,13 @@ class Other(commands.Cog):
                 reason=f"Starting whisper for {ctx.author.display_name}"
             )
 
-            await thread.add_user(ctx.author)
+            if channel == self.helper.GameChannel:
+                self.thread_registry.add(thread, threads.whisper_thread)
+            self.helper.ThreadMembers.created(thread)
+
+            await self.helper.ThreadMembers.add_user(thread, ctx.author)
             for player in players:
-                await thread.add_user(player)
+                await self.helper.ThreadMembers.add_user(thread, player)
             await utility.finish_processing(ctx)
         else:
             await ctx.author.send("This is a livetext exclusive command that is only usable within the livetext category, " \
@@ -72,38 +106,35 @@ class Other(commands.Cog):
     async def CreateThreads(self, ctx: commands.Context, setup_message: str = None):
         """Creates a private thread in the game's channel for each player.
         The player and all STs are automatically added to each thread. The threads are named "ST Thread [player name]".
+        Threads created since SetStart are reused, so running it again only fills in what is missing.
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
             townsquare: typing.Optional[Townsquare] = self.bot.get_cog("Townsquare")
             if townsquare:
                 townsquare: typing.Optional[TownSquare] = townsquare.town_square
-            for player in self.helper.PlayerRole.members:
+            sts = self.helper.role_members(self.helper.STRole)
+            plans = []
+            for player in self.helper.role_members(self.helper.PlayerRole):
                 name = player.display_name
-                if townsquare:
-                    name = next((p.alias for p in townsquare.players if p.id == player.id), name)
+                if townsquare and townsquare.get_player(player.id):
+                    name = townsquare.get_player(player.id).alias
+                plans.append(threads.ThreadPlan(threads.st_thread_name(name), [player] + sts, player.id))
 
-                thread = await self.helper.GameChannel.create_thread(
-                    name=f"ST Thread {name}"[:100],
-                    auto_archive_duration=60,  # 1 hr
-                    type=nextcord.ChannelType.private_thread,
-                    invitable=False,
-                    reason=f"Preparing livetext ST Threads"
-                )
-                                
-                await thread.add_user(player)
-                for st in self.helper.STRole.members:
-                    await thread.add_user(st)
-                if setup_message:
-                    await thread.send(setup_message)
+            progress = utility.ProgressReport(ctx.author, "Setting up ST threads", len(plans))
+            await progress.start()
+            provisioner = threads.ThreadProvisioner(self.helper.GameChannel, self.thread_registry, self.start_time,
+                                                    self.helper.ThreadConcurrency, setup_message, progress.advance)
+            result = await provisioner.provision(plans)
+            await progress.finish(threads.summarize(result))
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not a livetext ST")
 
     @commands.command()
     async def SendToThreads(self, ctx: commands.Context, message: str):
-        """Sends the same message to all active ST threads with "ST Thread" in the thread name,  
-        that were created since SetStart was ran or 3 hrs ago, whichever is soonest.
+        """Sends the same message to all ST threads, archived ones included, that were created since SetStart was
+        ran or 3 hrs ago, whichever is soonest.
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
@@ -112,15 +143,20 @@ class Other(commands.Cog):
             last_set_time = self.start_time
             min_creation_time = default_time if default_time > last_set_time else last_set_time
 
-            threads = self.helper.GameChannel.threads
-            for thread in threads:
-                if "st thread" in thread.name.lower() and thread.created_at > min_creation_time:
-                    await thread.send(message)
+            registry = self.thread_registry
+            entries = registry.of_kind(threads.st_thread, min_creation_time)
+            # active threads named like ST threads which were not created by CreateThreads
+            unregistered = [thread for thread in self.helper.GameChannel.threads
+                            if "st thread" in thread.name.lower() and thread.created_at > min_creation_time
+                            and thread.id not in registry.entries]
+            report = await threads.broadcast(self.bot, registry, entries, unregistered, message,
+                                             self.helper.ThreadConcurrency)
+            await utility.dm_user(ctx.author, threads.summarize_delivery(report)[:2000])
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not a livetext ST")
 
-    @commands.command()
+    @commands.command(extras={"needs_game": False})
     async def HelpMe(self, ctx: commands.Context, command_type: typing.Optional[str] = "no-mod"):
         """Sends a message listing and explaining available commands.
         Can be filtered by appending one of `all, anyone, st, townsquare, mod, no-mod`. Default is `no-mod`"""
@@ -173,7 +209,8 @@ class Other(commands.Cog):
         st_embed.add_field(name="<EndGame",
                            value='Removes the game role from all players and the kibitz role from your kibitzers, '
                                  'makes the kibitz channel visible to the public, and sends a message reminding '
-                                 'players to give feedback for the ST and providing a link to do so.',
+                                 'players to give feedback for the ST and providing a link to do so. Also sets '
+                                 'the start time like <SetStart, so threads of the game are not reused.',
                            inline=False)
         st_embed.add_field(name="<StartSignups",
                            value='Posts a message listing the signed up players and sts with buttons that players '
@@ -182,7 +219,8 @@ class Other(commands.Cog):
                            inline=False)
         st_embed.add_field(name="<CreateThreads [setup message]",
                            value='Creates a private thread for each player, named "ST Thread [player name]", adds the '
-                                 'player and all STs to it, then posts [setup message] into each thread.',
+                                 'player and all STs to it, then posts [setup message] into each thread. Running it '
+                                 'again only fills in missing threads, members and setup messages.',
                            inline=False)
         st_embed.add_field(name="<SetReminders [event] [times]",
                            value="At the given times, sends reminders to the players how long they have until the "
@@ -259,6 +297,10 @@ class Other(commands.Cog):
                                  "game role. Can be used without the town square.\n"
                                  "Usage example: `<SubstitutePlayer @Alex @Amy`",
                            inline=False)
+        ts_embed.add_field(name="<ExportTownSquare [binary]",
+                           value="Sends you the current town square as a JSON file, or as a binary snapshot with "
+                                 "`<ExportTownSquare binary`. You must be a storyteller for this.",
+                           inline=False)
         ts_embed.add_field(name="<CreateNomThread [name]",
                            value='Creates a thread for nominations to be run in. The name of the thread is optional, '
                                  'with `Nominations` as default.\n'
@@ -342,33 +384,27 @@ class Other(commands.Cog):
                             inline=False)
         mod_embed.set_footer(
             text="4/4")
-        try:
-            command_type = command_type.lower()
-            if command_type == "all":
-                await ctx.author.send(embed=anyone_embed)
-                await ctx.author.send(embed=st_embed)
-                await ctx.author.send(embed=ts_embed)
-                await ctx.author.send(embed=mod_embed)
-            elif command_type == "anyone":
-                await ctx.author.send(embed=anyone_embed)
-            elif command_type == "st":
-                await ctx.author.send(embed=st_embed)
-            elif command_type == "townsquare":
-                await ctx.author.send(embed=ts_embed)
-            elif command_type == "mod":
-                await ctx.author.send(embed=mod_embed)
-            elif command_type == "no-mod":
-                await ctx.author.send(embed=anyone_embed)
-                await ctx.author.send(embed=st_embed)
-                await ctx.author.send(embed=ts_embed)
-            else:
-                await ctx.author.send(
-                    'Use `all`, `anyone`, `st`, `townsquare`, `mod` or `no-mod` to filter the help message. '
-                    'Default is `no-mod`.')
-            await ctx.author.send("Note: If you believe that there is an error with the bot, please let Lukey or a "
-                                  "mod know."
-                                  "\nThank you!")
-        except nextcord.Forbidden:
+        help_embeds = {"all": [anyone_embed, st_embed, ts_embed, mod_embed],
+                       "anyone": [anyone_embed],
+                       "st": [st_embed],
+                       "townsquare": [ts_embed],
+                       "mod": [mod_embed],
+                       "no-mod": [anyone_embed, st_embed, ts_embed]}
+        command_type = command_type.lower()
+        # help DMs are cosmetic traffic, sent after any game critical requests
+        if command_type in help_embeds:
+            messages = [utility.dm_user(ctx.author, embed=embed, priority=outbound.COSMETIC)
+                        for embed in help_embeds[command_type]]
+        else:
+            messages = [utility.dm_user(ctx.author, 'Use `all`, `anyone`, `st`, `townsquare`, `mod` or `no-mod` to '
+                                                    'filter the help message. Default is `no-mod`.',
+                                        priority=outbound.COSMETIC)]
+        messages.append(utility.dm_user(ctx.author, "Note: If you believe that there is an error with the bot, please "
+                                                    "let Lukey or a mod know."
+                                                    "\nThank you!",
+                                        priority=outbound.COSMETIC))
+        # sent at once, so that they are coalesced into as few DMs as possible
+        if not all(await asyncio.gather(*messages)):
             await ctx.send("Please enable DMs to receive the help message")
         await utility.finish_processing(ctx)
 
@@ -1,20 +1,29 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
+import heapq
 import json
 import logging
 import os
 import re
-from dataclasses import dataclass
-from typing import Optional
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 from dataclasses_json import dataclass_json
-from nextcord.ext import commands, tasks
+from nextcord.ext import commands
 from nextcord.utils import utcnow, format_dt
 
+import games
+import outbound
+import storage
 import utility
 
+message_limit = 2000
 minutes_pattern = re.compile(r"^(\d+):([0-5]\d)$")
+# the end of the countdown appended to reminders by Reminder.create
+countdown_pattern = re.compile(r" <t:(\d+):R> \(<t:\d+:t>\)$")
 
 
 def parse_time(inp: str) -> float:
@@ -31,6 +40,7 @@ class Reminder:
     time: str
     channel: int
     text: str
+    id: Optional[int] = field(default=None, compare=False)
 
     def explain(self) -> str:
         text_elements = self.text.split(" ")
@@ -56,32 +66,237 @@ class Reminder:
         return Reminder(time.isoformat(), channel, text)
 
 
+class Clock:
+    """The time the reminder scheduler reads and sleeps on. Replaced by a fake clock in checks."""
+
+    @staticmethod
+    def time() -> float:
+        return time.time()
+
+    @staticmethod
+    async def sleep(seconds: float):
+        await asyncio.sleep(seconds)
+
+
+@dataclass
+class DueReminder:
+    id: int
+    game: int
+    timestamp: float
+    channel: int
+    text: str
+
+
+class ReminderScheduler:
+    """Keeps the reminders of all games in a heap on the epoch time they are due, and sleeps until the first of them
+    is. All reminders due by then are dispatched at once, so reminders due at the same time are merged, and the sleep
+    is cut short when reminders are added or removed.
+    """
+
+    def __init__(self, dispatch: Callable[[List[DueReminder]], Awaitable[None]], clock: Clock = Clock()):
+        self.dispatch = dispatch
+        self.clock = clock
+        self.reminders: Dict[int, DueReminder] = {}
+        # (timestamp, id), entries of removed reminders are skipped when they come up
+        self._heap: List[Tuple[float, int]] = []
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.dispatched = 0
+        self.wakeups = 0
+        self.max_delay = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, reminder: DueReminder):
+        self.reminders[reminder.id] = reminder
+        heapq.heappush(self._heap, (reminder.timestamp, reminder.id))
+        self._changed.set()
+
+    def remove(self, reminder_ids: List[int]):
+        for reminder_id in reminder_ids:
+            self.reminders.pop(reminder_id, None)
+        self._changed.set()
+
+    def remove_game(self, game: int):
+        self.remove([reminder.id for reminder in self.reminders.values() if reminder.game == game])
+
+    def next_due(self) -> Optional[float]:
+        while self._heap and self._heap[0][1] not in self.reminders:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[DueReminder]:
+        due = []
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            _, reminder_id = heapq.heappop(self._heap)
+            due.append(self.reminders.pop(reminder_id))
+        return due
+
+    async def run(self):
+        while True:
+            self._changed.clear()
+            next_due = self.next_due()
+            if next_due is None:
+                await self._changed.wait()
+                continue
+            now = self.clock.time()
+            if next_due > now:
+                await self._sleep_unless_changed(next_due - now)
+                continue
+            self.wakeups += 1
+            due = self.pop_due(now)
+            self.max_delay = max(self.max_delay, now - min(reminder.timestamp for reminder in due))
+            self.dispatched += len(due)
+            try:
+                await self.dispatch(due)
+            except Exception as e:
+                logging.exception(f"Failed to dispatch reminders: {e}")
+
+    async def _sleep_unless_changed(self, seconds: float):
+        sleep = asyncio.ensure_future(self.clock.sleep(seconds))
+        changed = asyncio.ensure_future(self._changed.wait())
+        await asyncio.wait([sleep, changed], return_when=asyncio.FIRST_COMPLETED)
+        sleep.cancel()
+        changed.cancel()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"pending": len(self.reminders),
+                "dispatched": self.dispatched,
+                "wakeups": self.wakeups,
+                "max_delay_ms": int(self.max_delay * 1000)}
+
+
+def merge_reminders(due: List[DueReminder]) -> List[Tuple[int, List[DueReminder]]]:
+    """Groups reminders dispatched together into one message per channel, in the order they are due."""
+    merged: Dict[int, List[DueReminder]] = {}
+    for reminder in sorted(due, key=lambda r: (r.timestamp, r.id)):
+        merged.setdefault(reminder.channel, []).append(reminder)
+    return list(merged.items())
+
+
+def pack_messages(reminders: List[DueReminder]) -> List[str]:
+    """Joins the texts of the reminders into as few messages as fit the message limit, never splitting a reminder."""
+    messages = []
+    for reminder in reminders:
+        text = reminder.text[:message_limit]
+        if messages and len(messages[-1]) + 1 + len(text) <= message_limit:
+            messages[-1] += "\n" + text
+        else:
+            messages.append(text)
+    return messages
+
+
+def countdown_end(reminder: DueReminder) -> float:
+    """Returns when the event the reminder counts down to occurs, which is the reminder itself for announcements."""
+    matched = countdown_pattern.search(reminder.text)
+    return float(matched.group(1)) if matched is not None else reminder.timestamp
+
+
+def reconcile_overdue(overdue: List[DueReminder], now: float) \
+        -> Tuple[List[Tuple[int, List[DueReminder]]], List[DueReminder]]:
+    """Splits the reminders which came due while Carat was offline into those still worth sending, merged into one
+    message per channel, and those skipped. Reminders of countdowns which ended are skipped, and of the others only
+    the latest reminder of each countdown is sent - its relative timestamp shows the time left as it is now.
+    """
+    latest: Dict[Tuple[int, str], DueReminder] = {}
+    skipped = []
+    for reminder in sorted(overdue, key=lambda r: (r.timestamp, r.id)):
+        if countdown_end(reminder) <= now:
+            skipped.append(reminder)
+            continue
+        key = (reminder.channel, reminder.text)
+        if key in latest:
+            skipped.append(latest[key])
+        latest[key] = reminder
+    return merge_reminders(list(latest.values())), skipped
+
+
 class Reminders(commands.Cog):
     bot: commands.Bot
     helper: utility.Helper
-    reminder_list: list[Reminder]
-    ReminderStorage: str
+    store: storage.Store
 
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
-        self.ReminderStorage = os.path.join(self.helper.StorageLocation, "reminders.json")
-        self.reminder_list = []
-        if not os.path.exists(self.ReminderStorage):
-            with open(self.ReminderStorage, 'w') as f:
-                json.dump(self.reminder_list, f, indent=2)
-        else:
-            with open(self.ReminderStorage, 'r') as f:
-                self.reminder_list = [Reminder.from_dict(item) for item in json.load(f)]
-            self.reminder_list.sort()
-        self.check_reminders.start()
+        self.store = storage.get_store(self.helper.StorageLocation)
+        self.migrate_legacy_storage()
+        self.helper.Games.register(self.load_state)
+        self.scheduler = ReminderScheduler(self.send_reminders)
+        utility.register_metrics("reminders", self.scheduler.stats)
+        asyncio.create_task(self.start_scheduler())
 
     def cog_unload(self):
-        self.check_reminders.cancel()
+        self.scheduler.stop()
+        utility.unregister_metrics("reminders")
+
+    async def start_scheduler(self):
+        # reminders are read from the database so that games whose state is not loaded still get theirs
+        now = self.scheduler.clock.time()
+        overdue = []
+        for reminder_id, game_id, due_time, channel_id, text in await self.store.pending_reminders():
+            reminder = DueReminder(reminder_id, game_id, datetime.datetime.fromisoformat(due_time).timestamp(),
+                                   channel_id, text)
+            if reminder.timestamp <= now:
+                overdue.append(reminder)
+            else:
+                self.scheduler.add(reminder)
+        if overdue:
+            await self.catch_up(overdue, now)
+        self.scheduler.start()
 
-    def update_storage(self):
-        with open(self.ReminderStorage, 'w') as f:
-            json.dump([item.to_dict() for item in self.reminder_list], f, indent=2)
+    async def catch_up(self, overdue: List[DueReminder], now: float):
+        """Sends what is still relevant of the reminders which came due while Carat was offline, and reports the
+        others to the log channel of their game.
+        """
+        to_send, skipped = reconcile_overdue(overdue, now)
+        await self.send_merged(to_send)
+        self.forget_reminders(overdue)
+        for game_id in {reminder.game for reminder in overdue}:
+            config = self.helper.Games.configs.get(game_id)
+            if config is None:
+                continue
+            game_skipped = [reminder for reminder in skipped if reminder.game == game_id]
+            game_sent = sum(1 for _, reminders in to_send for reminder in reminders if reminder.game == game_id)
+            report = f"{len(game_skipped) + game_sent} reminders came due while Carat was offline. " \
+                     f"Sent {game_sent} for countdowns still running, skipped {len(game_skipped)}"
+            if game_skipped:
+                report += ":\n" + "\n".join(Reminder(datetime.datetime.fromtimestamp(
+                    r.timestamp, datetime.timezone.utc).isoformat(), r.channel, r.text).explain() for r in game_skipped)
+            # reported to the game's own log channel, as no command selected a game
+            games.current_game.set(config)
+            await self.helper.log(report)
+
+    def migrate_legacy_storage(self):
+        """Imports reminders from the file used before the database existed."""
+        legacy_storage = os.path.join(self.helper.StorageLocation, "reminders.json")
+        if not os.path.exists(legacy_storage):
+            return
+        with open(legacy_storage, 'r') as f:
+            reminders = [Reminder.from_dict(item) for item in json.load(f)]
+        self.store.import_reminders(self.helper.Games.default.channel.id,
+                                    [(r.time, r.channel, r.text) for r in reminders])
+        os.replace(legacy_storage, legacy_storage + ".migrated")
+        logging.info(f"Imported {len(reminders)} reminders from file into the database")
+
+    async def load_state(self, state: games.GameState):
+        state.reminders = sorted(Reminder(time, channel, text, reminder_id) for reminder_id, time, channel, text
+                                 in await self.store.load_reminders(state.config.channel.id))
+
+    @property
+    def reminder_list(self) -> list[Reminder]:
+        return self.helper.game_state().reminders
+
+    @reminder_list.setter
+    def reminder_list(self, value: list[Reminder]):
+        self.helper.game_state().reminders = value
 
     @commands.command(usage="[event] [times]... <'ping-st'> <'no-player-ping'>")
     async def SetReminders(self, ctx: commands.Context, *args):
@@ -96,7 +311,7 @@ class Reminders(commands.Cog):
             ping_st = "ping-st" in args
             no_player_ping = "no-player-ping" in args
             args = tuple(arg for arg in args if arg not in ["ping-st", "no-player-ping"])
-            if args:
+            if not args:
                 await utility.deny_command(ctx, "At one reminder time is required")
                 return
             game_channel = self.helper.GameChannel
@@ -104,7 +319,7 @@ class Reminders(commands.Cog):
             try:
                 times = [parse_time(time) for time in args]
             except ValueError:
-                event = args[1]
+                event = args[0]
                 try:
                     times = [parse_time(time) for time in args[1:]]
                 except ValueError as e:
@@ -123,13 +338,18 @@ class Reminders(commands.Cog):
                 mention = st_role.mention if mention is None else f"{st_role.mention} {mention}"
             times.sort()
             end_of_countdown = utcnow() + datetime.timedelta(minutes=times[-1])
-            for time in times:
-                reminder = Reminder.create(utcnow() + datetime.timedelta(minutes=time), game_channel, mention, event,
-                                           end_of_countdown)
+            new_reminders = [Reminder.create(utcnow() + datetime.timedelta(minutes=time), game_channel.id, mention,
+                                             event, end_of_countdown) for time in times]
+            reminder_ids = await self.store.add_reminders(game_channel.id,
+                                                          [(r.time, r.channel, r.text) for r in new_reminders])
+            for reminder, reminder_id in zip(new_reminders, reminder_ids):
+                reminder.id = reminder_id
                 self.reminder_list.append(reminder)
+                self.scheduler.add(DueReminder(reminder_id, game_channel.id,
+                                               datetime.datetime.fromisoformat(reminder.time).timestamp(),
+                                               reminder.channel, reminder.text))
                 logging.debug(f"Added reminder for livetext: {reminder}")
             self.reminder_list.sort()
-            self.update_storage()
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be an ST to use this command")
@@ -140,8 +360,8 @@ class Reminders(commands.Cog):
         """
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
-            self.reminder_list = []
-            self.update_storage()
+            self.reset_reminders()
+            self.store.delete_reminders(self.helper.GameChannel.id)
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be an ST to use this command")
@@ -158,16 +378,32 @@ class Reminders(commands.Cog):
             await utility.dm_user(ctx.author, "\n".join([reminder.explain() for reminder in reminders]))
         await utility.finish_processing(ctx)
 
-    @tasks.loop(seconds=15)
-    async def check_reminders(self):
-        if len(self.reminder_list) == 0:
-            return
-        earliest_reminder = self.reminder_list[0]
-        if datetime.datetime.fromisoformat(earliest_reminder.time) <= utcnow():
-            channel = self.bot.get_channel(earliest_reminder.channel)
-            await channel.send(earliest_reminder.text)
-            self.reminder_list.pop(0)
-            self.update_storage()
+    def reset_reminders(self):
+        """Drops the current game's reminders from memory and the scheduler. The caller removes them from storage."""
+        self.reminder_list = []
+        self.scheduler.remove_game(self.helper.GameChannel.id)
+
+    async def send_reminders(self, due: List[DueReminder]):
+        await self.send_merged(merge_reminders(due))
+        self.forget_reminders(due)
+
+    async def send_merged(self, merged: List[Tuple[int, List[DueReminder]]]):
+        for channel_id, reminders in merged:
+            channel = self.bot.get_channel(channel_id)
+            for message in pack_messages(reminders):
+                try:
+                    await outbound.scheduler.run(outbound.CRITICAL, lambda: channel.send(message))
+                except Exception as e:
+                    logging.exception(f"Failed to send reminder to {channel_id}: {e}")
+
+    def forget_reminders(self, done: List[DueReminder]):
+        """Removes sent or skipped reminders from the database in one transaction, and from loaded games."""
+        done_ids = {reminder.id for reminder in done}
+        self.store.delete_reminders_by_id(list(done_ids))
+        for game_id in {reminder.game for reminder in done}:
+            state = self.helper.Games.states.get(game_id)
+            if state is not None:
+                state.reminders = [reminder for reminder in state.reminders if reminder.id not in done_ids]
 
 
 def setup(bot: commands.Bot):
@@ -25,9 +25,9 @@ class Signup(commands.Cog):
         """
         await utility.start_processing(ctx)
         st_role = self.helper.STRole
-        st_names = [st.display_name for st in st_role.members]
+        st_names = [st.display_name for st in self.helper.role_members(st_role)]
         player_role = self.helper.PlayerRole
-        player_names = [player.display_name for player in player_role.members]
+        player_names = [player.display_name for player in self.helper.role_members(player_role)]
 
         output_string = f"Players\n" \
                         f"Storyteller:\n"
@@ -49,8 +49,8 @@ class Signup(commands.Cog):
         """
         if ctx.channel == self.helper.GameChannel:
             await utility.start_processing(ctx)
-            st_names = [st.display_name for st in self.helper.STRole.members] if len(self.helper.STRole.members) != 0 else ["unknown"]
-            player_list = self.helper.PlayerRole.members
+            st_names = [st.display_name for st in self.helper.role_members(self.helper.STRole)] or ["unknown"]
+            player_list = self.helper.role_members(self.helper.PlayerRole)
             
             embed = nextcord.Embed(title="Livetext Game Sign Up",
                                     description="Ran by " + ", ".join(st_names) +
@@ -78,6 +78,12 @@ class SignupView(nextcord.ui.View):
         super().__init__(timeout=60)  # 1hr, stops old signups being used
         self.helper = helper
 
+    async def interaction_check(self, interaction: nextcord.Interaction) -> bool:
+        if await self.helper.Games.select(interaction.channel, interaction.user) is None:
+            await interaction.response.send_message(content="This is not a game channel", ephemeral=True)
+            return False
+        return True
+
     async def on_error(self, error: Exception, item: nextcord.ui.Item, interaction: nextcord.Interaction) -> None:
         traceback_buffer = io.StringIO()
         traceback.print_exception(type(error), error, error.__traceback__, file=traceback_buffer)
@@ -131,7 +137,7 @@ class SignupView(nextcord.ui.View):
         await self.update_signup_sheet(interaction.message)
 
     async def update_signup_sheet(self, signup_message: nextcord.Message):
-        st_names = [st.display_name for st in self.helper.STRole.members] if len(self.helper.STRole.members) != 0 else ["unknown"]
+        st_names = [st.display_name for st in self.helper.role_members(self.helper.STRole)] or ["unknown"]
 
         embed = nextcord.Embed(title="Livetext Game Sign Up",
                                description="Ran by " + ", ".join(st_names) +
@@ -140,7 +146,7 @@ class SignupView(nextcord.ui.View):
                                             f"\nPress {refresh_emoji} if the list needs updating "
                                             "(if a command is used to assign roles)",
                                 color=0xff0000)        
-        player_list = self.helper.PlayerRole.members
+        player_list = self.helper.role_members(self.helper.PlayerRole)
         for i, player in enumerate(player_list):
             name = player.display_name
             embed.add_field(name=str(i + 1) + ". " + str(name),
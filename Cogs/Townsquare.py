@@ -4,17 +4,25 @@ import io
 import json
 import logging
 import os
+import time
 import traceback
+from bisect import bisect_left, insort
 from dataclasses import dataclass, field
 from math import ceil
-from typing import List, Optional, Dict, Union, Callable, Literal
+from typing import List, Optional, Dict, Union, Awaitable, Callable, Literal, Set
 
 import nextcord
 from dataclasses_json import dataclass_json
 from nextcord.ext import commands
 from nextcord.utils import get, utcnow, format_dt
 
+import codec
+import games
+import outbound
+import storage
+import threads
 import utility
+from roles import RoleChange
 
 not_voted_yet = "-"
 confirmed_yes_vote = "confirmed_yes_vote"
@@ -22,6 +30,7 @@ confirmed_no_vote = "confirmed_no_vote"
 voted_yes_emoji = '\U00002705'  # ✅
 voted_no_emoji = '\U0000274C'  # ❌
 clock_emoji = '\U0001f566'  # 🕦
+town_square_schema_version = 1
 
 @dataclass_json
 @dataclass
@@ -34,8 +43,17 @@ class Player:
 
 
     def __eq__(self, other):
+        if type(other) is Player:  # by far the most common comparison, skips the isinstance chain
+            return self.id == other.id
         return isinstance(other, (Player, nextcord.User, nextcord.Member)) and self.id == other.id
 
+    def to_row(self) -> list:
+        return [self.id, self.alias, self.can_vote, self.dead, self.banshee]
+
+    @staticmethod
+    def from_row(row: list) -> Player:
+        return Player(*row)
+
 
 @dataclass_json
 @dataclass
@@ -45,6 +63,13 @@ class Vote:
     thief: bool = False
     banshee: bool = False
 
+    def to_row(self) -> list:
+        return [self.vote, self.bureaucrat, self.thief, self.banshee]
+
+    @staticmethod
+    def from_row(row: list) -> Vote:
+        return Vote(*row)
+
 @dataclass_json
 @dataclass
 class Nomination:
@@ -58,6 +83,22 @@ class Nomination:
     finished: bool = False
     pause_votes: bool = False
 
+    def __post_init__(self):
+        self.tally = NominationTally()
+        # the message to edit, so updates need no lookup. Rebuilt from the ids when the nomination is loaded
+        self.message_handle: Optional[Union[nextcord.Message, nextcord.PartialMessage]] = None
+
+    def to_row(self) -> list:
+        return [self.nominator.to_row(), self.nominee.to_row(),
+                {player_id: vote.to_row() for player_id, vote in self.votes.items()},
+                self.accusation, self.defense, self.player_index, self.message, self.finished, self.pause_votes]
+
+    @staticmethod
+    def from_row(row: list) -> Nomination:
+        return Nomination(Player.from_row(row[0]), Player.from_row(row[1]),
+                          {player_id: Vote.from_row(vote) for player_id, vote in row[2].items()},
+                          *row[3:])
+
 
 @dataclass_json
 @dataclass
@@ -72,176 +113,687 @@ class TownSquare:
     vote_threshold: int = 0
     vote_time: int = 5 
 
+    def __post_init__(self):
+        self.revision = 0
+        self.participant_names: Optional[ParticipantNames] = None
+        self.reindex()
+
+    def reindex(self):
+        """Rebuilds the lookups by id. Must be called after changing the players or STs in place."""
+        self.revision += 1  # tells the caches built from the participants (nomination renders, names) to rebuild
+        self.player_by_id: Dict[int, Player] = {player.id: player for player in self.players}
+        self.seat_by_id: Dict[int, int] = {player.id: seat for seat, player in enumerate(self.players)}
+        self.st_by_id: Dict[int, Player] = {st.id: st for st in self.sts}
+
+    def get_player(self, player_id: int) -> Optional[Player]:
+        return self.player_by_id.get(player_id)
+
+    def get_st(self, st_id: int) -> Optional[Player]:
+        return self.st_by_id.get(st_id)
+
+    def get_participant(self, participant_id: int) -> Optional[Player]:
+        player = self.player_by_id.get(participant_id)
+        return player if player is not None else self.st_by_id.get(participant_id)
+
+    def get_seat(self, player_id: int) -> Optional[int]:
+        return self.seat_by_id.get(player_id)
+
+    def set_players(self, players: List[Player]):
+        self.players = players
+        self.reindex()
+
+    def add_st(self, st: Player):
+        self.sts.append(st)
+        self.reindex()
+
+    def remove_st(self, st_id: int):
+        st = self.st_by_id.get(st_id)
+        if st is not None:
+            self.sts.remove(st)
+            self.reindex()
+
+    def mark_changed(self, player_id: int):
+        """Tells the render of the current nomination that the player's alias or status changed."""
+        if self.current_nomination:
+            self.current_nomination.tally.mark_changed(player_id)
+
+    def substitute_player(self, player: Player, substitute_id: int, alias: str):
+        player.id = substitute_id
+        player.alias = alias
+        self.reindex()
+
+    def to_row(self) -> list:
+        return [[p.to_row() for p in self.players], [st.to_row() for st in self.sts],
+                self.current_nomination.to_row() if self.current_nomination else None,
+                self.nomination_thread, self.log_thread, self.organ_grinder, self.player_noms_allowed,
+                self.vote_threshold, self.vote_time]
+
+    @staticmethod
+    def from_row(row: list) -> TownSquare:
+        return TownSquare([Player.from_row(p) for p in row[0]], [Player.from_row(st) for st in row[1]],
+                          Nomination.from_row(row[2]) if row[2] is not None else None,
+                          *row[3:])
+
+    def to_bytes(self) -> bytes:
+        return codec.pack([town_square_schema_version, self.to_row()])
+
+    @staticmethod
+    def from_bytes(data: bytes) -> TownSquare:
+        version, row = codec.unpack(data)
+        if version != town_square_schema_version:
+            raise ValueError(f"Unsupported town square schema version {version}")
+        return TownSquare.from_row(row)
+
+class NominationTally:
+    """Renders the vote embed of a nomination incrementally.
+    Keeps the seat order, the running count of weighted yes votes and the rendered rows between renders, so only rows
+    marked as changed (and rows whose count or clock changes because of them) are rendered again.
+    """
+
+    def __init__(self):
+        self.changed: Set[int] = set()
+        self.revision: Optional[int] = None
+        self.order: List[Player] = []
+        self.seats: Dict[int, int] = {}
+        self.weights: List[int] = []
+        self.yes_seats: List[int] = []
+        self.counters: Dict[int, int] = {}
+        self.dead: List[bool] = []
+        self.living = 0
+        self.current = 0
+        self.votes_needed = 0
+        self.organ_grinder = False
+        self.emoji: Optional[Dict[str, nextcord.PartialEmoji]] = None
+        self.embed: Optional[nextcord.Embed] = None
+        self.full_renders = 0
+        self.rows_rendered = 0
+
+    def mark_changed(self, player_id: int):
+        """Call when the vote, alias, or status of a player changed."""
+        self.changed.add(player_id)
+
+    def invalidate(self):
+        self.revision = None
+
+    def votes_needed_for(self, town_square: TownSquare) -> int:
+        if town_square.vote_threshold == 0:
+            return ceil(self.living / 2)
+        return town_square.vote_threshold
+
+    def render(self, town_square: TownSquare, nom: Nomination, emoji: Dict[str, nextcord.PartialEmoji]) \
+            -> nextcord.Embed:
+        if self.revision != town_square.revision or self.organ_grinder != town_square.organ_grinder \
+                or self.emoji is not emoji:
+            self.rebuild(town_square, nom, emoji)
+            return self.embed
+        positions = sorted(self.seats[player_id] for player_id in self.changed if player_id in self.seats)
+        self.changed.clear()
+        rerender = set(positions)
+        for seat in positions:
+            player = self.order[seat]
+            if player.dead != self.dead[seat]:
+                self.living += -1 if player.dead else 1
+                self.dead[seat] = player.dead
+            weight = self.weight(player, nom)
+            if weight != self.weights[seat]:
+                if not self.weights[seat]:
+                    insort(self.yes_seats, seat)
+                elif not weight:
+                    self.yes_seats.remove(seat)
+                    del self.counters[seat]
+                self.weights[seat] = weight
+        votes_needed = self.votes_needed_for(town_square)
+        if votes_needed != self.votes_needed:
+            self.votes_needed = votes_needed
+            rerender.update(self.yes_seats)
+        if positions:
+            # rows before the first change keep their count, later yes votes continue from it
+            start = bisect_left(self.yes_seats, positions[0])
+            counter = self.counters[self.yes_seats[start - 1]] if start > 0 else 0
+            for seat in self.yes_seats[start:]:
+                counter += self.weights[seat]
+                if self.counters.get(seat) != counter:
+                    self.counters[seat] = counter
+                    rerender.add(seat)
+            if positions[0] <= self.current:
+                current = self.next_voter(nom, positions[0])
+                if current != self.current:
+                    rerender.update(seat for seat in (self.current, current) if seat < len(self.order))
+                    self.current = current
+        for seat in sorted(rerender):
+            name, value, inline = self.render_row(seat, nom)
+            self.embed.set_field_at(seat, name=name, value=value, inline=inline)
+        self.rows_rendered += len(rerender)
+        return self.embed
+
+    def rebuild(self, town_square: TownSquare, nom: Nomination, emoji: Dict[str, nextcord.PartialEmoji]):
+        self.revision = town_square.revision
+        self.organ_grinder = town_square.organ_grinder
+        self.emoji = emoji
+        self.changed.clear()
+        self.order = reordered_players(nom, town_square)
+        self.seats = {player.id: seat for seat, player in enumerate(self.order)}
+        self.dead = [player.dead for player in self.order]
+        self.living = self.dead.count(False)
+        self.weights = [self.weight(player, nom) for player in self.order]
+        self.yes_seats = [seat for seat, weight in enumerate(self.weights) if weight]
+        self.counters = {}
+        counter = 0
+        for seat in self.yes_seats:
+            counter += self.weights[seat]
+            self.counters[seat] = counter
+        self.votes_needed = self.votes_needed_for(town_square)
+        self.current = self.next_voter(nom, 0)
+        self.embed = nextcord.Embed(title="Votes",
+                                    color=0xff0000)
+        for seat in range(len(self.order)):
+            name, value, inline = self.render_row(seat, nom)
+            self.embed.add_field(name=name, value=value, inline=inline)
+        self.full_renders += 1
+        self.rows_rendered += len(self.order)
+
+    def weight(self, player: Player, nom: Nomination) -> int:
+        # how much the player's vote adds to the yes count
+        vote = nom.votes[player.id]
+        if not player.can_vote or self.organ_grinder or vote.vote != confirmed_yes_vote:
+            return 0
+        value = 1
+        if vote.thief:
+            value *= -1
+        if vote.bureaucrat:
+            value *= 3
+        if vote.banshee:
+            value *= 2
+        return value
+
+    def next_voter(self, nom: Nomination, start: int) -> int:
+        # seat of the first player from start on who still has to vote, len(order) if there is none
+        for seat in range(start, len(self.order)):
+            player = self.order[seat]
+            if player.can_vote and nom.votes[player.id].vote not in [confirmed_yes_vote, confirmed_no_vote]:
+                return seat
+        return len(self.order)
+
+    def render_row(self, seat: int, nom: Nomination) -> tuple[str, str, bool]:
+        player = self.order[seat]
+        name = player.alias + " (Nominator)" if player == nom.nominator else player.alias
+        if player.dead:
+            name = str(self.emoji["shroud"]) + " " + name
+        if seat == self.current:
+            name = clock_emoji + " " + name
+        vote = nom.votes[player.id]
+        if not player.can_vote:
+            return f"~~{name}~~", "", True
+        if self.organ_grinder:
+            return name, str(self.emoji["organ_grinder"]), False
+        if vote.vote == confirmed_yes_vote:
+            return name, f"{voted_yes_emoji} ({self.counters[seat]}/{self.votes_needed})", False
+        if vote.vote == confirmed_no_vote:
+            return name, voted_no_emoji, False
+        return name, vote.vote, False
+
+
 def format_nom_message(game_role: nextcord.Role, town_square: TownSquare, nom: Nomination,
                        emoji: Dict[str, nextcord.PartialEmoji]) -> tuple[str, nextcord.Embed]:
-    if town_square.vote_threshold == 0:
-        votes_needed = ceil(len([player for player in town_square.players if not player.dead]) / 2)
-    else:
-        votes_needed = town_square.vote_threshold
-    players = reordered_players(nom, town_square)
-    current_voter = next((player for player in players if player.can_vote and
-                          nom.votes[player.id].vote not in [confirmed_yes_vote, confirmed_no_vote]), None)
+    embed = nom.tally.render(town_square, nom, emoji)
+    votes_needed = nom.tally.votes_needed
     content = f"{game_role.mention} {nom.nominator.alias} has nominated {nom.nominee.alias}.\n" \
               f"Accusation: {nom.accusation}\n" \
               f"Defense: {nom.defense}\n" \
               f"{votes_needed} votes required to put {nom.nominee.alias} on the block.\n"
-    embed = nextcord.Embed(title="Votes",
-                           color=0xff0000)
-    counter = 0
-    for player in players:
-        name = player.alias + " (Nominator)" if player == nom.nominator else player.alias
-        if player.dead:
-            name = str(emoji["shroud"]) + " " + name
-        if player == current_voter:
-            name = clock_emoji + " " + name
-        vote = nom.votes[player.id]
-        if (not player.can_vote) and vote != confirmed_yes_vote:
-            embed.add_field(name=f"~~{name}~~", value="", inline=True)
-        else:
-            if town_square.organ_grinder:
-                embed.add_field(name=name,
-                                value=str(emoji["organ_grinder"]),
-                                inline=False)
-            elif vote.vote == confirmed_yes_vote:
-                value = 1
-                if vote.thief:
-                    value *= -1
-                if vote.bureaucrat:
-                    value *= 3
-                if vote.banshee:
-                    value *= 2
-                counter += value
-                embed.add_field(name=name,
-                                value=f"{voted_yes_emoji} ({counter}/{votes_needed})",
-                                inline=False)
-            elif vote.vote == confirmed_no_vote:
-                embed.add_field(name=name,
-                                value=voted_no_emoji,
-                                inline=False)
-            else:
-                embed.add_field(name=name,
-                                value=nom.votes[player.id].vote,
-                                inline=False)
     return content, embed
 
 
-def reordered_players(nom: Nomination, town_square: TownSquare) -> List[Player]:
-    if nom.nominee in town_square.players:
-        last_vote_index = next(i for i, player in enumerate(town_square.players) if player == nom.nominee)
-    elif nom.nominator in town_square.players:
-        last_vote_index = next(i for i, player in enumerate(town_square.players) if player == nom.nominator)
+def apply_journal_record(town_square: TownSquare, record: dict):
+    # replays a change from the journal files used before the database existed
+    op = record["op"]
+    nom = town_square.current_nomination
+    if op == "vote":
+        nom.votes[record["player"]] = Vote(record["vote"])
+    elif op == "vote_locked":
+        nom.votes[record["player"]].vote = record["vote"]
+        nom.player_index = record["player_index"]
+        nom.finished = record["finished"]
+    elif op == "player":
+        player = town_square.get_player(record["id"])
+        if "dead" in record:
+            player.dead = record["dead"]
+        if "can_vote" in record:
+            player.can_vote = record["can_vote"]
+    elif op == "alias":
+        affected = town_square.players + town_square.sts
+        if nom:
+            affected += [nom.nominator, nom.nominee]
+        for participant in affected:
+            if participant.id == record["id"]:
+                participant.alias = record["alias"]
+    elif op == "nomination_opened":
+        town_square.current_nomination = Nomination.from_dict(record["nomination"])
+    elif op == "nomination_closed":
+        nom.finished = True
     else:
+        raise ValueError(f"Unknown journal record: {record}")
+
+
+def reordered_players(nom: Nomination, town_square: TownSquare) -> List[Player]:
+    last_vote_index = town_square.get_seat(nom.nominee.id)
+    if last_vote_index is None:
+        last_vote_index = town_square.get_seat(nom.nominator.id)
+    if last_vote_index is None:
         last_vote_index = len(town_square.players) - 1
     return town_square.players[last_vote_index + 1:] + town_square.players[:last_vote_index + 1]
 
 
+class NameIndex:
+    """Looks up which of a list of names contain, start with or equal a string, with or without case.
+    Keeps the names and all their suffixes sorted, as a substring of a name is the start of one of its suffixes.
+    Results are positions in the list, in order; names that are None match nothing.
+    """
+
+    def __init__(self, names: List[Optional[str]]):
+        self.names: List[Optional[str]] = []
+        self.sorted_names: List[tuple[str, int]] = []
+        self.sorted_lower_names: List[tuple[str, int]] = []
+        self.suffixes: List[tuple[str, int]] = []
+        self.lower_suffixes: List[tuple[str, int]] = []
+        for name in names:
+            self.names.append(None)
+            self.set_name(len(self.names) - 1, name)
+
+    def set_name(self, position: int, name: Optional[str]):
+        old_name = self.names[position]
+        if old_name is not None:
+            for sorted_list in [self.sorted_names, self.sorted_lower_names, self.suffixes, self.lower_suffixes]:
+                sorted_list[:] = [entry for entry in sorted_list if entry[1] != position]
+        self.names[position] = name
+        if name is None:
+            return
+        lower_name = name.lower()
+        insort(self.sorted_names, (name, position))
+        insort(self.sorted_lower_names, (lower_name, position))
+        for i in range(len(name)):
+            insort(self.suffixes, (name[i:], position))
+        for i in range(len(lower_name)):
+            insort(self.lower_suffixes, (lower_name[i:], position))
+
+    @staticmethod
+    def starting_with(sorted_list: List[tuple[str, int]], start: str) -> List[int]:
+        positions = set()
+        i = bisect_left(sorted_list, (start, -1))
+        while i < len(sorted_list) and sorted_list[i][0].startswith(start):
+            positions.add(sorted_list[i][1])
+            i += 1
+        return sorted(positions)
+
+    def containing(self, identifier: str, ignore_case: bool) -> List[int]:
+        if ignore_case:
+            return self.starting_with(self.lower_suffixes, identifier.lower())
+        return self.starting_with(self.suffixes, identifier)
+
+    def prefixed(self, identifier: str, ignore_case: bool) -> List[int]:
+        if ignore_case:
+            return self.starting_with(self.sorted_lower_names, identifier.lower())
+        return self.starting_with(self.sorted_names, identifier)
+
+    def equal(self, identifier: str, ignore_case: bool) -> List[int]:
+        if ignore_case:
+            identifier = identifier.lower()
+            return [position for position in self.prefixed(identifier, True)
+                    if self.names[position].lower() == identifier]
+        return [position for position in self.prefixed(identifier, False) if self.names[position] == identifier]
+
+    def best_matches(self, identifier: str) -> List[int]:
+        """Narrows down ambiguous matches: containing, then starting with, then equal to the identifier, trying to
+        ignore the case first at each step.
+        """
+        matches = self.containing(identifier, True)
+        if len(matches) > 1:
+            matches = self.prefixed(identifier, True)
+            if len(matches) < 1:
+                matches = self.containing(identifier, False)
+            elif len(matches) > 1:
+                matches = self.prefixed(identifier, False)
+                if len(matches) < 1:
+                    matches = self.equal(identifier, True)
+                elif len(matches) > 1:
+                    matches = self.equal(identifier, False)
+        return matches
+
+
+class ParticipantNames:
+    """Indexes the aliases, display names and usernames of a town square's participants (players, then STs) for
+    resolving the names given to commands. Built once per town square and updated when one of the names changes.
+    """
+
+    def __init__(self, town_square: TownSquare, guild: nextcord.Guild):
+        self.revision = town_square.revision
+        participants = town_square.players + town_square.sts
+        self.participants = participants
+        self.ids = [p.id for p in participants]
+        self.positions: Dict[int, List[int]] = {}
+        for position, participant_id in enumerate(self.ids):
+            self.positions.setdefault(participant_id, []).append(position)
+        members = [guild.get_member(p.id) for p in participants]
+        self.aliases = NameIndex([p.alias for p in participants])
+        self.display_names = NameIndex([m.display_name if m is not None else None for m in members])
+        self.usernames = NameIndex([m.name if m is not None else None for m in members])
+
+    def alias_changed(self, participant: Player):
+        # someone seated and also an ST has separate entries with separate aliases
+        for position in self.positions.get(participant.id, []):
+            if self.participants[position] is participant:
+                self.aliases.set_name(position, participant.alias)
+
+    def update_member(self, member: nextcord.Member):
+        for position in self.positions.get(member.id, []):
+            if self.display_names.names[position] != member.display_name:
+                self.display_names.set_name(position, member.display_name)
+            if self.usernames.names[position] != member.name:
+                self.usernames.set_name(position, member.name)
+
+    def matches(self, names: NameIndex, identifier: str) -> List[int]:
+        return [self.ids[position] for position in names.best_matches(identifier)]
+
+
+class NominationMessages:
+    """Edits the nomination messages. Skips edits that would not change what a message shows, and sends at most one
+    edit per message at a time, folding all renders arriving in the meantime into the next edit. If the message was
+    deleted, missing is called once with its id, however many renders were waiting.
+    """
+    max_tracked = 100
+
+    def __init__(self, missing: Callable[[int], Awaitable[None]]):
+        self.missing = missing
+        self.fingerprints: Dict[int, str] = {}
+        # message id -> (message, content, embed, future of the callers waiting, time the oldest of them queued)
+        self.pending: Dict[int, tuple[nextcord.Message, str, nextcord.Embed, asyncio.Future, float]] = {}
+        self.editing: Dict[int, asyncio.Task] = {}
+        self.edits = 0
+        self.edits_skipped = 0
+        self.edits_coalesced = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        utility.register_metrics("nomination_messages", self.stats)
+
+    @staticmethod
+    def fingerprint(content: str, embed: nextcord.Embed) -> str:
+        # serialised rather than kept as a dict, as the cached embed is changed in place by later renders
+        return json.dumps([content, embed.to_dict()], sort_keys=True)
+
+    def sent(self, message_id: int, content: str, embed: nextcord.Embed):
+        self.remember(message_id, self.fingerprint(content, embed))
+
+    def remember(self, message_id: int, fingerprint: str):
+        self.fingerprints[message_id] = fingerprint
+        if len(self.fingerprints) > self.max_tracked:
+            del self.fingerprints[next(iter(self.fingerprints))]
+
+    def forget(self, message_id: int):
+        self.fingerprints.pop(message_id, None)
+
+    def needs_edit(self, message_id: int, content: str, embed: nextcord.Embed) -> bool:
+        if message_id in self.editing:
+            return True  # an earlier render is still on its way, so what the message will show is not known yet
+        if self.fingerprints.get(message_id) == self.fingerprint(content, embed):
+            self.edits_skipped += 1
+            return False
+        return True
+
+    async def edit(self, message: nextcord.Message, content: str, embed: nextcord.Embed):
+        """Returns once an edit showing this render or a later one is done, or the message turned out to be deleted.
+        Raises if that edit failed otherwise.
+        """
+        pending = self.pending.get(message.id)
+        if pending is None:
+            future = asyncio.get_running_loop().create_future()
+            queued = time.monotonic()
+        else:
+            _, _, _, future, queued = pending
+            self.edits_coalesced += 1
+        self.pending[message.id] = (message, content, embed, future, queued)
+        if message.id not in self.editing:
+            self.editing[message.id] = asyncio.create_task(self.send_edits(message.id))
+        await asyncio.shield(future)
+
+    async def send_edits(self, message_id: int):
+        try:
+            while message_id in self.pending:
+                message, content, embed, future, queued = self.pending.pop(message_id)
+                # taken before the edit, as renders arriving while it is sent change the embed
+                fingerprint = self.fingerprint(content, embed)
+                try:
+                    if self.fingerprints.get(message_id) == fingerprint:
+                        self.edits_skipped += 1
+                    else:
+                        await outbound.scheduler.run(outbound.CRITICAL,
+                                                     lambda: message.edit(content=content, embed=embed))
+                        self.edits += 1
+                        self.remember(message_id, fingerprint)
+                except nextcord.HTTPException as e:
+                    if e.code != 10008:  # Discord's 404
+                        future.set_exception(e)
+                        continue
+                    self.forget(message_id)
+                    # renders arriving later would fail the same way
+                    self.pending.pop(message_id, None)
+                    future.set_result(None)
+                    await self.missing(message_id)
+                    continue
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+                self.last_latency = time.monotonic() - queued
+                self.max_latency = max(self.max_latency, self.last_latency)
+        finally:
+            del self.editing[message_id]
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"edits": self.edits,
+                "edits_skipped": self.edits_skipped,
+                "edits_coalesced": self.edits_coalesced,
+                "last_latency_ms": round(self.last_latency * 1000, 1),
+                "max_latency_ms": round(self.max_latency * 1000, 1)}
+
+
 class Townsquare(commands.Cog):
     bot: commands.Bot
     helper: utility.Helper
-    TownSquareStorage: str
-    town_square: TownSquare
-    emoji: Dict[str, nextcord.PartialEmoji]
+    store: storage.Store
+    guild_emoji: Dict[int, Dict[str, nextcord.PartialEmoji]]
+    nom_messages: NominationMessages
 
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
-        self.TownSquareStorage = os.path.join(self.helper.StorageLocation, "townsquare.json")
-        self.emoji = {}
+        self.store = storage.get_store(self.helper.StorageLocation)
+        self.guild_emoji = {}
+        self.nom_messages = NominationMessages(self.nomination_message_missing)
         self.vote_count_view = None
-        self.town_square = None
-        if not os.path.exists(self.TownSquareStorage):
-            with open(self.TownSquareStorage, 'w') as f:
-                json.dump({}, f, indent=2)
-        else:
-            with open(self.TownSquareStorage, 'r') as f:
+        self.migrate_legacy_storage()
+        self.helper.Games.register(self.load_state, self.unload_state)
+
+    async def load_state(self, state: games.GameState):
+        game_id = state.config.channel.id
+        state.town_square_storage = storage.WriteBehind(f"townsquare.{game_id}", lambda: self.write_storage(state),
+                                                        self.helper.StorageFlushInterval)
+        row = await self.store.load_town_square(game_id)
+        state.town_square = TownSquare.from_row(row) if row is not None else None
+
+    @staticmethod
+    def unload_state(state: games.GameState):
+        state.town_square_storage.close()
+
+    @property
+    def town_square(self) -> Optional[TownSquare]:
+        return self.helper.game_state().town_square
+
+    @town_square.setter
+    def town_square(self, town_square: Optional[TownSquare]):
+        self.helper.game_state().town_square = town_square
+
+    @property
+    def emoji(self) -> Dict[str, nextcord.PartialEmoji]:
+        return self.guild_emoji.get(self.helper.Guild.id, {})
+
+    def migrate_legacy_storage(self):
+        """Imports the town square from the files used before the database existed."""
+        binary_storage = os.path.join(self.helper.StorageLocation, "townsquare.bin")
+        json_storage = os.path.join(self.helper.StorageLocation, "townsquare.json")
+        journal_storage = os.path.join(self.helper.StorageLocation, "townsquare.journal")
+        generation = 0
+        town_square = None
+        if os.path.exists(binary_storage):
+            with open(binary_storage, 'rb') as f:
+                generation, data = codec.unpack(f.read())
+            if data is not None:
+                town_square = TownSquare.from_bytes(data)
+        elif os.path.exists(json_storage):
+            with open(json_storage, 'r') as f:
                 json_data = json.load(f)
-                if json_data != {}:
-                    self.town_square = TownSquare.from_dict(json_data)
+            if "players" in json_data:  # snapshot from before the journal existed
+                town_square = TownSquare.from_dict(json_data)
+            else:
+                generation = json_data.get("generation", 0)
+                if json_data.get("town_square"):
+                    town_square = TownSquare.from_dict(json_data["town_square"])
+        else:
+            return
+        journal_generation, records = storage.read_journal(journal_storage)
+        if journal_generation == generation:
+            for record in records:
+                try:
+                    apply_journal_record(town_square, record)
+                except Exception as e:
+                    logging.exception(f"Could not replay town square journal record {record}: {e}")
+        self.store.save_town_square(self.helper.Games.default.channel.id,
+                                    town_square.to_row() if town_square else None)
+        for path in [binary_storage, json_storage, journal_storage]:
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        logging.info("Imported the town square from files into the database")
 
     async def load_emoji(self):
-        self.emoji = {}
+        emoji = self.guild_emoji.setdefault(self.helper.Guild.id, {})
         shroud_emoji = get(self.helper.Guild.emojis, name="shroud")
         if shroud_emoji is not None:
-            self.emoji["shroud"] = nextcord.PartialEmoji.from_str(
+            emoji["shroud"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=shroud_emoji))
         else:
-            self.emoji["shroud"] = nextcord.PartialEmoji.from_str('\U0001F480')  # 💀
+            emoji["shroud"] = nextcord.PartialEmoji.from_str('\U0001F480')  # 💀
             await self.helper.log("Shroud emoji not found, using default")
         thief_emoji = get(self.helper.Guild.emojis, name="thief")
         if thief_emoji is not None:
-            self.emoji["thief"] = nextcord.PartialEmoji.from_str(
+            emoji["thief"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=thief_emoji))
         else:
-            self.emoji["thief"] = nextcord.PartialEmoji.from_str('\U0001F48E')  # 💎
+            emoji["thief"] = nextcord.PartialEmoji.from_str('\U0001F48E')  # 💎
             await self.helper.log("Thief emoji not found, using default")
         bureaucrat_emoji = get(self.helper.Guild.emojis, name="bureaucrat")
         if bureaucrat_emoji is not None:
-            self.emoji["bureaucrat"] = nextcord.PartialEmoji.from_str(
+            emoji["bureaucrat"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=bureaucrat_emoji))
         else:
-            self.emoji["bureaucrat"] = nextcord.PartialEmoji.from_str('\U0001f4ce')  # 📎
+            emoji["bureaucrat"] = nextcord.PartialEmoji.from_str('\U0001f4ce')  # 📎
             await self.helper.log("Bureaucrat emoji not found, using default")
         banshee_emoji = get(self.helper.Guild.emojis, name="banshee")
         if banshee_emoji is not None:
-            self.emoji["banshee"] = nextcord.PartialEmoji.from_str(
+            emoji["banshee"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=banshee_emoji))
         else:
-            self.emoji["banshee"] = nextcord.PartialEmoji.from_str('\U0001f47b')  # 👻
+            emoji["banshee"] = nextcord.PartialEmoji.from_str('\U0001f47b')  # 👻
             await self.helper.log("Banshee emoji not found, using default")
         organ_grinder_emoji = get(self.helper.Guild.emojis, name="organ_grinder")
         if organ_grinder_emoji is not None:
-            self.emoji["organ_grinder"] = nextcord.PartialEmoji.from_str(
+            emoji["organ_grinder"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=organ_grinder_emoji))
         else:
-            self.emoji["organ_grinder"] = nextcord.PartialEmoji.from_str('\U0001f648')  # 🙈
+            emoji["organ_grinder"] = nextcord.PartialEmoji.from_str('\U0001f648')  # 🙈
             await self.helper.log("Organ grinder emoji not found, using default")
 
+    def cog_unload(self):
+        for state in self.helper.Games.states.values():
+            state.town_square_storage.flush()
+
+    async def write_snapshot(self):
+        """Writes the town square of the game as a binary snapshot to the snapshots folder in the storage location."""
+        if self.town_square is None:
+            return
+        directory = os.path.join(self.helper.StorageLocation, "snapshots")
+        path = os.path.join(directory, f"townsquare-{self.helper.GameChannel.id}-{utcnow():%Y%m%d-%H%M%S}.bin")
+        data = self.town_square.to_bytes()
+
+        def write():
+            os.makedirs(directory, exist_ok=True)
+            storage.atomic_write(path, data)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+        except OSError as e:
+            logging.exception(f"Could not write town square snapshot {path}: {e}")
+
     def update_storage(self):
-        json_data = {}
-        if self.town_square:
-            json_data = self.town_square.to_dict()
-        with open(self.TownSquareStorage, 'w') as f:
-            json.dump(json_data, f, indent=2)
+        """Schedules writing the whole town square."""
+        self.helper.game_state().town_square_storage.mark_dirty()
+
+    def record(self, change: Callable[..., None], *args):
+        """Stores a single change to the town square as a row-level update, e.g. self.store.set_vote."""
+        state = self.helper.game_state()
+        if state.town_square_storage.dirty:
+            return  # the pending write of the whole town square will contain this change
+        change(state.config.channel.id, *args)
+
+    def write_storage(self, state: games.GameState):
+        self.store.save_town_square(state.config.channel.id,
+                                    state.town_square.to_row() if state.town_square else None)
 
     async def log(self, message: str):
-        log_thread = get(self.helper.GameChannel.threads, id=self.town_square.log_thread)
-        await log_thread.send((format_dt(utcnow()) + ": " + message)[:2000])
+        self.helper.log_sink(self.town_square.log_thread).add(format_dt(utcnow()) + ": " + message)
 
     async def update_nom_message(self, nom: Nomination):
         game_role = self.helper.PlayerRole
         content, embed = format_nom_message(game_role, self.town_square, nom, self.emoji)
-        game_channel = self.helper.GameChannel
-        nom_thread = get(game_channel.threads, id=self.town_square.nomination_thread)
-        try:
-            nom_message = await nom_thread.fetch_message(nom.message)
-            await nom_message.edit(content=content, embed=embed)
-        except nextcord.HTTPException as e:
-            if e.code == 10008:  # Discord's 404
-                logging.error(f"Missing message for nomination of {nom.nominee.alias} in livetext")
-                st_role = self.helper.STRole
-                await self.log(f"{st_role.mention} Could not find the nomination message for the "
-                                f"nomination of {nom.nominee.alias} to update it. Please close the "
-                                f"nomination to prevent this happening again.")
-                return
-            else:
-                raise e
+        if not self.nom_messages.needs_edit(nom.message, content, embed):
+            return
+        if nom.message_handle is None:
+            nom_thread = self.bot.get_partial_messageable(self.town_square.nomination_thread,
+                                                          type=nextcord.ChannelType.public_thread)
+            nom.message_handle = nom_thread.get_partial_message(nom.message)
+        await self.nom_messages.edit(nom.message_handle, content, embed)
         logging.debug(f"Updated nomination for livetext: {nom}")
 
+    async def nomination_message_missing(self, message_id: int):
+        # runs in the task sending the edits, which belongs to the game of the command that started it
+        nom = self.town_square.current_nomination if self.town_square else None
+        if nom is None or nom.message != message_id:
+            return
+        nom.message_handle = None
+        logging.error(f"Missing message for nomination of {nom.nominee.alias} in livetext")
+        st_role = self.helper.STRole
+        await self.log(f"{st_role.mention} Could not find the nomination message for the "
+                       f"nomination of {nom.nominee.alias} to update it. Please close the "
+                       f"nomination to prevent this happening again.")
+
+    def participant_names(self) -> ParticipantNames:
+        names = self.town_square.participant_names
+        if names is None or names.revision != self.town_square.revision:
+            names = ParticipantNames(self.town_square, self.helper.Guild)
+            self.town_square.participant_names = names
+        return names
+
     def get_game_participant(self, identifier: str) -> Union[nextcord.Member, None]:
-        participants = self.town_square.players + self.town_square.sts
         # handle explicit mentions
         if utility.is_mention(identifier):
-            member = get(self.helper.Guild.members, id=int(identifier[2:-1]))
-            if member is not None and member.id in [p.id for p in participants]:
+            member = self.helper.Guild.get_member(int(identifier[2:-1]))
+            if member is not None and self.town_square.get_participant(member.id) is not None:
                 return member
             else:
                 return None
         # check alternatives for identifying the player
-        alias_matches = self.try_get_matching_player(participants, identifier, lambda p: p.alias)
-        display_names = {p.id: get(self.helper.Guild.members, id=p.id).display_name for p in participants}
-        display_name_matches = self.try_get_matching_player(participants, identifier, lambda p: display_names[p.id])
-        usernames = {p.id: get(self.helper.Guild.members, id=p.id).name for p in participants}
-        username_matches = self.try_get_matching_player(participants, identifier, lambda p: usernames[p.id])
+        names = self.participant_names()
+        alias_matches = names.matches(names.aliases, identifier)
+        display_name_matches = names.matches(names.display_names, identifier)
+        username_matches = names.matches(names.usernames, identifier)
         if len(alias_matches) == 1:
             target_id = alias_matches[0]
         elif len(alias_matches) > 1:
@@ -266,7 +818,27 @@ class Townsquare(commands.Cog):
             target_id = username_matches[0]
         else:
             return None
-        return get(self.helper.Guild.members, id=target_id)
+        return self.helper.Guild.get_member(target_id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: nextcord.Member, after: nextcord.Member):
+        if before.display_name != after.display_name or before.name != after.name:
+            self.update_participant_names(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: nextcord.User, after: nextcord.User):
+        if before.name != after.name:
+            for config in self.helper.Games.configs.values():
+                member = config.guild.get_member(after.id)
+                if member is not None:
+                    self.update_participant_names(member)
+
+    def update_participant_names(self, member: nextcord.Member):
+        # only loaded games can have an index
+        for state in self.helper.Games.states.values():
+            if state.config.guild.id == member.guild.id and state.town_square is not None \
+                    and state.town_square.participant_names is not None:
+                state.town_square.participant_names.update_member(member)
 
     # runs before each command - checks a town square exists
     async def cog_check(self, ctx: commands.Context) -> bool:
@@ -279,22 +851,6 @@ class Townsquare(commands.Cog):
         else:
             return True
 
-    @staticmethod
-    def try_get_matching_player(player_list: List[Player], identifier: str, attribute: Callable[[Player], str]) \
-            -> List[int]:
-        matches = [p.id for p in player_list if identifier.lower() in attribute(p).lower()]
-        if len(matches) > 1:
-            matches = [p.id for p in player_list if attribute(p).lower().startswith(identifier.lower())]
-            if len(matches) < 1:
-                matches = [p.id for p in player_list if identifier in attribute(p)]
-            elif len(matches) > 1:
-                matches = [p.id for p in player_list if attribute(p).startswith(identifier)]
-                if len(matches) < 1:
-                    matches = [p.id for p in player_list if attribute(p).lower() == identifier.lower()]
-                elif len(matches) > 1:
-                    matches = [p.id for p in player_list if attribute(p) == identifier]
-        return matches
-
     @commands.command(aliases = ["SetupTS"])
     async def SetupTownSquare(self, ctx: commands.Context, 
                               players: commands.Greedy[nextcord.Member]):
@@ -306,9 +862,12 @@ class Townsquare(commands.Cog):
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
 
+            sts = self.helper.role_members(self.helper.STRole)
             player_list = [Player(p.id, p.display_name) for p in players]
-            st_list = [Player(st.id, st.display_name) for st in self.helper.STRole.members]
+            st_list = [Player(st.id, st.display_name) for st in sts]
             self.town_square = TownSquare(player_list, st_list)
+            # in the background, so that the first DMs to the participants during the game need a request less
+            asyncio.create_task(self.helper.DMs.prewarm(list(players) + sts))
             channel = self.helper.GameChannel
 
             try:
@@ -330,10 +889,12 @@ class Townsquare(commands.Cog):
                     await utility.deny_command(ctx, "Failed to create logging thread.")
                     return
                 
-            for st in self.helper.STRole.members:
-                await log_thread.add_user(st)
+            self.helper.ThreadMembers.created(log_thread)
+            for st in self.helper.role_members(self.helper.STRole):
+                await self.helper.ThreadMembers.add_user(log_thread, st)
 
             self.town_square.log_thread = log_thread.id
+            self.helper.game_state().threads.add(log_thread, threads.log_thread)
             await self.log(f"Town square created: {self.town_square}")
             self.update_storage()
             await utility.finish_processing(ctx)
@@ -355,9 +916,10 @@ class Townsquare(commands.Cog):
             await utility.start_processing(ctx)
 
             new_player_list = [self.reuse_or_convert_player(p) for p in players]
-            removed_players = [p for p in self.town_square.players if p not in new_player_list]
-            added_players = [p for p in new_player_list if p not in self.town_square.players]
-            self.town_square.players = new_player_list
+            new_ids = {p.id for p in new_player_list}
+            removed_players = [p for p in self.town_square.players if p.id not in new_ids]
+            added_players = [p for p in new_player_list if self.town_square.get_player(p.id) is None]
+            self.town_square.set_players(new_player_list)
             nom = self.town_square.current_nomination
 
             if nom:
@@ -373,12 +935,25 @@ class Townsquare(commands.Cog):
             await utility.deny_command(ctx, "You are not the storyteller for this game")
 
     def reuse_or_convert_player(self, player: nextcord.Member) -> Player:
-        existing_player = next((p for p in self.town_square.players if p.id == player.id), None)
+        existing_player = self.town_square.get_player(player.id)
         if existing_player:
             return existing_player
         else:
             return Player(player.id, player.display_name)
 
+    async def add_substitute_to_threads(self, player: nextcord.Member, substitute: nextcord.Member):
+        """Adds the substitute to the threads created since the last <SetStart which the player is in."""
+        other_cog = self.bot.get_cog("Other")
+        recent_threads = [thread for thread in self.helper.GameChannel.threads
+                          if thread.create_timestamp > other_cog.start_time]
+        player_threads = await self.helper.ThreadMembers.threads_with(player.id, recent_threads,
+                                                                      self.helper.ThreadConcurrency)
+        results = await asyncio.gather(*[self.helper.ThreadMembers.add_user(thread, substitute)
+                                         for thread in player_threads], return_exceptions=True)
+        for thread, result in zip(player_threads, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Failed to add {substitute} to {thread}: {result}")
+
     @commands.command(aliases=["SubPlayer"])
     async def SubstitutePlayer(self, ctx: commands.Context, player: nextcord.Member,
                                substitute: nextcord.Member):
@@ -394,28 +969,19 @@ class Townsquare(commands.Cog):
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
 
-            player_list = self.town_square.players
-            current_player = next((p for p in player_list if p.id == player.id), None)
+            current_player = self.town_square.get_player(player.id)
             if current_player is None:
                 await utility.deny_command(ctx, f"{player.display_name} is not a participant.")
                 return
-            substitute_existing_player = next((p for p in player_list if p.id == substitute.id), None)
-            if substitute_existing_player is not None:
+            if self.town_square.get_player(substitute.id) is not None:
                 await utility.deny_command(ctx, f"{substitute.display_name} is already a player.")
                 return
             
             game_role = self.helper.PlayerRole
-            await player.remove_roles(game_role, reason="substituted out")
-            await substitute.add_roles(game_role, reason="substituted in")
-            current_player.id = substitute.id
-            current_player.alias = substitute.display_name
-
-            game_channel = self.helper.GameChannel
-            other_cog = self.bot.get_cog("Other")
-            for thread in game_channel.threads:
-                thread_members = await thread.fetch_members()
-                if player in [tm.member for tm in thread_members] and thread.create_timestamp > other_cog.start_time:
-                    await thread.add_user(substitute)
+            await self.helper.change_roles(ctx.author, [RoleChange(player, game_role, False, "substituted out"),
+                                                        RoleChange(substitute, game_role, True, "substituted in")])
+            self.town_square.substitute_player(current_player, substitute.id, substitute.display_name)
+            await self.add_substitute_to_threads(player, substitute)
 
             nom = self.town_square.current_nomination
             if nom and not nom.finished:
@@ -444,21 +1010,34 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, f"{substitute.display_name} is already a player.")
                 return
 
-            await player.remove_roles(game_role, reason="substituted out")
-            await substitute.add_roles(game_role, reason="substituted in")
-
-            game_channel = self.helper.GameChannel
-            other_cog = self.bot.get_cog("Other")
-            for thread in game_channel.threads:
-                thread_members = await thread.fetch_members()
-                if player in [tm.member for tm in thread_members] and thread.create_timestamp > other_cog.start_time:
-                    await thread.add_user(substitute)
+            await self.helper.change_roles(ctx.author, [RoleChange(player, game_role, False, "substituted out"),
+                                                        RoleChange(substitute, game_role, True, "substituted in")])
+            await self.add_substitute_to_threads(player, substitute)
 
             logging.debug(f"Substituted {player} with {substitute} in livetext")
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not the storyteller for this game")
 
+    @commands.command(aliases=["ExportTS"])
+    async def ExportTownSquare(self, ctx: commands.Context, export_format: Optional[str] = "json"):
+        """Sends you the current town square as a JSON file, or as a binary snapshot with `binary`.
+        You must be a storyteller for this.
+        """
+        if self.helper.authorize_st_command(ctx.author):
+            if export_format.lower() not in ["json", "binary"]:
+                await utility.deny_command(ctx, "The format must be `json` or `binary`")
+                return
+            await utility.start_processing(ctx)
+            if export_format.lower() == "binary":
+                file = nextcord.File(io.BytesIO(self.town_square.to_bytes()), "townsquare.bin")
+            else:
+                file = nextcord.File(io.BytesIO(self.town_square.to_json(indent=2).encode("utf-8")), "townsquare.json")
+            await ctx.author.send("Town square", file=file)
+            await utility.finish_processing(ctx)
+        else:
+            await utility.deny_command(ctx, "You are not the storyteller for this game")
+
     @commands.command(aliases=["CreateNomThread", "CreateNominationsThread"])
     async def CreateNominationThread(self, ctx: commands.Context, name: Optional[str]):
         """Creates a thread for nominations to be run in.
@@ -472,9 +1051,11 @@ class Townsquare(commands.Cog):
             thread = await game_channel.create_thread(name=name[:100] if name is not None else "Nominations",
                                                       auto_archive_duration=60, # 1h
                                                       type=nextcord.ChannelType.public_thread)
-            for st in self.helper.STRole.members:
-                await thread.add_user(st)
+            self.helper.ThreadMembers.created(thread)
+            for st in self.helper.role_members(self.helper.STRole):
+                await self.helper.ThreadMembers.add_user(thread, st)
             self.town_square.nomination_thread = thread.id
+            self.helper.game_state().threads.add(thread, threads.nomination_thread)
             self.update_storage()
             await utility.finish_processing(ctx)
         else:
@@ -508,16 +1089,15 @@ class Townsquare(commands.Cog):
             await utility.deny_command(ctx, "The nomination thread has not been created. Ask an ST to fix this.")
         else:
             await utility.start_processing(ctx)
-            participants = self.town_square.players + self.town_square.sts
-            converted_nominee = next((p for p in participants if p.id == nominee.id), None)
+            converted_nominee = self.town_square.get_participant(nominee.id)
             if not converted_nominee:
                 await utility.deny_command(ctx,
                                            "The Nominee is not included in the town square. Ask an ST to fix this.")
                 return
             if not nominator_identifier:
-                converted_nominator = next((p for p in participants if p.id == ctx.author.id), None)
+                converted_nominator = self.town_square.get_participant(ctx.author.id)
             else:
-                converted_nominator = next((p for p in participants if p.id == nominator.id), None)
+                converted_nominator = self.town_square.get_participant(nominator.id)
             if not converted_nominator:
                 await utility.deny_command(ctx,
                                            "The Nominator is not included in the town square. Ask an ST to fix this.")
@@ -528,12 +1108,14 @@ class Townsquare(commands.Cog):
             nom = Nomination(converted_nominator, converted_nominee, votes)
 
             content, embed = format_nom_message(game_role, self.town_square, nom, self.emoji)
-            nom_message = await nom_thread.send(content=content, embed=embed, view=NominationView(self.helper, self.town_square, self.emoji))
+            nom_message = await nom_thread.send(content=content, embed=embed, view=NominationView(self))
             nom.message = nom_message.id
+            nom.message_handle = nom_message
+            self.nom_messages.sent(nom_message.id, content, embed)
             self.town_square.current_nomination = nom
             logging.debug(f"Nomination created: in livetext: {nom}")
             await utility.finish_processing(ctx)
-            self.update_storage()
+            self.record(self.store.open_nomination, nom.to_row())
             await self.log(f"{converted_nominator.alias} has nominated {converted_nominee.alias}")
     
     @commands.command(aliases = ["AddAcc"])
@@ -622,7 +1204,7 @@ class Townsquare(commands.Cog):
                 return
         else:
             voter = ctx.author
-        voter = next((p for p in self.town_square.players if p.id == voter.id), None)
+        voter = self.town_square.get_player(voter.id)
 
         if len(vote) > 400:
             await utility.deny_command(ctx, "Your vote is too long. Consider simplifying your condition. If that is "
@@ -650,14 +1232,16 @@ class Townsquare(commands.Cog):
                 return
             
             nom.votes[voter.id] = Vote(vote)
+            nom.tally.mark_changed(voter.id)
             if ctx.author == voter.id:
                 await self.log(f"{voter.alias} has set their vote on the nomination of {nom.nominee.alias} to {vote}")
             else:
                 await self.log(f"{ctx.author} has set {voter.alias}'s vote on the nomination of {nom.nominee.alias} to {vote}")
             
             await self.update_nom_message(nom)
-            self.update_storage()
-            await utility.finish_processing(ctx)
+            self.record(self.store.set_vote, voter.id, nom.votes[voter.id].to_row())
+            # acknowledges the vote, so it is not held up by cosmetic reactions
+            await utility.finish_processing(ctx, outbound.CRITICAL)
         else:
             await utility.deny_command(ctx, "You must be a player or storyteller to vote. "
                                             "If you are, the ST may have to add you to the town square.")
@@ -674,7 +1258,7 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, "No ongoing nominations")
                 return
             nom.finished = True
-            self.update_storage()
+            self.record(self.store.close_nomination)
             await utility.finish_processing(ctx)
             await self.log(f"{ctx.author} has closed the nomination of {nom.nominee.alias}")
         else:
@@ -694,24 +1278,29 @@ class Townsquare(commands.Cog):
         
         if game_role in ctx.author.roles:
             await utility.start_processing(ctx)
-            player = next((p for p in self.town_square.players if p.id == ctx.author.id), None)
+            player = self.town_square.get_player(ctx.author.id)
             if not player:
                 await utility.deny_command(ctx,
                                            "You are not included in the town square. Ask the ST to correct this.")
                 return
             player.alias = alias
-            self.update_storage()
+            self.town_square.mark_changed(player.id)
+            if self.town_square.participant_names is not None:
+                self.town_square.participant_names.alias_changed(player)
+            self.record(self.store.set_alias, player.id, alias)
             await self.log(f"{ctx.author.name} has set their alias to {alias}")
             await utility.finish_processing(ctx)
         elif st_role in ctx.author.roles:
             await utility.start_processing(ctx)
-            st = next((st for st in self.town_square.sts if st.id == ctx.author.id), None)
+            st = self.town_square.get_st(ctx.author.id)
             if not st:
                 await utility.deny_command(ctx, "Something went wrong and you are not included in the townsquare. "
                                                 "Try dropping and re-adding the grimoire")
                 return
             st.alias = alias
-            self.update_storage()
+            if self.town_square.participant_names is not None:
+                self.town_square.participant_names.alias_changed(st)
+            self.record(self.store.set_alias, st.id, alias)
             await self.log(f"{ctx.author.name} has set their alias to {alias}")
             await utility.finish_processing(ctx)
         else:
@@ -765,12 +1354,13 @@ class Townsquare(commands.Cog):
             if not player_user:
                 await utility.deny_command(ctx, f"Could not find player with identifier {player_identifier}")
                 return
-            player = next((p for p in self.town_square.players if p.id == player_user.id), None)
+            player = self.town_square.get_player(player_user.id)
             if not player:
                 await utility.deny_command(ctx, f"{player_user.display_name} is not included in the town square.")
                 return
             player.dead = not player.dead
-            self.update_storage()
+            self.town_square.mark_changed(player.id)
+            self.record(self.store.set_player_status, player.id, player.can_vote, player.dead)
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author, f"{player.alias} is now "
                                               f"{'marked as dead' if player.dead else 'marked as living'}")
@@ -790,12 +1380,13 @@ class Townsquare(commands.Cog):
             if not player_user:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {player_identifier}")
                 return
-            player = next((p for p in self.town_square.players if p.id == player_user.id), None)
+            player = self.town_square.get_player(player_user.id)
             if not player:
                 await utility.deny_command(ctx, f"{player_user.display_name} is not included in the town square.")
                 return
             player.can_vote = not player.can_vote
-            self.update_storage()
+            self.town_square.mark_changed(player.id)
+            self.record(self.store.set_player_status, player.id, player.can_vote, player.dead)
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author, f"{player.alias} can now "
                                               f"{'vote' if player.can_vote else 'not vote'}")
@@ -834,11 +1425,13 @@ class Townsquare(commands.Cog):
                                      " to 'yes' or 'no', or manually set it by adding the vote to the end of " 
                                      "this command e.g. '<LockVote yes'.")
                 return
+            nom.tally.mark_changed(player.id)
             nom.player_index += 1
             if nom.player_index >= len(players):
                 nom.finished = True
             await self.update_nom_message(nom)
-            self.update_storage()
+            self.record(self.store.lock_vote, player.id, nom.votes[player.id].vote, nom.player_index,
+                        nom.finished)
             await self.log(f"The vote of {player.alias} has been locked on the nomination of {nom.nominee.alias}") 
             await utility.finish_processing(ctx)
         else:
@@ -869,9 +1462,10 @@ class Townsquare(commands.Cog):
             
             while nom.player_index < player_no:
                 player = players[nom.player_index]
-                player_member: nextcord.Member = get(self.helper.Guild.members, id = player.id)
-                await nom_thread.send(f"{player_member.mention} is next to vote you have "
-                                      f"{vote_time} seconds until your vote is counted!", delete_after=vote_time)
+                player_member: nextcord.Member = self.helper.get_member(player.id)
+                await outbound.scheduler.run(outbound.CRITICAL, lambda: nom_thread.send(
+                    f"{player_member.mention} is next to vote you have {vote_time} seconds until your vote is "
+                    f"counted!", delete_after=vote_time))
                     
                 await asyncio.sleep(vote_time)
 
@@ -884,12 +1478,14 @@ class Townsquare(commands.Cog):
                     nom.votes[player.id].vote = confirmed_yes_vote
                 else:
                     nom.votes[player.id].vote = confirmed_no_vote
+                nom.tally.mark_changed(player.id)
 
                 nom.player_index += 1
                 await self.update_nom_message(nom)
-                self.update_storage()
+                self.record(self.store.lock_vote, player.id, nom.votes[player.id].vote, nom.player_index,
+                            nom.finished)
             nom.finished = True
-            self.update_storage()
+            self.record(self.store.close_nomination)
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be the Storyteller start counting votes")
@@ -911,28 +1507,35 @@ class Townsquare(commands.Cog):
 
         
 class NominationView(nextcord.ui.View):
-    def __init__(self, helper: utility.Helper, townsquare: TownSquare, emoji: Dict[str, nextcord.PartialEmoji]):
+    def __init__(self, cog: Townsquare):
         super().__init__(timeout=60) # 1hr 
-        self.helper = helper
-        self.townsquare = townsquare
-        self.emoji = emoji
+        self.cog = cog
+        self.helper = cog.helper
+        self.game = cog.helper.Game
+        self.emoji = cog.emoji
 
     async def on_error(self, error: Exception, item: nextcord.ui.Item, interaction: nextcord.Interaction) -> None:
         traceback_buffer = io.StringIO()
         traceback.print_exception(type(error), error, error.__traceback__, file=traceback_buffer)
         traceback_text = traceback_buffer.getvalue()
         logging.exception(f"Ignoring exception in NominationView:\n{traceback_text}")
-        await interaction.response.send_message(content="Issue registering your vote.", 
-                                                ephemeral=True)
+        if interaction.response.is_done():
+            await interaction.followup.send(content="Issue registering your vote.", ephemeral=True)
+        else:
+            await interaction.response.send_message(content="Issue registering your vote.", 
+                                                    ephemeral=True)
 
     @nextcord.ui.button(label="Yes", custom_id="Nom_Vote_Yes", style=nextcord.ButtonStyle.green)
     async def yes_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
-        player = next((p for p in self.townsquare.players if p.id == interaction.user.id), None)
+        await self.helper.Games.activate(self.game)
+        # read on every vote, as the town square is replaced by SetupTownSquare and EndGame and when it is reloaded
+        town_square = self.cog.town_square
+        player = town_square.get_player(interaction.user.id) if town_square else None
         if not player:
             await interaction.response.send_message(content="You are not in the townsquare, ask an ST to fix this",
                                                     ephemeral=True)
             return
-        nom = self.townsquare.current_nomination
+        nom = town_square.current_nomination
         if not nom or nom.finished:
             await interaction.response.send_message(content="This nominition has already been processed.",
                                                     ephemeral=True)
@@ -943,21 +1546,25 @@ class NominationView(nextcord.ui.View):
             return
         
         nom.votes[player.id] = Vote("Yes")
-        await self.update_nomination_view(interaction.message)
+        nom.tally.mark_changed(player.id)
+        self.cog.record(self.cog.store.set_vote, player.id, nom.votes[player.id].to_row())
+        # answered before the edit, which can wait behind other edits, as Discord only waits 3 seconds for the answer
         await interaction.response.send_message(content="Your vote has been registered as 'Yes'",
                                                 ephemeral=True)
-        log_thread = get(self.helper.GameChannel.threads, id=self.townsquare.log_thread)
-        await log_thread.send((format_dt(utcnow()) + ": " + f"{player.alias} has set "
-                               f"their vote on the nomination of {nom.nominee.alias} to 'Yes'")[:2000])
+        await self.update_nomination_view(interaction.message, town_square)
+        await self.cog.log(f"{player.alias} has set their vote on the nomination of {nom.nominee.alias} to 'Yes'")
 
     @nextcord.ui.button(label="No", custom_id="Nom_Vote_No", style=nextcord.ButtonStyle.red)
     async def no_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
-        player = next((p for p in self.townsquare.players if p.id == interaction.user.id), None)
+        await self.helper.Games.activate(self.game)
+        # read on every vote, as the town square is replaced by SetupTownSquare and EndGame and when it is reloaded
+        town_square = self.cog.town_square
+        player = town_square.get_player(interaction.user.id) if town_square else None
         if not player:
             await interaction.response.send_message(content="You are not in the townsquare, ask an ST to fix this",
                                                     ephemeral=True)
             return
-        nom = self.townsquare.current_nomination
+        nom = town_square.current_nomination
         if not nom or nom.finished:
             await interaction.response.send_message(content="This nominition has already been processed.",
                                                     ephemeral=True)
@@ -968,20 +1575,26 @@ class NominationView(nextcord.ui.View):
             return
         
         nom.votes[player.id] = Vote("No")
-        await self.update_nomination_view(interaction.message)
+        nom.tally.mark_changed(player.id)
+        self.cog.record(self.cog.store.set_vote, player.id, nom.votes[player.id].to_row())
+        # answered before the edit, which can wait behind other edits, as Discord only waits 3 seconds for the answer
         await interaction.response.send_message(content="Your vote has been registered as 'No'",
                                                 ephemeral=True)
-        log_thread = get(self.helper.GameChannel.threads, id=self.townsquare.log_thread)
-        await log_thread.send((format_dt(utcnow()) + ": " + f"{player.alias} has set "
-                               f"their vote on the nomination of {nom.nominee.alias} to 'No'")[:2000])
+        await self.update_nomination_view(interaction.message, town_square)
+        await self.cog.log(f"{player.alias} has set their vote on the nomination of {nom.nominee.alias} to 'No'")
 
-    async def update_nomination_view(self, nomination_message: nextcord.Message):
-        content, embed = format_nom_message(self.helper.PlayerRole, self.townsquare, self.townsquare.current_nomination, self.emoji)
-        await nomination_message.edit(content=content, embed=embed)
+    async def update_nomination_view(self, nomination_message: nextcord.Message, town_square: TownSquare):
+        content, embed = format_nom_message(self.helper.PlayerRole, town_square, town_square.current_nomination,
+                                            self.emoji)
+        if self.cog.nom_messages.needs_edit(nomination_message.id, content, embed):
+            await self.cog.nom_messages.edit(nomination_message, content, embed)
 
 
 
 async def setup(bot: commands.Bot):
     cog = Townsquare(bot, utility.Helper(bot))
-    await cog.load_emoji()
+    for config in cog.helper.Games.configs.values():
+        games.current_game.set(config)
+        await cog.load_emoji()
+    games.current_game.set(None)
     bot.add_cog(cog)
@@ -2,6 +2,7 @@ import nextcord
 from nextcord.ext import commands
 
 import utility
+from roles import RoleChange
 
 
 class Users(commands.Cog):
@@ -20,8 +21,8 @@ class Users(commands.Cog):
         player_names = [p.display_name for p in players]
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
-            for player in players:
-                await player.add_roles(self.helper.PlayerRole)
+            await self.helper.change_roles(ctx.author, [RoleChange(player, self.helper.PlayerRole, True)
+                                                        for player in players])
             await utility.dm_user(ctx.author,
                                   "You have assigned the livetext game player role to " + ", ".join(player_names))
             await utility.finish_processing(ctx)
@@ -42,8 +43,8 @@ class Users(commands.Cog):
         player_names = [p.display_name for p in players]
         if self.helper.authorize_st_command(ctx.author):
             await utility.start_processing(ctx)
-            for player in players:
-                await player.remove_roles(self.helper.PlayerRole)
+            await self.helper.change_roles(ctx.author, [RoleChange(player, self.helper.PlayerRole, False)
+                                                        for player in players])
             await utility.dm_user(ctx.author,
                                   "You have removed the livetext game player role from " + ", ".join(player_names))
             await utility.finish_processing(ctx)
@@ -57,18 +58,18 @@ class Users(commands.Cog):
     async def WipePlayers(self, ctx: commands.Context):
         """Removes the game role from everyone, useful for when a game doesn't fire.
         """
+        role = self.helper.PlayerRole
+        players = self.helper.role_members(role)
+        player_names = [p.display_name for p in players]
         if self.helper.authorize_st_command(ctx.author):
-            utility.start_processing(ctx)
-            role = self.helper.PlayerRole
-            players = role.members
-            player_names = [p.display_name for p in players]
-            for player in players:
-                player.remove_roles(role)
+            await utility.start_processing(ctx)
+            await self.helper.change_roles(ctx.author, [RoleChange(player, role, False) for player in players])
             await utility.dm_user(ctx.author,
                                   "You have removed the livetext game player role from " + ", ".join(player_names))
+            await utility.finish_processing(ctx)
         else:
-            utility.deny_command(ctx, "You need to be an ST to run this command")
-        
+            await utility.deny_command(ctx, "You need to be an ST to run this command")
+
         await self.helper.log(f"{ctx.author.mention} has run the WipePlayers command removing the role from "
                               f"{', '.join(player_names)} for livetext")
 
@@ -0,0 +1,47 @@
+"""Compares the dataclasses_json JSON round trip of a town square with the binary codec.
+
+Run from the repository root: python -m benchmarks.codec_benchmark
+"""
+import json
+import timeit
+
+from Cogs.Townsquare import TownSquare, Player, Nomination, Vote
+
+player_count = 20
+repetitions = 2000
+
+
+def build_town_square() -> TownSquare:
+    players = [Player(100000000000000000 + i, f"Player number {i}", can_vote=i % 4 != 0, dead=i % 3 == 0)
+               for i in range(player_count)]
+    sts = [Player(200000000000000000 + i, f"Storyteller {i}") for i in range(2)]
+    votes = {p.id: Vote("yes" if i % 2 else "no, unless the nominee claims Virgin", thief=i == 3, bureaucrat=i == 5)
+             for i, p in enumerate(players)}
+    nom = Nomination(players[2], players[7], votes, accusation="A" * 200, defense="D" * 200, player_index=6,
+                     message=300000000000000000)
+    return TownSquare(players, sts, nom, nomination_thread=400000000000000000, log_thread=500000000000000000)
+
+
+def json_round_trip(town_square: TownSquare) -> TownSquare:
+    return TownSquare.from_dict(json.loads(json.dumps(town_square.to_dict(), indent=2)))
+
+
+def binary_round_trip(town_square: TownSquare) -> TownSquare:
+    return TownSquare.from_bytes(town_square.to_bytes())
+
+
+def main():
+    town_square = build_town_square()
+    assert binary_round_trip(town_square) == json_round_trip(town_square) == town_square
+    json_size = len(json.dumps(town_square.to_dict(), indent=2).encode("utf-8"))
+    binary_size = len(town_square.to_bytes())
+    json_time = timeit.timeit(lambda: json_round_trip(town_square), number=repetitions) / repetitions
+    binary_time = timeit.timeit(lambda: binary_round_trip(town_square), number=repetitions) / repetitions
+    print(f"{player_count} players, full vote dict, {repetitions} round trips each")
+    print(f"dataclasses_json + json: {json_time * 1e6:8.1f} us per round trip, {json_size} bytes")
+    print(f"binary codec:            {binary_time * 1e6:8.1f} us per round trip, {binary_size} bytes")
+    print(f"speedup: {json_time / binary_time:.1f}x, size: {binary_size / json_size:.0%}")
+
+
+if __name__ == "__main__":
+    main()
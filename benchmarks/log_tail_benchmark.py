@@ -0,0 +1,154 @@
+"""Writes a log with tracebacks through IndexedFileHandler and checks that its tail, and tail_records reading the
+file backwards, give the same records as the readlines filter SendLogs used before, timing the three. Then writes
+logs in both formats through a queue to a rotating handler, appending to an existing file, and checks that the tail
+covers the unindexed start of the file and the rotated files, and that exceptions keep their traceback apart.
+
+Run from the repository root: python -m benchmarks.log_tail_benchmark
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import tempfile
+import time
+from typing import List
+
+import logindex
+
+record_count = 200000
+log_format = "%(asctime)s - %(levelname)s: %(message)s"
+levels = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR,
+          "CRITICAL": logging.CRITICAL}
+
+
+def readlines_tail(path: str, min_level: int, limit: int, older_paths: List[str] = ()) -> List[str]:
+    # what read_logs did before, reading and filtering the whole file, here after the older files
+    lines = []
+    for log_path in list(older_paths) + [path]:
+        with open(log_path, "r") as logs:
+            lines += logs.read().rstrip("\n").split("\n")
+    items = []
+    level = logging.NOTSET
+    for line in lines:
+        start = logindex.record_level(line.encode())
+        if start is not None:
+            level = start
+            if level >= min_level:
+                items.append(line)
+        elif level >= min_level and items:
+            items[-1] += "\n" + line
+    return [item.rstrip("\n") for item in items[-limit:]]
+
+
+def write_log(handler: logging.Handler, count: int = record_count, seed: int = 0):
+    logger = logging.getLogger("log_tail_benchmark")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    rng = random.Random(seed)
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.0005:
+            try:
+                raise ValueError(f"failure {i}")
+            except ValueError:
+                logger.exception(f"Command failed {i}")
+        elif roll < 0.002:
+            logger.warning(f"Could not DM user {i}")
+        else:
+            logger.info(f"Command {i} processed\nwith a second line",
+                        extra={"command": "Vote", "author_id": i, "game": 1, "latency_ms": rng.randrange(500)})
+    logger.removeHandler(handler)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "Carat.log")
+        handler = logindex.IndexedFileHandler(path, mode="w")
+        handler.setFormatter(logging.Formatter(log_format))
+        write_log(handler)
+        print(f"{record_count} records, {os.path.getsize(path) / 1e6:.1f} MB")
+        for min_level, limit in [(logging.INFO, 50), (logging.WARNING, 50), (logging.ERROR, 20),
+                                 (logging.ERROR, 1000)]:
+            expected, full_ms = timed(readlines_tail, path, min_level, limit)
+            backwards, backwards_ms = timed(logindex.tail_records, path, min_level, limit)
+            indexed, indexed_ms = timed(handler.tail, min_level, limit)
+            assert backwards == expected, f"tail_records differs for {logging.getLevelName(min_level)} {limit}"
+            assert indexed == expected, f"the index differs for {logging.getLevelName(min_level)} {limit}"
+            print(f"{logging.getLevelName(min_level)} x{limit}: {len(expected)} records, readlines {full_ms:.1f} ms, "
+                  f"backwards {backwards_ms:.1f} ms, indexed {indexed_ms:.2f} ms")
+        handler.close()
+    for json_lines in [False, True]:
+        check_rotation(json_lines)
+
+
+def check_rotation(json_lines: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "Carat.log")
+        formatter = logindex.JsonFormatter() if json_lines else logging.Formatter(logindex.text_format)
+        # a previous run's records, which the new handler appends to without indexing
+        previous = logindex.IndexedFileHandler(path)
+        previous.setFormatter(formatter)
+        write_log(previous, 500, seed=1)
+        previous.close()
+        handler = logindex.IndexedRotatingFileHandler(path, max_bytes=200000, backup_count=3)
+        handler.setFormatter(formatter)
+        write_log(handler, 30, seed=3)
+        for min_level, limit in [(logging.INFO, 20), (logging.INFO, 100), (logging.WARNING, 5)]:
+            assert handler.tail(min_level, limit) == readlines_tail(path, min_level, limit), \
+                f"appended tail differs for {logging.getLevelName(min_level)} {limit}"
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        start = time.perf_counter()
+        write_log(logindex.RecordQueueHandler(log_queue), 20000, seed=2)
+        enqueue_ms = (time.perf_counter() - start) * 1000
+        listener.stop()
+        rotated = handler.rotated_files()
+        assert [os.path.basename(p) for p in rotated] == ["Carat.log.1", "Carat.log.2", "Carat.log.3"], rotated
+        # a short file, so the tail has to reach into the unindexed part and the rotated files
+        handler.doRollover()
+        write_log(handler, 30, seed=4)
+        rotated = handler.rotated_files()
+        for min_level, limit in [(logging.INFO, 20), (logging.INFO, 300), (logging.ERROR, 10), (logging.ERROR, 100)]:
+            expected = readlines_tail(path, min_level, limit, rotated[::-1])
+            indexed = handler.tail(min_level, limit)
+            assert indexed == expected, f"rotated tail differs for {logging.getLevelName(min_level)} {limit}"
+        if json_lines:
+            entry = json.loads(handler.tail(logging.INFO, 1)[0])
+            assert {"time", "level", "message", "command", "author_id", "game", "latency_ms"} <= set(entry), entry
+        # an exception logged through the queue keeps its traceback apart from the message
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        queue_handler = logindex.RecordQueueHandler(log_queue)
+        logger = logging.getLogger("log_tail_benchmark")
+        logger.addHandler(queue_handler)
+        try:
+            raise ValueError("failure in the queue")
+        except ValueError:
+            logger.exception("Command %s failed", "Vote")
+        logger.removeHandler(queue_handler)
+        listener.stop()
+        last_error = handler.tail(logging.ERROR, 1)[0]
+        if json_lines:
+            entry = json.loads(last_error)
+            assert entry["message"] == "Command Vote failed", entry
+            assert "ValueError: failure in the queue" in entry["exception"], entry
+        else:
+            assert last_error.endswith("ValueError: failure in the queue") and "Command Vote failed\nTraceback" in \
+                last_error, last_error
+        handler.close()
+        print(f"{'json' if json_lines else 'text'} rotation: {len(rotated)} rotated files, tails match, "
+              f"20000 records queued in {enqueue_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
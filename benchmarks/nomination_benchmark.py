@@ -0,0 +1,155 @@
+"""Compares rendering a nomination message from scratch on every vote with the cached NominationTally.
+
+Also replays random votes, locks and status changes against both and checks they render identical messages.
+Run from the repository root: python -m benchmarks.nomination_benchmark
+"""
+import random
+import timeit
+from math import ceil
+from typing import Dict
+
+import nextcord
+
+from Cogs.Townsquare import TownSquare, Player, Nomination, Vote, format_nom_message, reordered_players, \
+    confirmed_yes_vote, confirmed_no_vote, not_voted_yet, clock_emoji, voted_yes_emoji, voted_no_emoji
+
+player_counts = [5, 10, 20, 50, 100]
+repetitions = 500
+role = nextcord.Object(1)
+role.mention = "<@&1>"
+emoji = {"shroud": "(shroud)", "organ_grinder": "(organ grinder)"}
+
+
+def render_from_scratch(game_role, town_square: TownSquare, nom: Nomination,
+                        emoji: Dict[str, nextcord.PartialEmoji]) -> tuple[str, nextcord.Embed]:
+    # format_nom_message as it was before the tally was cached
+    if town_square.vote_threshold == 0:
+        votes_needed = ceil(len([player for player in town_square.players if not player.dead]) / 2)
+    else:
+        votes_needed = town_square.vote_threshold
+    players = reordered_players(nom, town_square)
+    current_voter = next((player for player in players if player.can_vote and
+                          nom.votes[player.id].vote not in [confirmed_yes_vote, confirmed_no_vote]), None)
+    content = f"{game_role.mention} {nom.nominator.alias} has nominated {nom.nominee.alias}.\n" \
+              f"Accusation: {nom.accusation}\n" \
+              f"Defense: {nom.defense}\n" \
+              f"{votes_needed} votes required to put {nom.nominee.alias} on the block.\n"
+    embed = nextcord.Embed(title="Votes",
+                           color=0xff0000)
+    counter = 0
+    for player in players:
+        name = player.alias + " (Nominator)" if player == nom.nominator else player.alias
+        if player.dead:
+            name = str(emoji["shroud"]) + " " + name
+        if player == current_voter:
+            name = clock_emoji + " " + name
+        vote = nom.votes[player.id]
+        if (not player.can_vote) and vote != confirmed_yes_vote:
+            embed.add_field(name=f"~~{name}~~", value="", inline=True)
+        else:
+            if town_square.organ_grinder:
+                embed.add_field(name=name,
+                                value=str(emoji["organ_grinder"]),
+                                inline=False)
+            elif vote.vote == confirmed_yes_vote:
+                value = 1
+                if vote.thief:
+                    value *= -1
+                if vote.bureaucrat:
+                    value *= 3
+                if vote.banshee:
+                    value *= 2
+                counter += value
+                embed.add_field(name=name,
+                                value=f"{voted_yes_emoji} ({counter}/{votes_needed})",
+                                inline=False)
+            elif vote.vote == confirmed_no_vote:
+                embed.add_field(name=name,
+                                value=voted_no_emoji,
+                                inline=False)
+            else:
+                embed.add_field(name=name,
+                                value=nom.votes[player.id].vote,
+                                inline=False)
+    return content, embed
+
+
+def build_town_square(player_count: int) -> TownSquare:
+    players = [Player(i, f"Player {i}") for i in range(player_count)]
+    nom = Nomination(players[1], players[player_count // 2], {p.id: Vote(not_voted_yet) for p in players})
+    return TownSquare(players, [Player(10000, "Storyteller")], nom)
+
+
+def check_identical_output(seed: int, steps: int = 300):
+    rng = random.Random(seed)
+    town_square = build_town_square(rng.randint(3, 20))
+    nom = town_square.current_nomination
+    for _ in range(steps):
+        player = rng.choice(town_square.players)
+        action = rng.random()
+        if action < 0.5:
+            nom.votes[player.id] = Vote(rng.choice(["yes", "no", "maybe", confirmed_yes_vote, confirmed_no_vote]),
+                                        bureaucrat=rng.random() < 0.2, thief=rng.random() < 0.2,
+                                        banshee=rng.random() < 0.1)
+            nom.tally.mark_changed(player.id)
+        elif action < 0.65:
+            player.dead = not player.dead
+            town_square.mark_changed(player.id)
+        elif action < 0.8:
+            player.can_vote = not player.can_vote
+            town_square.mark_changed(player.id)
+        elif action < 0.85:
+            player.alias = f"Alias {rng.randint(0, 99)}"
+            town_square.mark_changed(player.id)
+        elif action < 0.9:
+            town_square.vote_threshold = rng.choice([0, 0, 3, 5])
+        elif action < 0.93:
+            town_square.organ_grinder = not town_square.organ_grinder
+        elif action < 0.96:
+            new_id = max(p.id for p in town_square.players) + 1
+            nom.votes[new_id] = nom.votes.pop(player.id)
+            town_square.substitute_player(player, new_id, f"Substitute {new_id}")
+        else:
+            new_player = Player(max(p.id for p in town_square.players) + 1, "Late joiner")
+            town_square.set_players(town_square.players + [new_player])
+            nom.votes[new_player.id] = Vote(not_voted_yet)
+        expected_content, expected_embed = render_from_scratch(role, town_square, nom, emoji)
+        content, embed = format_nom_message(role, town_square, nom, emoji)
+        assert content == expected_content, (content, expected_content)
+        assert embed.to_dict() == expected_embed.to_dict(), (seed, embed.to_dict(), expected_embed.to_dict())
+
+
+def time_per_vote(player_count: int, render) -> float:
+    town_square = build_town_square(player_count)
+    nom = town_square.current_nomination
+    render(role, town_square, nom, emoji)
+    players = reordered_players(nom, town_square)
+
+    def vote():
+        # lock the next vote, starting over once everyone has voted
+        player = players[nom.player_index % player_count]
+        nom.votes[player.id].vote = confirmed_yes_vote if nom.player_index % 3 else confirmed_no_vote
+        nom.tally.mark_changed(player.id)
+        nom.player_index += 1
+        if nom.player_index % player_count == 0:
+            for p in players:
+                nom.votes[p.id].vote = not_voted_yet
+                nom.tally.mark_changed(p.id)
+        render(role, town_square, nom, emoji)
+
+    return timeit.timeit(vote, number=repetitions) / repetitions
+
+
+def main():
+    for seed in range(50):
+        check_identical_output(seed)
+    print("cached and from-scratch renders are identical over 50 random sequences")
+    print(f"{'players':>8} {'from scratch':>14} {'tally':>10}")
+    for player_count in player_counts:
+        scratch_time = time_per_vote(player_count, render_from_scratch)
+        tally_time = time_per_vote(player_count, format_nom_message)
+        print(f"{player_count:>8} {scratch_time * 1e6:11.1f} us {tally_time * 1e6:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Checks that resolving participant names through the ParticipantNames index gives the same results as the
+previous linear lookup cascade on a corpus of names and identifiers, then compares how long both take.
+
+Run from the repository root: python -m benchmarks.participant_lookup_benchmark
+"""
+import random
+import timeit
+import types
+from typing import Callable, List, Optional
+
+from nextcord.utils import get
+
+from Cogs.Townsquare import Townsquare, TownSquare, Player
+
+repetitions = 200
+
+# names chosen to hit every step of the cascade: shared substrings and prefixes, case differences, exact duplicates
+corpus_names = ["Alice", "alice", "Alicia", "ALI", "Bob", "Bobby", "bobby", "Bo", "Charlie", "charles", "Charlotte",
+                "Dave", "David", "dave_", "Eve", "Evelyn", "eve", "Frank", "Franky", "Grace", "Gracie", "Heidi",
+                "Ivan", "Ivana", "Judy", "Ju", "Mallory", "mal", "Ñandú", "ñandu", "Zoë", "zoe", "Ωmega", "ωmega",
+                "Storyteller", "story", "Teller"]
+
+
+def old_matches(player_list: List[Player], identifier: str, attribute: Callable[[Player], str]) -> List[int]:
+    # Townsquare.try_get_matching_player before the index
+    matches = [p.id for p in player_list if identifier.lower() in attribute(p).lower()]
+    if len(matches) > 1:
+        matches = [p.id for p in player_list if attribute(p).lower().startswith(identifier.lower())]
+        if len(matches) < 1:
+            matches = [p.id for p in player_list if identifier in attribute(p)]
+        elif len(matches) > 1:
+            matches = [p.id for p in player_list if attribute(p).startswith(identifier)]
+            if len(matches) < 1:
+                matches = [p.id for p in player_list if attribute(p).lower() == identifier.lower()]
+            elif len(matches) > 1:
+                matches = [p.id for p in player_list if attribute(p) == identifier]
+    return matches
+
+
+def old_get_game_participant(town_square: TownSquare, guild, identifier: str) -> Optional[object]:
+    # Townsquare.get_game_participant before the index, for identifiers that are not mentions
+    participants = town_square.players + town_square.sts
+    alias_matches = old_matches(participants, identifier, lambda p: p.alias)
+    display_names = {p.id: get(guild.members, id=p.id).display_name for p in participants}
+    display_name_matches = old_matches(participants, identifier, lambda p: display_names[p.id])
+    usernames = {p.id: get(guild.members, id=p.id).name for p in participants}
+    username_matches = old_matches(participants, identifier, lambda p: usernames[p.id])
+    if len(alias_matches) == 1:
+        target_id = alias_matches[0]
+    elif len(alias_matches) > 1:
+        if len(set(alias_matches).intersection(set(display_name_matches))) == 1:
+            target_id = list(set(alias_matches).intersection(set(display_name_matches)))[0]
+        elif len(set(alias_matches).intersection(set(username_matches))) == 1:
+            target_id = list(set(alias_matches).intersection(set(username_matches)))[0]
+        elif len(set(display_name_matches).intersection(set(display_name_matches)).intersection(
+                set(username_matches))) == 1:
+            target_id = list(set(display_name_matches).intersection(set(display_name_matches)).intersection(
+                set(username_matches)))[0]
+        else:
+            return None
+    elif len(display_name_matches) == 1:
+        target_id = display_name_matches[0]
+    elif len(display_name_matches) > 1:
+        if len(set(display_name_matches).intersection(set(username_matches))) == 1:
+            target_id = list(set(display_name_matches).intersection(set(username_matches)))[0]
+        else:
+            return None
+    elif len(username_matches) == 1:
+        target_id = username_matches[0]
+    else:
+        return None
+    return get(guild.members, id=target_id)
+
+
+class Guild:
+    def __init__(self, members):
+        self.id = 1
+        self.members = members
+        self._members = {m.id: m for m in members}
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+
+def build_game(rng: random.Random, participant_count: int, member_count: int):
+    members = [types.SimpleNamespace(id=1000 + i, name=rng.choice(corpus_names).lower() + str(rng.randint(0, 3)),
+                                     display_name=rng.choice(corpus_names)) for i in range(member_count)]
+    chosen = rng.sample(members, participant_count)
+    players = [Player(m.id, rng.choice([m.display_name, rng.choice(corpus_names)])) for m in chosen[:-2]]
+    # an ST who is also seated as a player, as happens in test games
+    sts = [Player(m.id, m.display_name) for m in chosen[-2:]] + [Player(players[0].id, players[0].alias)]
+    town_square = TownSquare(players, sts)
+    guild = Guild(members)
+    cog = Townsquare.__new__(Townsquare)
+    cog.helper = types.SimpleNamespace(Guild=guild,
+                                       game_state=lambda: types.SimpleNamespace(town_square=town_square))
+    return town_square, guild, cog
+
+
+def identifiers(rng: random.Random, town_square: TownSquare, guild) -> List[str]:
+    names = [p.alias for p in town_square.players + town_square.sts]
+    names += [m.display_name for m in guild.members] + [m.name for m in guild.members]
+    result = []
+    for name in names:
+        result += [name, name.lower(), name.upper(), name[:2], name[1:4], name[-2:]]
+    result += ["x", "Zz", "", "a", "e", "bo", "BO", "Ali", "ALI", "1", "story"]
+    return [rng.choice(result) for _ in range(200)]
+
+
+def check_same_results(seed: int):
+    rng = random.Random(seed)
+    town_square, guild, cog = build_game(rng, rng.randint(5, 20), 60)
+    for step, identifier in enumerate(identifiers(rng, town_square, guild)):
+        if step % 40 == 39:
+            # aliases and member names change during a game
+            participant = rng.choice(town_square.players + town_square.sts)
+            participant.alias = rng.choice(corpus_names)
+            cog.participant_names().alias_changed(participant)
+            member = guild.get_member(participant.id)
+            member.display_name = rng.choice(corpus_names)
+            cog.participant_names().update_member(member)
+        expected = old_get_game_participant(town_square, guild, identifier)
+        actual = cog.get_game_participant(identifier)
+        assert actual is expected, (seed, identifier, actual, expected)
+
+
+def main():
+    for seed in range(100):
+        check_same_results(seed)
+    print("index and linear cascade resolve all identifiers of 100 random games the same way")
+    rng = random.Random(0)
+    town_square, guild, cog = build_game(rng, 20, 1000)
+    queries = identifiers(rng, town_square, guild)
+    old_time = timeit.timeit(lambda: [old_get_game_participant(town_square, guild, q) for q in queries],
+                             number=repetitions // 10) / (repetitions // 10 * len(queries))
+    new_time = timeit.timeit(lambda: [cog.get_game_participant(q) for q in queries],
+                             number=repetitions) / (repetitions * len(queries))
+    print(f"20 participants, 1000 guild members: linear {old_time * 1e6:.1f} us, index {new_time * 1e6:.1f} us "
+          f"per lookup")
+
+
+if __name__ == "__main__":
+    main()
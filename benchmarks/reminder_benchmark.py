@@ -0,0 +1,145 @@
+"""Runs the ReminderScheduler on a fake clock through a day of random reminders, checking that every reminder is
+dispatched exactly once and exactly when it is due, that removed reminders are never dispatched, and that the 15
+second poll it replaced would have sent them later. Then checks that the catch-up after a restart sends only the
+latest reminder of each countdown still running, and that merged reminders are split over several messages rather
+than cut off.
+
+Run from the repository root: python -m benchmarks.reminder_benchmark
+"""
+import asyncio
+import datetime
+import heapq
+import random
+from typing import Dict, List, Tuple
+
+from Cogs.Reminders import Clock, DueReminder, Reminder, ReminderScheduler, merge_reminders, message_limit, \
+    pack_messages, reconcile_overdue
+
+poll_interval = 15.0
+reminder_count = 2000
+
+
+class FakeClock(Clock):
+    """A clock whose time only moves when advanced, waking the sleepers whose time has come."""
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._count = 0
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        future = asyncio.get_running_loop().create_future()
+        self._count += 1
+        heapq.heappush(self._sleepers, (self.now + seconds, self._count, future))
+        await future
+
+    @staticmethod
+    async def settle():
+        # lets the scheduler run until it sleeps again
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+    async def advance_to(self, until: float):
+        await self.settle()
+        while self._sleepers and self._sleepers[0][0] <= until:
+            wake_time, _, future = heapq.heappop(self._sleepers)
+            self.now = max(self.now, wake_time)
+            if not future.done():
+                future.set_result(None)
+            await self.settle()
+        self.now = until
+
+
+async def check(seed: int):
+    rng = random.Random(seed)
+    clock = FakeClock()
+    dispatched: Dict[int, float] = {}
+    messages = 0
+
+    async def dispatch(due: List[DueReminder]):
+        nonlocal messages
+        for reminder in due:
+            assert reminder.id not in dispatched, f"reminder {reminder.id} dispatched twice"
+            dispatched[reminder.id] = clock.time()
+        messages += len(merge_reminders(due))
+
+    scheduler = ReminderScheduler(dispatch, clock)
+    scheduler.start()
+    reminders = []
+    for reminder_id in range(reminder_count):
+        # bursts at shared times, as SetReminders with several STs or games would give
+        timestamp = rng.choice([rng.uniform(0, 86400), rng.randrange(0, 86400, 600)])
+        reminders.append(DueReminder(reminder_id, rng.randrange(3), timestamp, rng.randrange(5), f"r{reminder_id}"))
+    # added at random times before they are due, some removed again
+    events = sorted([(rng.uniform(0, r.timestamp), "add", r) for r in reminders] +
+                    [(rng.uniform(0, r.timestamp), "remove", r) for r in reminders if rng.random() < 0.1],
+                    key=lambda e: (e[0], e[1] == "remove"))
+    removed = set()
+    for when, kind, reminder in events:
+        await clock.advance_to(when)
+        if kind == "add":
+            scheduler.add(reminder)
+        elif reminder.id in scheduler.reminders:
+            scheduler.remove([reminder.id])
+            removed.add(reminder.id)
+    await clock.advance_to(86400 + 1)
+    scheduler.stop()
+
+    expected = {r.id for r in reminders} - removed
+    assert set(dispatched) == expected, f"seed {seed}: {len(expected ^ set(dispatched))} reminders wrongly handled"
+    by_id = {r.id: r for r in reminders}
+    for reminder_id, sent in dispatched.items():
+        due = by_id[reminder_id].timestamp
+        # the fake clock wakes sleepers exactly on time, up to float rounding
+        assert due <= sent <= due + 1e-6, f"seed {seed}: reminder {reminder_id} sent at {sent}"
+    poll_delay = sum(poll_interval - by_id[i].timestamp % poll_interval for i in dispatched) / len(dispatched)
+    scheduled_delay = sum(dispatched[i] - by_id[i].timestamp for i in dispatched) / len(dispatched)
+    return len(dispatched), messages, scheduler.wakeups, poll_delay, scheduled_delay
+
+
+def check_catch_up():
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    overdue = []
+    # countdowns as SetReminders creates them, in two channels, with Carat offline from minute 5 to minute 20
+    for channel, event, times in [(1, "Whispers close", [3, 6, 9, 12, 15]),
+                                  (1, "Nominations open", [10, 18, 30]),
+                                  (2, "Votes close", [6, 12, 24])]:
+        end = start + datetime.timedelta(minutes=times[-1])
+        for minutes in times:
+            reminder = Reminder.create(start + datetime.timedelta(minutes=minutes), channel, "<@&1>", event, end)
+            due = datetime.datetime.fromisoformat(reminder.time).timestamp()
+            if due <= (start + datetime.timedelta(minutes=20)).timestamp() and minutes > 5:
+                overdue.append(DueReminder(len(overdue), 1, due, channel, reminder.text))
+    to_send, skipped = reconcile_overdue(overdue, (start + datetime.timedelta(minutes=20)).timestamp())
+    sent = {channel: [reminder.timestamp for reminder in reminders] for channel, reminders in to_send}
+    minute = lambda m: (start + datetime.timedelta(minutes=m)).timestamp()
+    assert sent == {1: [minute(18)], 2: [minute(12)]}, sent
+    assert len(skipped) == len(overdue) - 2
+    print(f"catch-up: {len(overdue)} overdue reminders, sent {len(to_send)} messages, skipped {len(skipped)}")
+
+
+def check_packing():
+    rng = random.Random(0)
+    reminders = [DueReminder(i, 1, 0.0, 1, "x" * rng.randrange(1, 400)) for i in range(200)]
+    reminders.append(DueReminder(200, 1, 0.0, 1, "y" * (message_limit + 10)))
+    messages = pack_messages(reminders)
+    assert all(len(message) <= message_limit for message in messages)
+    expected = [r.text[:message_limit] for r in reminders]
+    assert [text for message in messages for text in message.split("\n")] == expected
+    print(f"packing: {len(reminders)} merged reminders in {len(messages)} messages, none lost")
+
+
+def main():
+    for seed in range(5):
+        sent, messages, wakeups, poll_delay, scheduled_delay = asyncio.run(check(seed))
+        print(f"seed {seed}: {sent} reminders in {messages} messages over {wakeups} wakeups, "
+              f"average delay {scheduled_delay:+.3f}s (15s poll: {poll_delay:+.3f}s)")
+    check_catch_up()
+    check_packing()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Measures how long storing votes blocks the event loop, running the database access on the loop (as Carat did
+before the storage thread) and through the Store's storage thread. Commits are slowed down by a few milliseconds
+to stand in for a slow disk, as fsync on the machines running benchmarks is usually much faster than on the bot host.
+
+Run from the repository root: python -m benchmarks.storage_benchmark
+"""
+import asyncio
+import tempfile
+import time
+
+import storage
+import utility
+from Cogs.Townsquare import TownSquare, Player, Nomination, Vote
+
+player_count = 20
+vote_count = 300
+game = 1
+commit_delay = 0.003  # seconds
+
+
+class SlowCommits:
+    """Wraps a connection, delaying every commit done through its context manager."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        time.sleep(commit_delay)
+        return self.connection.__exit__(*exc_info)
+
+
+def build_town_square() -> TownSquare:
+    players = [Player(i, f"Player {i}") for i in range(player_count)]
+    nom = Nomination(players[0], players[1], {p.id: Vote("-") for p in players})
+    return TownSquare(players, [Player(1000, "Storyteller")], nom)
+
+
+async def store_votes(store: storage.Store, on_loop: bool) -> float:
+    """Stores votes as a burst of button presses would, returns the time spent blocking the loop."""
+    blocked = 0.0
+    for i in range(vote_count):
+        args = (game, i % player_count, Vote("yes" if i % 2 else "no").to_row())
+        start = time.perf_counter()
+        if on_loop:
+            storage.Store.set_vote.__wrapped__(store, *args)
+        else:
+            store.set_vote(*args)
+        blocked += time.perf_counter() - start
+        await asyncio.sleep(0)
+    return blocked
+
+
+async def run(on_loop: bool) -> tuple[float, dict]:
+    store = storage.Store(tempfile.mkdtemp() + "/carat.db")
+    store.save_town_square(game, build_town_square().to_row())
+    store.drain()
+    store.connection = SlowCommits(store.connection)
+    monitor = utility.LoopMonitor()
+    monitor.interval = 0.001
+    monitor.start()
+    await asyncio.sleep(0.01)
+    blocked = await store_votes(store, on_loop)
+    await asyncio.get_running_loop().run_in_executor(None, store.drain)
+    monitor.task.cancel()
+    store.connection = store.connection.connection
+    store.close()
+    return blocked, monitor.stats()
+
+
+async def main():
+    for label, on_loop in [("on the event loop", True), ("on the storage thread", False)]:
+        blocked, lag = await run(on_loop)
+        print(f"{vote_count} votes stored {label}: loop blocked {blocked * 1000:7.1f} ms in total, "
+              f"max wake-up delay {lag['max_lag_ms']} ms, {lag['stalls']} stalls")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+"""Compact binary encoding for Carat's stored state.
+
+Implements the subset of the MessagePack format needed for the town square (nil, booleans, integers, strings, bytes,
+arrays and maps), so the output can also be read with any MessagePack library.
+"""
+import struct
+from typing import Any, Tuple
+
+_nil = b"\xc0"
+_false = b"\xc2"
+_true = b"\xc3"
+
+
+def pack(obj: Any) -> bytes:
+    parts = []
+    _pack_into(obj, parts)
+    return b"".join(parts)
+
+
+def _pack_into(obj: Any, parts: list):
+    if obj is None:
+        parts.append(_nil)
+    elif obj is True:
+        parts.append(_true)
+    elif obj is False:
+        parts.append(_false)
+    elif isinstance(obj, int):
+        _pack_int(obj, parts)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            parts.append(bytes((0xa0 | length,)))
+        elif length < 0x100:
+            parts.append(struct.pack(">BB", 0xd9, length))
+        elif length < 0x10000:
+            parts.append(struct.pack(">BH", 0xda, length))
+        else:
+            parts.append(struct.pack(">BI", 0xdb, length))
+        parts.append(data)
+    elif isinstance(obj, (bytes, bytearray)):
+        length = len(obj)
+        if length < 0x100:
+            parts.append(struct.pack(">BB", 0xc4, length))
+        elif length < 0x10000:
+            parts.append(struct.pack(">BH", 0xc5, length))
+        else:
+            parts.append(struct.pack(">BI", 0xc6, length))
+        parts.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        length = len(obj)
+        if length < 16:
+            parts.append(bytes((0x90 | length,)))
+        elif length < 0x10000:
+            parts.append(struct.pack(">BH", 0xdc, length))
+        else:
+            parts.append(struct.pack(">BI", 0xdd, length))
+        for item in obj:
+            _pack_into(item, parts)
+    elif isinstance(obj, dict):
+        length = len(obj)
+        if length < 16:
+            parts.append(bytes((0x80 | length,)))
+        elif length < 0x10000:
+            parts.append(struct.pack(">BH", 0xde, length))
+        else:
+            parts.append(struct.pack(">BI", 0xdf, length))
+        for key, value in obj.items():
+            _pack_into(key, parts)
+            _pack_into(value, parts)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+
+def _pack_int(value: int, parts: list):
+    if 0 <= value < 0x80:
+        parts.append(bytes((value,)))
+    elif -32 <= value < 0:
+        parts.append(struct.pack(">b", value))
+    elif value >= 0:
+        if value < 0x100:
+            parts.append(struct.pack(">BB", 0xcc, value))
+        elif value < 0x10000:
+            parts.append(struct.pack(">BH", 0xcd, value))
+        elif value < 0x100000000:
+            parts.append(struct.pack(">BI", 0xce, value))
+        else:
+            parts.append(struct.pack(">BQ", 0xcf, value))
+    else:
+        if value >= -0x80:
+            parts.append(struct.pack(">Bb", 0xd0, value))
+        elif value >= -0x8000:
+            parts.append(struct.pack(">Bh", 0xd1, value))
+        elif value >= -0x80000000:
+            parts.append(struct.pack(">Bi", 0xd2, value))
+        else:
+            parts.append(struct.pack(">Bq", 0xd3, value))
+
+
+_fixed_formats = {0xcc: ">B", 0xcd: ">H", 0xce: ">I", 0xcf: ">Q",
+                  0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q"}
+_length_formats = {0xc4: ">B", 0xc5: ">H", 0xc6: ">I",
+                   0xd9: ">B", 0xda: ">H", 0xdb: ">I",
+                   0xdc: ">H", 0xdd: ">I",
+                   0xde: ">H", 0xdf: ">I"}
+
+
+def unpack(data: bytes) -> Any:
+    obj, offset = _unpack_from(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError(f"{len(data) - offset} unexpected bytes after encoded value")
+    return obj
+
+
+def _unpack_from(data: memoryview, offset: int) -> Tuple[Any, int]:
+    marker = data[offset]
+    offset += 1
+    if marker < 0x80:
+        return marker, offset
+    if marker >= 0xe0:
+        return marker - 0x100, offset
+    if 0xa0 <= marker <= 0xbf:
+        end = offset + (marker & 0x1f)
+        return str(data[offset:end], "utf-8"), end
+    if 0x90 <= marker <= 0x9f:
+        return _unpack_array(data, offset, marker & 0x0f)
+    if 0x80 <= marker <= 0x8f:
+        return _unpack_map(data, offset, marker & 0x0f)
+    if marker == 0xc0:
+        return None, offset
+    if marker == 0xc2:
+        return False, offset
+    if marker == 0xc3:
+        return True, offset
+    if marker in _fixed_formats:
+        fmt = _fixed_formats[marker]
+        return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+    if marker in _length_formats:
+        fmt = _length_formats[marker]
+        length = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+        if marker <= 0xc6:
+            return bytes(data[offset:offset + length]), offset + length
+        if marker <= 0xdb:
+            return str(data[offset:offset + length], "utf-8"), offset + length
+        if marker <= 0xdd:
+            return _unpack_array(data, offset, length)
+        return _unpack_map(data, offset, length)
+    raise ValueError(f"Unsupported type marker {marker:#x} at offset {offset - 1}")
+
+
+def _unpack_array(data: memoryview, offset: int, length: int) -> Tuple[list, int]:
+    items = []
+    for _ in range(length):
+        item, offset = _unpack_from(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data: memoryview, offset: int, length: int) -> Tuple[dict, int]:
+    items = {}
+    for _ in range(length):
+        key, offset = _unpack_from(data, offset)
+        value, offset = _unpack_from(data, offset)
+        items[key] = value
+    return items, offset
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import nextcord
+
+import outbound
+
+message_limit = 2000
+embed_limit = 10
+embed_length_limit = 6000
+
+
+@dataclass
+class _Entry:
+    content: Optional[str]
+    embed: Optional[nextcord.Embed]
+    # resolved with whether every message holding part of this entry was delivered
+    future: asyncio.Future
+
+
+@dataclass
+class _Batch:
+    user: Union[nextcord.User, nextcord.Member]
+    priority: int
+    entries: List[_Entry] = field(default_factory=list)
+
+
+class DMSender:
+    """Delivers the DMs Carat sends. DM channels are cached per user, messages to the same user within window seconds
+    are sent together in as few messages as possible, and users with DMs disabled are remembered for disabled_ttl
+    seconds, during which messages to them fail without a request.
+    """
+
+    def __init__(self, window: float = 0.25, disabled_ttl: float = 600.0):
+        self.window = window
+        self.disabled_ttl = disabled_ttl
+        self.channels: Dict[int, nextcord.DMChannel] = {}
+        self.disabled: Dict[int, float] = {}
+        self.batches: Dict[int, _Batch] = {}
+        self.dms = 0
+        self.messages_sent = 0
+        self.channels_created = 0
+        self.skipped_disabled = 0
+
+    async def send(self, user: Union[nextcord.User, nextcord.Member], content: Optional[str] = None,
+                   embed: Optional[nextcord.Embed] = None, priority: int = outbound.NORMAL) -> bool:
+        """Sends the content and embed to the user, returning whether that worked."""
+        if self.is_disabled(user.id):
+            self.skipped_disabled += 1
+            return False
+        self.dms += 1
+        batch = self.batches.get(user.id)
+        if batch is None:
+            batch = _Batch(user, priority)
+            self.batches[user.id] = batch
+            asyncio.get_running_loop().call_later(self.window, lambda: asyncio.create_task(self._flush(user.id)))
+        entry = _Entry(content, embed, asyncio.get_running_loop().create_future())
+        batch.entries.append(entry)
+        batch.priority = min(batch.priority, priority)
+        return await asyncio.shield(entry.future)
+
+    def is_disabled(self, user_id: int) -> bool:
+        expiry = self.disabled.get(user_id)
+        if expiry is None:
+            return False
+        if time.monotonic() < expiry:
+            return True
+        del self.disabled[user_id]
+        return False
+
+    async def _flush(self, user_id: int):
+        batch = self.batches.pop(user_id)
+        messages = self._pack([(entry.content, entry.embed) for entry in batch.entries])
+        # indexes of the entries with a part in a message that was not delivered
+        failed: Set[int] = set()
+        sending = 0
+        try:
+            channel = await self._channel(batch.user)
+            for sending, (content, embeds, parts) in enumerate(messages):
+                try:
+                    await outbound.scheduler.run(batch.priority,
+                                                 lambda: channel.send(content=content, embeds=embeds))
+                    self.messages_sent += 1
+                except nextcord.Forbidden:
+                    raise
+                except Exception as e:
+                    logging.exception(f"Could not DM {batch.user}: {e}")
+                    failed.update(parts)
+        except nextcord.Forbidden:
+            logging.warning(f"Could not DM {batch.user} - user has DMs disabled")
+            self.disabled[user_id] = time.monotonic() + self.disabled_ttl
+            failed.update(part for _, _, parts in messages[sending:] for part in parts)
+        except Exception as e:
+            logging.exception(f"Could not DM {batch.user}: {e}")
+            failed.update(range(len(batch.entries)))
+        # each caller learns whether their own message arrived, whatever happened to the others
+        for index, entry in enumerate(batch.entries):
+            entry.future.set_result(index not in failed)
+
+    @staticmethod
+    def _pack(entries: List[Tuple[Optional[str], Optional[nextcord.Embed]]]) \
+            -> List[Tuple[Optional[str], List[nextcord.Embed], Set[int]]]:
+        """Packs the entries into as few messages as possible, each with the indexes of the entries it holds part of."""
+        # text is never put below the embeds of earlier messages, to keep the order they were sent in
+        messages = []
+        content: Optional[str] = None
+        embeds: List[nextcord.Embed] = []
+        parts: Set[int] = set()
+        for index, (text, embed) in enumerate(entries):
+            if text is not None:
+                text = text[:message_limit]
+                if embeds or content is not None and len(content) + 2 + len(text) > message_limit:
+                    messages.append((content, embeds, parts))
+                    content, embeds, parts = None, [], set()
+                content = text if content is None else f"{content}\n\n{text}"
+                parts.add(index)
+            if embed is not None:
+                if len(embeds) == embed_limit or sum(len(e) for e in embeds) + len(embed) > embed_length_limit:
+                    messages.append((content, embeds, parts))
+                    content, embeds, parts = None, [], set()
+                embeds.append(embed)
+                parts.add(index)
+        messages.append((content, embeds, parts))
+        return [(content, embeds, parts) for content, embeds, parts in messages if content is not None or embeds]
+
+    async def _channel(self, user: Union[nextcord.User, nextcord.Member]) -> nextcord.DMChannel:
+        channel = self.channels.get(user.id)
+        if channel is None:
+            channel = user.dm_channel
+            if channel is None:
+                channel = await user.create_dm()
+                self.channels_created += 1
+            self.channels[user.id] = channel
+        return channel
+
+    async def prewarm(self, users: Iterable[Union[nextcord.User, nextcord.Member]], concurrency: int = 4):
+        """Opens the DM channels of the users, so that the first DM to them needs one request less."""
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def open_channel(user: Union[nextcord.User, nextcord.Member]):
+            async with semaphore:
+                try:
+                    await self._channel(user)
+                except nextcord.HTTPException as e:
+                    logging.warning(f"Could not open the DM channel of {user}: {e}")
+
+        await asyncio.gather(*[open_channel(user) for user in users if user.id not in self.channels])
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"dms": self.dms,
+                "messages": self.messages_sent,
+                "channels": len(self.channels),
+                "channels_created": self.channels_created,
+                "disabled_users": len(self.disabled),
+                "skipped_disabled": self.skipped_disabled}
+
+
+sender = DMSender()
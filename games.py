@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+import nextcord
+from nextcord.ext import commands
+from nextcord.utils import get
+
+sweep_interval = 60  # seconds between checks for idle games
+
+
+@dataclass
+class GameConfig:
+    guild: nextcord.Guild
+    channel: nextcord.TextChannel
+    st_role: nextcord.Role
+    player_role: nextcord.Role
+    mod_role: nextcord.Role
+    log_channel: nextcord.TextChannel
+
+
+@dataclass
+class GameState:
+    """Everything Carat keeps in memory about one game. Filled in by the loaders the cogs register."""
+    config: GameConfig
+    town_square: Optional[Any] = None
+    town_square_storage: Optional[Any] = None
+    reminders: list = field(default_factory=list)
+    start_time: Optional[datetime.datetime] = None
+    threads: Optional[Any] = None
+    last_used: float = field(default_factory=time.monotonic)
+
+
+# the game the command or interaction currently being handled belongs to
+current_game: ContextVar[Optional[GameConfig]] = ContextVar("current_game", default=None)
+
+
+class NotAGameChannel(commands.CommandError):
+    """Raised before a command that needs a game runs in a channel no game can be found for."""
+
+
+class GameRegistry:
+    """Holds the configured games, keyed by the id of their game channel, and lazily loads and evicts their state."""
+
+    def __init__(self):
+        self.configs: Dict[int, GameConfig] = {}
+        self.default: Optional[GameConfig] = None
+        self.states: Dict[int, GameState] = {}
+        self.loaders: List[Callable[[GameState], Awaitable[None]]] = []
+        self.unloaders: List[Callable[[GameState], None]] = []
+        self.idle_timeout = 3600.0
+        self.loads = 0
+        self.evictions = 0
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._sweep_handle: Optional[asyncio.TimerHandle] = None
+
+    def load_configs(self, bot: commands.Bot):
+        """Reads the game from the environment variables, and any further games from games.json in the storage
+        location. Does nothing if the games have been read already.
+        """
+        if self.default is not None:
+            return
+        self.idle_timeout = float(os.environ.get('GAME_IDLE_MINUTES', 60)) * 60
+        self.default = self._create_config(bot, {"guild_id": os.environ['GUILD_ID'],
+                                                 "game_channel_id": os.environ['GAME_CHANNEL_ID'],
+                                                 "st_role_id": os.environ['ST_ROLE_ID'],
+                                                 "player_role_id": os.environ['PLAYER_ROLE_ID'],
+                                                 "mod_role_id": os.environ['DOOMSAYER_ROLE_ID'],
+                                                 "log_channel_id": os.environ['LOG_CHANNEL_ID']})
+        self.configs[self.default.channel.id] = self.default
+        games_file = os.path.join(os.environ['STORAGE_LOCATION'], "games.json")
+        if os.path.exists(games_file):
+            with open(games_file, 'r') as f:
+                for entry in json.load(f):
+                    config = self._create_config(bot, entry)
+                    self.configs[config.channel.id] = config
+        logging.info(f"Configured {len(self.configs)} games")
+
+    def _create_config(self, bot: commands.Bot, entry: Dict[str, Union[str, int]]) -> GameConfig:
+        guild = get(bot.guilds, id=int(entry["guild_id"]))
+        if guild is None:
+            logging.error(f"Failed to find guild {entry['guild_id']}. Check the game configuration")
+            raise EnvironmentError
+        # mod role and log channel default to those of the first game if not given
+        mod_role = get(guild.roles, id=int(entry["mod_role_id"])) if "mod_role_id" in entry else self.default.mod_role
+        log_channel = get(guild.channels, id=int(entry["log_channel_id"])) if "log_channel_id" in entry \
+            else self.default.log_channel
+        config = GameConfig(guild,
+                            get(guild.channels, id=int(entry["game_channel_id"])),
+                            get(guild.roles, id=int(entry["st_role_id"])),
+                            get(guild.roles, id=int(entry["player_role_id"])),
+                            mod_role,
+                            log_channel)
+        if None in [config.channel, config.st_role, config.player_role, config.mod_role, config.log_channel]:
+            logging.error("Failed to find required discord entity. Check .env file and games.json are correct and "
+                          "Guild is set up")
+            raise EnvironmentError
+        return config
+
+    def find(self, channel: Optional[nextcord.abc.Messageable],
+             user: Optional[Union[nextcord.User, nextcord.Member]] = None) -> Optional[GameConfig]:
+        """Finds the game a message or interaction in the given channel by the given user belongs to, or None if the
+        channel belongs to no game or could belong to several.
+        """
+        if isinstance(channel, nextcord.Thread):
+            channel = channel.parent
+        guild = getattr(channel, "guild", None)
+        if guild is None:
+            # DMs - use the game the user plays in or runs
+            if user is not None:
+                for config in self.configs.values():
+                    member = config.guild.get_member(user.id)
+                    if member is not None and (config.player_role in member.roles or config.st_role in member.roles):
+                        return config
+            return self.default
+        if channel.id in self.configs:
+            return self.configs[channel.id]
+        guild_games = [config for config in self.configs.values() if config.guild.id == guild.id]
+        category_games = [config for config in guild_games
+                          if channel.category is not None and config.channel.category == channel.category]
+        if len(category_games) == 1:
+            return category_games[0]
+        if len(guild_games) == 1:
+            return guild_games[0]
+        # another game of the guild, or another guild's game, would be a guess
+        return None
+
+    async def select(self, channel: Optional[nextcord.abc.Messageable],
+                     user: Optional[Union[nextcord.User, nextcord.Member]] = None) -> Optional[GameConfig]:
+        """Makes the game belonging to the channel the current game for the running task, loading its state.
+        Returns None, selecting no game, if the channel belongs to none.
+        """
+        config = self.find(channel, user)
+        if config is None:
+            current_game.set(None)
+            return None
+        await self.activate(config)
+        return config
+
+    async def activate(self, config: GameConfig):
+        """Makes the game the current game for the running task, loading its state without blocking the loop."""
+        current_game.set(config)
+        await self.load(config)
+
+    def current(self) -> GameConfig:
+        config = current_game.get()
+        return config if config is not None else self.default
+
+    def register(self, loader: Callable[[GameState], Awaitable[None]],
+                 unloader: Optional[Callable[[GameState], None]] = None):
+        """Registers a cog's functions filling in its part of a game's state when the game is loaded, and saving it
+        before the state is evicted.
+        """
+        self.loaders.append(loader)
+        if unloader is not None:
+            self.unloaders.append(unloader)
+        for state in self.states.values():
+            asyncio.create_task(loader(state))
+
+    async def load(self, config: GameConfig) -> GameState:
+        """Returns the state of the game, loading it from storage if needed. Concurrent loads of a game share one."""
+        state = self.states.get(config.channel.id)
+        if state is None:
+            loading = self._loading.get(config.channel.id)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(config))
+                self._loading[config.channel.id] = loading
+                loading.add_done_callback(lambda _: self._loading.pop(config.channel.id, None))
+            state = await asyncio.shield(loading)
+        state.last_used = time.monotonic()
+        return state
+
+    async def _load(self, config: GameConfig) -> GameState:
+        state = GameState(config)
+        for loader in self.loaders:
+            await loader(state)
+        self.states[config.channel.id] = state
+        self.loads += 1
+        logging.debug(f"Loaded state of the game in {config.channel}")
+        self._schedule_sweep()
+        return state
+
+    def state(self, config: Optional[GameConfig] = None) -> GameState:
+        """Returns the state of the given game (by default the current one), which select or load has loaded."""
+        if config is None:
+            config = self.current()
+        state = self.states.get(config.channel.id)
+        if state is None:
+            raise LookupError(f"The state of the game in {config.channel} was used before it was loaded")
+        state.last_used = time.monotonic()
+        return state
+
+    def _schedule_sweep(self):
+        if self._sweep_handle is not None:
+            return
+        try:
+            self._sweep_handle = asyncio.get_running_loop().call_later(sweep_interval, self.evict_idle)
+        except RuntimeError:
+            pass  # not on the event loop yet, the next load will schedule it
+
+    def evict_idle(self):
+        self._sweep_handle = None
+        now = time.monotonic()
+        for game_id, state in list(self.states.items()):
+            if now - state.last_used >= self.idle_timeout:
+                for unloader in self.unloaders:
+                    unloader(state)
+                del self.states[game_id]
+                self.evictions += 1
+                logging.debug(f"Evicted idle state of the game in {state.config.channel}")
+        if self.states:
+            self._schedule_sweep()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"games": len(self.configs),
+                "loaded": len(self.states),
+                "loads": self.loads,
+                "evictions": self.evictions}
+
+
+registry = GameRegistry()
@@ -0,0 +1,237 @@
+import atexit
+import copy
+import glob
+import heapq
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+from array import array
+from typing import IO, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+block_size = 64 * 1024
+
+# the start of a record in either format Carat logs in, later lines of a text record are traceback continuations
+record_start = re.compile(rb"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} - (DEBUG|INFO|WARNING|ERROR|CRITICAL): ")
+json_record_start = re.compile(rb'^\{"time": "[^"]*", "level": "(DEBUG|INFO|WARNING|ERROR|CRITICAL)"')
+level_names = {b"DEBUG": logging.DEBUG, b"INFO": logging.INFO, b"WARNING": logging.WARNING, b"ERROR": logging.ERROR,
+               b"CRITICAL": logging.CRITICAL}
+
+
+def record_level(line: bytes) -> Optional[int]:
+    """Returns the level of the record the line starts, or None if it continues the record before."""
+    matched = record_start.match(line) or json_record_start.match(line)
+    return level_names[matched.group(1)] if matched is not None else None
+
+
+def _reverse_records(f: BinaryIO, end: int) -> Iterator[Tuple[int, bytes]]:
+    position = end
+    pending = b""  # the start of the earliest line read so far, possibly incomplete
+    continuation: List[bytes] = []  # lines after the earliest record start found so far, in reverse
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        lines = (f.read(read_size) + pending).split(b"\n")
+        # the first line may continue in the block before
+        pending = lines.pop(0)
+        for line in reversed(lines):
+            level = record_level(line)
+            if level is None:
+                continuation.append(line)
+            else:
+                yield level, b"\n".join([line] + continuation[::-1])
+                continuation = []
+    level = record_level(pending)
+    if level is not None:
+        yield level, b"\n".join([pending] + continuation[::-1])
+
+
+def reverse_records(path: str) -> Iterator[Tuple[int, bytes]]:
+    """Yields (level, text) of the records in the log file from the last to the first, reading it backwards in
+    blocks. Lines before the first record are skipped.
+    """
+    with open(path, "rb") as f:
+        yield from _reverse_records(f, f.seek(0, os.SEEK_END))
+
+
+def _tail(records: Iterator[Tuple[int, bytes]], min_level: int, limit: int) -> List[str]:
+    found = []
+    if limit <= 0:
+        return found
+    for level, text in records:
+        if level >= min_level:
+            found.append(text.rstrip(b"\n").decode("utf-8", errors="replace"))
+            if len(found) == limit:
+                break
+    return found[::-1]
+
+
+def tail_records(path: str, min_level: int, limit: int) -> List[str]:
+    """Returns the last limit records of at least the given level in the log file, oldest first."""
+    try:
+        return _tail(reverse_records(path), min_level, limit)
+    except FileNotFoundError:
+        # rotated away meanwhile
+        return []
+
+
+class IndexedHandlerMixin:
+    """Makes a file handler remember where each record it writes starts and which level it has, so that the last
+    records of a level can be read without scanning the file. Records which were in the file when it was opened, and
+    the files rotated away before, are read backwards when the index has too few.
+    """
+    baseFilename: str
+    stream: Optional[IO]
+
+    def reset_index(self):
+        # byte offsets of all records, and the positions in it of the records of each level
+        self.offsets = array("q")
+        self.by_level: Dict[int, array] = {}
+        # records already in the file when it was opened are not indexed
+        self.indexed_from = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if isinstance(self, logging.handlers.BaseRotatingHandler) and self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            offset = self.stream.tell()
+            # not super().emit, which would roll over after the offset was taken
+            logging.FileHandler.emit(self, record)
+            self.by_level.setdefault(record.levelno, array("q")).append(len(self.offsets))
+            self.offsets.append(offset)
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.reset_index()
+
+    def rotated_files(self) -> List[str]:
+        """The files rotated away from this one, the newest first."""
+        files = [path for path in glob.glob(glob.escape(self.baseFilename) + ".*") if os.path.isfile(path)]
+        return sorted(files, key=os.path.getmtime, reverse=True)
+
+    def tail(self, min_level: int, limit: int) -> List[str]:
+        """Returns the last limit records of at least the given level, oldest first."""
+        if limit <= 0:
+            return []
+        self.acquire()
+        try:
+            self.flush()
+            # positions of the last limit records of each wanted level, merged to the last limit overall
+            candidates = [positions[-limit:] for level, positions in self.by_level.items() if level >= min_level]
+            positions = list(heapq.merge(*candidates))[-limit:]
+            # records written after this are not read
+            end_of_file = self.stream.tell() if self.stream is not None else self.indexed_from
+            spans = [(self.offsets[position],
+                      self.offsets[position + 1] if position + 1 < len(self.offsets) else end_of_file)
+                     for position in positions]
+            indexed_from = self.indexed_from
+            older_files = self.rotated_files()
+            # opened while no rollover can happen, so it stays the file the index is of
+            f = open(self.baseFilename, "rb")
+        finally:
+            self.release()
+        with f:
+            records = []
+            for start, end in spans:
+                f.seek(start)
+                records.append(f.read(end - start).rstrip(b"\n").decode("utf-8", errors="replace"))
+            if len(records) < limit:
+                records = _tail(_reverse_records(f, indexed_from), min_level, limit - len(records)) + records
+        for path in older_files:
+            if len(records) >= limit:
+                break
+            records = tail_records(path, min_level, limit - len(records)) + records
+        return records
+
+
+class IndexedFileHandler(IndexedHandlerMixin, logging.FileHandler):
+    def __init__(self, filename: str, mode: str = "a", encoding: Optional[str] = "utf-8"):
+        super().__init__(filename, mode, encoding)
+        self.reset_index()
+
+
+class IndexedRotatingFileHandler(IndexedHandlerMixin, logging.handlers.RotatingFileHandler):
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, encoding: Optional[str] = "utf-8"):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.reset_index()
+
+    def rotated_files(self) -> List[str]:
+        # numbered from the newest, which modification times might not tell apart
+        files = [f"{self.baseFilename}.{number}" for number in range(1, self.backupCount + 1)]
+        return [path for path in files if os.path.isfile(path)]
+
+
+class IndexedTimedRotatingFileHandler(IndexedHandlerMixin, logging.handlers.TimedRotatingFileHandler):
+    def __init__(self, filename: str, when: str, backup_count: int, encoding: Optional[str] = "utf-8"):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding=encoding)
+        self.reset_index()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with the command, author_id, game and latency_ms fields of
+    records logged with them as extra.
+    """
+    fields = ("command", "author_id", "game", "latency_ms")
+
+    def format(self, record: logging.LogRecord) -> str:
+        # time and level first, for record_level
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for name in self.fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+text_format = "%(asctime)s - %(levelname)s: %(message)s"
+_exception_formatter = logging.Formatter()
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue with their arguments merged into the message, but keeps the exception apart as
+    exc_text, for the file handler's formatter to lay it out (as the exception field of JsonFormatter, for one).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback is formatted here, as it refers to frames the logging thread should not keep alive
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_logging(filename: str, json_lines: bool = False, max_bytes: int = 0, backup_count: int = 5,
+                  when: Optional[str] = None, level: int = logging.INFO) -> IndexedHandlerMixin:
+    """Sends the records of the root logger through a queue to a thread writing them to the file, so logging never
+    waits for the disk. The file is rotated every when (as in TimedRotatingFileHandler) if given, otherwise once it
+    reaches max_bytes if that is positive. Returns the file handler, to read the logs back with tail.
+    """
+    if when:
+        handler = IndexedTimedRotatingFileHandler(filename, when, backup_count)
+    elif max_bytes > 0:
+        handler = IndexedRotatingFileHandler(filename, max_bytes, backup_count)
+    else:
+        handler = IndexedFileHandler(filename, mode="w")
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(text_format))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # registered after logging's own, so it runs first and the queue is written out before the handler is closed
+    atexit.register(listener.stop)
+    logging.basicConfig(handlers=[RecordQueueHandler(log_queue)], level=level)
+    return handler
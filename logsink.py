@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Union
+
+import nextcord
+
+import outbound
+
+message_limit = 2000
+
+_sinks: Dict[int, "LogSink"] = {}
+
+
+class LogSink:
+    """Buffers lines logged to a Discord channel or thread and sends them packed into as few messages as possible.
+    Lines are sent in the order they were added, at the latest interval seconds after the first unsent one, or
+    as soon as enough of them are waiting to fill a message.
+    """
+
+    def __init__(self, bot: nextcord.Client, channel_id: int, interval: float):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.interval = interval
+        self.lines: List[str] = []
+        self.buffered_length = 0
+        self.channel: Optional[Union[nextcord.TextChannel, nextcord.Thread]] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+        self.lines_added = 0
+        self.messages_sent = 0
+        self.failed_messages = 0
+
+    def add(self, line: str):
+        line = line[:message_limit]
+        self.lines.append(line)
+        self.buffered_length += len(line) + 1
+        self.lines_added += 1
+        if self.buffered_length > message_limit:
+            self._schedule(0)
+        elif self._handle is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay: float):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = asyncio.get_running_loop().call_later(delay, lambda: asyncio.create_task(self.flush()))
+
+    async def flush(self):
+        """Sends all buffered lines."""
+        async with self._lock:
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            while self.lines:
+                message = self._take_message()
+                try:
+                    channel = await self._get_channel()
+                    await outbound.scheduler.run(outbound.COSMETIC, lambda: channel.send(message))
+                    self.messages_sent += 1
+                except nextcord.HTTPException:
+                    self.failed_messages += 1
+                    self.channel = None
+                    logging.exception(f"Failed to send log message to channel {self.channel_id}: {message}")
+
+    def _take_message(self) -> str:
+        # packs as many of the oldest lines as fit into one message
+        length = len(self.lines[0])
+        count = 1
+        while count < len(self.lines) and length + 1 + len(self.lines[count]) <= message_limit:
+            length += 1 + len(self.lines[count])
+            count += 1
+        message = "\n".join(self.lines[:count])
+        del self.lines[:count]
+        self.buffered_length -= length + 1
+        return message
+
+    async def _get_channel(self) -> Union[nextcord.TextChannel, nextcord.Thread]:
+        if self.channel is None:
+            self.channel = self.bot.get_channel(self.channel_id) or await self.bot.fetch_channel(self.channel_id)
+        if isinstance(self.channel, nextcord.Thread) and self.channel.archived:
+            self.channel = await self.channel.edit(archived=False)
+        return self.channel
+
+
+def get_sink(bot: nextcord.Client, channel_id: int, interval: float) -> LogSink:
+    sink = _sinks.get(channel_id)
+    if sink is None:
+        sink = LogSink(bot, channel_id, interval)
+        _sinks[channel_id] = sink
+    return sink
+
+
+async def flush_all():
+    for sink in list(_sinks.values()):
+        await sink.flush()
+
+
+def stats() -> Dict[str, Union[int, float]]:
+    return {"sinks": len(_sinks),
+            "lines": sum(sink.lines_added for sink in _sinks.values()),
+            "messages": sum(sink.messages_sent for sink in _sinks.values()),
+            "failed_messages": sum(sink.failed_messages for sink in _sinks.values()),
+            "buffered_lines": sum(len(sink.lines) for sink in _sinks.values())}
+
@@ -0,0 +1,216 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, TypeVar, Union
+
+import nextcord
+from nextcord.ext import commands
+
+T = TypeVar("T")
+
+# priority classes, lower runs first
+CRITICAL = 0  # nomination messages while votes are counted, vote acknowledgements
+NORMAL = 1
+COSMETIC = 2  # processing reactions, log messages, help DMs
+names = {CRITICAL: "critical", NORMAL: "normal", COSMETIC: "cosmetic"}
+
+pressure_window = 10.0  # seconds after a rate limit during which droppable requests are dropped
+rate_limited_warning = "We are being rate limited."  # logged by nextcord.http for every 429 it retries
+
+
+class Request:
+    __slots__ = ("priority", "seq", "factory", "future", "droppable", "key", "queued_at", "dropped", "started")
+
+    def __init__(self, priority: int, seq: int, factory: Callable[[], Awaitable], future: asyncio.Future,
+                 droppable: bool, key: Optional[Hashable]):
+        self.priority = priority
+        self.seq = seq
+        self.factory = factory
+        self.future = future
+        self.droppable = droppable
+        self.key = key
+        self.queued_at = time.monotonic()
+        self.dropped = False
+        self.started = False
+
+    def __lt__(self, other: "Request") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    """Runs requests to Discord in priority order, with at most concurrency of them in flight.
+    Requests of the same priority run in the order they were made, and requests with the same key never run at the
+    same time, so e.g. the reactions on one message are not reordered. Cosmetic requests leave one slot free for the
+    others. Droppable requests are given up on, resolving to None, when more than cosmetic_limit of them wait, when
+    they waited longer than max_delay seconds, or while Discord rate limited Carat recently.
+    """
+
+    def __init__(self, concurrency: int = 4, cosmetic_limit: int = 20, max_delay: float = 30.0):
+        self.concurrency = concurrency
+        self.cosmetic_limit = cosmetic_limit
+        self.max_delay = max_delay
+        self._queue: List[Request] = []
+        self._seq = itertools.count()
+        self._running_keys: Set[Hashable] = set()
+        self.in_flight = 0
+        self.cosmetic_in_flight = 0
+        self.queued: Dict[int, int] = {priority: 0 for priority in names}
+        self.completed: Dict[int, int] = {priority: 0 for priority in names}
+        self.droppable_queued = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.rate_limits = 0
+        self.buckets_exhausted = 0
+        self.global_rate_limits = 0
+        self.last_rate_limit = float("-inf")
+        self.listening = False
+
+    def configure(self, concurrency: int, cosmetic_limit: int, max_delay: float):
+        self.concurrency = max(1, concurrency)
+        self.cosmetic_limit = cosmetic_limit
+        self.max_delay = max_delay
+
+    def listen(self, bot: commands.Bot):
+        if not self.listening:
+            bot.add_listener(self.on_http_ratelimit, "on_http_ratelimit")
+            bot.add_listener(self.on_global_http_ratelimit, "on_global_http_ratelimit")
+            logging.getLogger("nextcord.http").addFilter(self.on_http_warning)
+            self.listening = True
+
+    async def run(self, priority: int, factory: Callable[[], Awaitable[T]], droppable: bool = False,
+                  key: Optional[Hashable] = None) -> Optional[T]:
+        """Runs the coroutine made by factory once its turn comes, returning its result, or None if it was dropped."""
+        return await self._enqueue(priority, factory, droppable, key).future
+
+    def submit(self, priority: int, factory: Callable[[], Awaitable], droppable: bool = False,
+               key: Optional[Hashable] = None) -> Request:
+        """Queues the coroutine made by factory without waiting for it. Failures are logged. Returns the request, which
+        can be cancelled while it waits.
+        """
+        request = self._enqueue(priority, factory, droppable, key)
+        request.future.add_done_callback(self._log_failure)
+        return request
+
+    def cancel(self, request: Request) -> bool:
+        """Gives up on a request that has not started yet, resolving it to None. Returns whether it was cancelled."""
+        if request.started or request.dropped:
+            return False
+        self._drop(request)
+        self.dropped -= 1
+        self.cancelled += 1
+        return True
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f"Outbound request failed: {future.exception()}")
+
+    def _enqueue(self, priority: int, factory: Callable[[], Awaitable], droppable: bool,
+                 key: Optional[Hashable]) -> Request:
+        future = asyncio.get_running_loop().create_future()
+        request = Request(priority, next(self._seq), factory, future, droppable, key)
+        heapq.heappush(self._queue, request)
+        self.queued[priority] += 1
+        if droppable:
+            self.droppable_queued += 1
+            if self.droppable_queued > self.cosmetic_limit:
+                self._drop(min(r for r in self._queue if r.droppable and not r.dropped))
+        self._dispatch()
+        return request
+
+    def _drop(self, request: Request):
+        request.dropped = True
+        self.queued[request.priority] -= 1
+        if request.droppable:
+            self.droppable_queued -= 1
+        self.dropped += 1
+        if not request.future.done():
+            request.future.set_result(None)
+
+    @property
+    def under_pressure(self) -> bool:
+        return time.monotonic() - self.last_rate_limit < pressure_window
+
+    def _dispatch(self):
+        held = []
+        while self.in_flight < self.concurrency and self._queue:
+            request = heapq.heappop(self._queue)
+            if request.dropped:
+                continue
+            if request.key is not None and request.key in self._running_keys or \
+                    request.priority == COSMETIC and self.cosmetic_in_flight >= max(1, self.concurrency - 1):
+                held.append(request)
+                continue
+            if request.droppable and (self.under_pressure or
+                                      time.monotonic() - request.queued_at > self.max_delay):
+                self._drop(request)
+                continue
+            self.queued[request.priority] -= 1
+            if request.droppable:
+                self.droppable_queued -= 1
+            if request.priority == COSMETIC and time.monotonic() - request.queued_at > 0.001:
+                self.deferred += 1
+            request.started = True
+            self.in_flight += 1
+            if request.priority == COSMETIC:
+                self.cosmetic_in_flight += 1
+            if request.key is not None:
+                self._running_keys.add(request.key)
+            asyncio.create_task(self._execute(request))
+        for request in held:
+            heapq.heappush(self._queue, request)
+
+    async def _execute(self, request: Request):
+        try:
+            result = await request.factory()
+            if not request.future.done():
+                request.future.set_result(result)
+        except Exception as e:
+            if isinstance(e, nextcord.HTTPException) and e.status == 429:
+                # a 429 nextcord does not retry, e.g. a Cloudflare ban
+                self.last_rate_limit = time.monotonic()
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            if request.priority == COSMETIC:
+                self.cosmetic_in_flight -= 1
+            self.completed[request.priority] += 1
+            if request.key is not None:
+                self._running_keys.discard(request.key)
+            self._dispatch()
+
+    async def on_http_ratelimit(self, limit: int, remaining: int, retry_after: float, bucket: str,
+                                scope: Optional[str]):
+        # dispatched whenever a bucket is used up, which for reactions is every request, and on a 429 alike
+        self.buckets_exhausted += 1
+
+    def on_http_warning(self, record: logging.LogRecord) -> bool:
+        # a filter on nextcord's HTTP logger, which only logs this warning when Discord answered with a 429
+        if isinstance(record.msg, str) and record.msg.startswith(rate_limited_warning):
+            self.rate_limits += 1
+            self.last_rate_limit = time.monotonic()
+        return True
+
+    async def on_global_http_ratelimit(self, retry_after: float):
+        self.global_rate_limits += 1
+        self.last_rate_limit = time.monotonic()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        stats = {"in_flight": self.in_flight}
+        for priority, name in names.items():
+            stats[f"queued_{name}"] = self.queued[priority]
+            stats[f"completed_{name}"] = self.completed[priority]
+        stats.update({"deferred": self.deferred,
+                      "dropped": self.dropped,
+                      "cancelled": self.cancelled,
+                      "rate_limits": self.rate_limits,
+                      "buckets_exhausted": self.buckets_exhausted,
+                      "global_rate_limits": self.global_rate_limits})
+        return stats
+
+
+scheduler = OutboundScheduler()
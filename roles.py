@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Union
+
+import nextcord
+
+retry_attempts = 3  # attempts per change when Discord answers with a rate limit or server error
+
+
+@dataclass
+class RoleChange:
+    member: nextcord.Member
+    role: nextcord.Role
+    add: bool
+    reason: Optional[str] = None
+
+    def describe(self) -> str:
+        return f"{'give' if self.add else 'remove'} {self.role.name} {'to' if self.add else 'from'} " \
+               f"{self.member.display_name}"
+
+
+@dataclass
+class RoleChangeFailure:
+    change: RoleChange
+    error: Exception
+
+
+class RoleChanger:
+    """Applies many role changes at once, with at most concurrency of them in flight.
+    The role routes of a guild share one rate limit bucket, which nextcord waits on, so firing every change at once
+    only queues them up inside nextcord - bounding them here keeps a large change from starving other requests.
+    Changes which already hold are skipped, and failures are collected instead of stopping the other changes.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.changes = 0
+        self.skipped = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def apply(self, changes: Iterable[RoleChange]) -> List[RoleChangeFailure]:
+        """Applies the changes, returning those which failed."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[self._apply_one(change) for change in changes])
+        return [failure for failure in results if failure is not None]
+
+    async def _apply_one(self, change: RoleChange) -> Optional[RoleChangeFailure]:
+        if (change.member.get_role(change.role.id) is not None) == change.add:
+            self.skipped += 1
+            return None
+        async with self._semaphore:
+            for attempt in range(retry_attempts):
+                try:
+                    if change.add:
+                        await change.member.add_roles(change.role, reason=change.reason)
+                    else:
+                        await change.member.remove_roles(change.role, reason=change.reason)
+                    self.changes += 1
+                    return None
+                except nextcord.HTTPException as e:
+                    # nextcord already retries rate limits itself, this covers those it gives up on
+                    if (e.status == 429 or e.status >= 500) and attempt + 1 < retry_attempts:
+                        self.retries += 1
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+                    self.failures += 1
+                    logging.warning(f"Failed to {change.describe()}: {e}")
+                    return RoleChangeFailure(change, e)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"concurrency": self.concurrency,
+                "changes": self.changes,
+                "skipped": self.skipped,
+                "retries": self.retries,
+                "failures": self.failures}
+
+
+def summarize(failures: List[RoleChangeFailure]) -> str:
+    return f"{len(failures)} role change{'s' if len(failures) != 1 else ''} failed:\n" + \
+        "\n".join(f"Could not {failure.change.describe()}: {failure.error}" for failure in failures)
+
+
+_changer: Optional[RoleChanger] = None
+
+
+def get_changer(concurrency: int) -> RoleChanger:
+    global _changer
+    if _changer is None:
+        _changer = RoleChanger(concurrency)
+    return _changer
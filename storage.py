@@ -0,0 +1,467 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
+
+import utility
+
+_write_behind_stores: List["WriteBehind"] = []
+
+
+def atomic_write(path: str, data: Union[str, bytes]):
+    """Writes data to a temporary file next to path and renames it over path.
+    Readers (and a restarted Carat) only ever see the complete old or the complete new content.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class WriteBehind:
+    """Coalesces storage writes. Mutations call mark_dirty, and the actual write happens at most once per interval
+    (in seconds). flush writes immediately if there are unwritten changes.
+    """
+
+    def __init__(self, name: str, write: Callable[[], None], interval: float):
+        self.name = name
+        self.interval = interval
+        self._write = write
+        self._dirty = False
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self.marks = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+        _write_behind_stores.append(self)
+        utility.register_metrics(f"storage.{name}", self.stats)
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def mark_dirty(self):
+        self.marks += 1
+        self._dirty = True
+        if self._handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not running on the event loop (e.g. during startup or shutdown) - nothing will flush later
+            self.flush()
+            return
+        self._handle = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        start = time.perf_counter()
+        try:
+            self._write()
+        except Exception as e:
+            self._dirty = True
+            self.failed_writes += 1
+            logging.exception(f"Failed to write {self.name} storage: {e}")
+            try:
+                self._handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+            except RuntimeError:
+                pass
+            return
+        elapsed = time.perf_counter() - start
+        self.writes += 1
+        self.last_flush_time = elapsed
+        self.total_flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+
+    def close(self):
+        """Writes pending changes and stops tracking this store."""
+        self.flush()
+        _write_behind_stores.remove(self)
+        utility.unregister_metrics(f"storage.{self.name}")
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"changes": self.marks,
+                "writes": self.writes,
+                "writes_avoided": self.marks - self.writes,
+                "failed_writes": self.failed_writes,
+                "last_flush_ms": round(self.last_flush_time * 1000, 2),
+                "max_flush_ms": round(self.max_flush_time * 1000, 2),
+                "avg_flush_ms": round(self.total_flush_time * 1000 / self.writes, 2) if self.writes else 0}
+
+
+def read_journal(path: str) -> tuple[Optional[int], List[dict]]:
+    """Reads a town square journal written by earlier versions of Carat. The first line holds the generation of the
+    snapshot the records apply to. An incomplete or unreadable record (e.g. from a crash mid-write) ends the journal.
+    """
+    generation = None
+    records = []
+    if not os.path.exists(path):
+        return generation, records
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                item = json.loads(line)
+            except ValueError:
+                break
+            if generation is None:
+                generation = item.get("generation")
+            else:
+                records.append(item)
+    return generation, records
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS town_squares (
+    game INTEGER PRIMARY KEY,
+    nomination_thread INTEGER,
+    log_thread INTEGER,
+    organ_grinder INTEGER NOT NULL,
+    player_noms_allowed INTEGER NOT NULL,
+    vote_threshold INTEGER NOT NULL,
+    vote_time INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS participants (
+    game INTEGER NOT NULL,
+    st INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    seat INTEGER NOT NULL,
+    alias TEXT NOT NULL,
+    can_vote INTEGER NOT NULL,
+    dead INTEGER NOT NULL,
+    banshee INTEGER NOT NULL,
+    PRIMARY KEY (game, st, id)
+);
+CREATE TABLE IF NOT EXISTS nominations (
+    game INTEGER PRIMARY KEY,
+    nominator_id INTEGER NOT NULL,
+    nominator_alias TEXT NOT NULL,
+    nominee_id INTEGER NOT NULL,
+    nominee_alias TEXT NOT NULL,
+    accusation TEXT NOT NULL,
+    defense TEXT NOT NULL,
+    player_index INTEGER NOT NULL,
+    message INTEGER,
+    finished INTEGER NOT NULL,
+    pause_votes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS votes (
+    game INTEGER NOT NULL,
+    player INTEGER NOT NULL,
+    vote TEXT NOT NULL,
+    bureaucrat INTEGER NOT NULL,
+    thief INTEGER NOT NULL,
+    banshee INTEGER NOT NULL,
+    PRIMARY KEY (game, player)
+);
+CREATE TABLE IF NOT EXISTS reminders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    game INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reminders_by_time ON reminders (time);
+CREATE INDEX IF NOT EXISTS reminders_by_game ON reminders (game, time);
+CREATE TABLE IF NOT EXISTS start_times (
+    game INTEGER PRIMARY KEY,
+    time TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    game INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    player INTEGER,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS threads_by_game ON threads (game, kind);
+"""
+
+_stores: Dict[str, "Store"] = {}
+
+
+def get_store(location: str) -> "Store":
+    """Returns the store in the given storage location, shared by all cogs."""
+    path = os.path.join(location, "carat.db")
+    if path not in _stores:
+        _stores[path] = Store(path)
+    return _stores[path]
+
+
+def _queued(method):
+    """Store methods changing the database run on the storage thread. The caller does not wait for them."""
+    @functools.wraps(method)
+    def queue(self: "Store", *args):
+        self._queue(method, *args)
+    return queue
+
+
+def _awaitable(method):
+    """Store methods run on the storage thread after all queued changes, awaited without blocking the event loop."""
+    @functools.wraps(method)
+    async def run(self: "Store", *args):
+        return await asyncio.wrap_future(self._submit(method, *args))
+    return run
+
+
+class Store:
+    """SQLite database holding the state of all games, keyed by the id of the game channel.
+    Town squares are read and written as rows in the shape produced by TownSquare.to_row, and single changes
+    (a vote, an alias, ...) are stored as single row updates.
+    All database access happens in order on a single storage thread, so a slow disk does not stall the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.connection = self._executor.submit(self._connect).result()
+        self.queued_changes = 0
+        self.failed_changes = 0
+        self.pending = 0  # submitted to the storage thread and not finished yet
+        self._pending_lock = threading.Lock()
+        utility.register_metrics(f"database.{os.path.basename(path)}", self.stats)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.executescript(_schema)
+        return connection
+
+    def _submit(self, method: Callable, *args) -> Future:
+        with self._pending_lock:
+            self.pending += 1
+        future = self._executor.submit(method, self, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future: Future):
+        # usually runs on the storage thread, while the event loop may be submitting
+        with self._pending_lock:
+            self.pending -= 1
+
+    def _queue(self, method: Callable[..., None], *args):
+        self.queued_changes += 1
+        self._submit(method, *args).add_done_callback(self._check_change)
+
+    def _check_change(self, future: Future):
+        if future.exception() is not None:
+            self.failed_changes += 1
+            logging.error("Failed to store change", exc_info=future.exception())
+
+    def drain(self):
+        """Waits until all queued changes are written."""
+        self._executor.submit(lambda: None).result()
+
+    def close(self):
+        self._executor.submit(self.connection.close).result()
+        self._executor.shutdown()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"queued_changes": self.queued_changes,
+                "failed_changes": self.failed_changes,
+                "pending_changes": self.pending}
+
+    # town squares
+
+    @_awaitable
+    def load_town_square(self, game: int) -> Optional[list]:
+        settings = self.connection.execute(
+            "SELECT nomination_thread, log_thread, organ_grinder, player_noms_allowed, vote_threshold, vote_time "
+            "FROM town_squares WHERE game = ?", (game,)).fetchone()
+        if settings is None:
+            return None
+        participants = self.connection.execute(
+            "SELECT st, id, alias, can_vote, dead, banshee FROM participants WHERE game = ? ORDER BY st, seat",
+            (game,)).fetchall()
+        players = [[p[1], p[2], bool(p[3]), bool(p[4]), bool(p[5])] for p in participants if not p[0]]
+        sts = [[p[1], p[2], bool(p[3]), bool(p[4]), bool(p[5])] for p in participants if p[0]]
+        nomination = self.connection.execute(
+            "SELECT nominator_id, nominator_alias, nominee_id, nominee_alias, accusation, defense, player_index, "
+            "message, finished, pause_votes FROM nominations WHERE game = ?", (game,)).fetchone()
+        if nomination is not None:
+            votes = {v[0]: [v[1], bool(v[2]), bool(v[3]), bool(v[4])] for v in self.connection.execute(
+                "SELECT player, vote, bureaucrat, thief, banshee FROM votes WHERE game = ?", (game,))}
+            nomination = [[nomination[0], nomination[1], True, False, False],
+                          [nomination[2], nomination[3], True, False, False],
+                          votes, nomination[4], nomination[5], nomination[6], nomination[7],
+                          bool(nomination[8]), bool(nomination[9])]
+        return [players, sts, nomination, settings[0], settings[1], bool(settings[2]), bool(settings[3]),
+                settings[4], settings[5]]
+
+    @_queued
+    def save_town_square(self, game: int, town_square: Optional[list]):
+        """Replaces everything stored about the game's town square in a single transaction."""
+        with self.connection:
+            self._delete_town_square(game)
+            if town_square is None:
+                return
+            players, sts, nomination = town_square[:3]
+            self.connection.execute("INSERT INTO town_squares VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (game, *town_square[3:]))
+            self.connection.executemany("INSERT INTO participants VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [(game, 0, p[0], seat, *p[1:]) for seat, p in enumerate(players)] +
+                                        [(game, 1, st[0], seat, *st[1:]) for seat, st in enumerate(sts)])
+            if nomination is not None:
+                self._insert_nomination(game, nomination)
+
+    def _delete_town_square(self, game: int):
+        for table in ["town_squares", "participants", "nominations", "votes"]:
+            self.connection.execute(f"DELETE FROM {table} WHERE game = ?", (game,))
+
+    def _insert_nomination(self, game: int, nomination: list):
+        nominator, nominee, votes = nomination[:3]
+        self.connection.execute("INSERT INTO nominations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (game, nominator[0], nominator[1], nominee[0], nominee[1], *nomination[3:]))
+        self.connection.executemany("INSERT INTO votes VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(game, player, *vote) for player, vote in votes.items()])
+
+    @_queued
+    def open_nomination(self, game: int, nomination: list):
+        with self.connection:
+            self.connection.execute("DELETE FROM nominations WHERE game = ?", (game,))
+            self.connection.execute("DELETE FROM votes WHERE game = ?", (game,))
+            self._insert_nomination(game, nomination)
+
+    @_queued
+    def close_nomination(self, game: int):
+        with self.connection:
+            self.connection.execute("UPDATE nominations SET finished = 1 WHERE game = ?", (game,))
+
+    @_queued
+    def set_vote(self, game: int, player: int, vote: list):
+        with self.connection:
+            self.connection.execute("UPDATE votes SET vote = ?, bureaucrat = ?, thief = ?, banshee = ? "
+                                    "WHERE game = ? AND player = ?", (*vote, game, player))
+
+    @_queued
+    def lock_vote(self, game: int, player: int, vote: str, player_index: int, finished: bool):
+        with self.connection:
+            self.connection.execute("UPDATE votes SET vote = ? WHERE game = ? AND player = ?", (vote, game, player))
+            self.connection.execute("UPDATE nominations SET player_index = ?, finished = ? WHERE game = ?",
+                                    (player_index, finished, game))
+
+    @_queued
+    def set_player_status(self, game: int, player: int, can_vote: bool, dead: bool):
+        with self.connection:
+            self.connection.execute("UPDATE participants SET can_vote = ?, dead = ? WHERE game = ? AND st = 0 "
+                                    "AND id = ?", (can_vote, dead, game, player))
+
+    @_queued
+    def set_alias(self, game: int, participant: int, alias: str):
+        with self.connection:
+            self.connection.execute("UPDATE participants SET alias = ? WHERE game = ? AND id = ?",
+                                    (alias, game, participant))
+            self.connection.execute("UPDATE nominations SET nominator_alias = ? WHERE game = ? AND nominator_id = ?",
+                                    (alias, game, participant))
+            self.connection.execute("UPDATE nominations SET nominee_alias = ? WHERE game = ? AND nominee_id = ?",
+                                    (alias, game, participant))
+
+    # reminders
+
+    @_awaitable
+    def load_reminders(self, game: int) -> List[tuple]:
+        """Returns (id, time, channel, text) of the game's reminders, earliest first."""
+        return self.connection.execute("SELECT id, time, channel, text FROM reminders WHERE game = ? ORDER BY time",
+                                       (game,)).fetchall()
+
+    @_awaitable
+    def add_reminders(self, game: int, reminders: List[tuple]) -> List[int]:
+        """Stores (time, channel, text) reminders and returns their ids."""
+        return self._insert_reminders(game, reminders)
+
+    @_queued
+    def import_reminders(self, game: int, reminders: List[tuple]):
+        """Stores (time, channel, text) reminders without waiting for their ids."""
+        self._insert_reminders(game, reminders)
+
+    def _insert_reminders(self, game: int, reminders: List[tuple]) -> List[int]:
+        with self.connection:
+            return [self.connection.execute("INSERT INTO reminders (game, time, channel, text) VALUES (?, ?, ?, ?)",
+                                            (game, *reminder)).lastrowid for reminder in reminders]
+
+    @_awaitable
+    def pending_reminders(self) -> List[tuple]:
+        """Returns (id, game, time, channel, text) of the reminders of all games."""
+        return self.connection.execute("SELECT id, game, time, channel, text FROM reminders ORDER BY time").fetchall()
+
+    @_queued
+    def delete_reminders_by_id(self, reminder_ids: List[int]):
+        with self.connection:
+            self.connection.executemany("DELETE FROM reminders WHERE id = ?", [(i,) for i in reminder_ids])
+
+    @_queued
+    def delete_reminders(self, game: int):
+        with self.connection:
+            self.connection.execute("DELETE FROM reminders WHERE game = ?", (game,))
+
+    # start times
+
+    @_awaitable
+    def load_start_time(self, game: int) -> Optional[str]:
+        row = self.connection.execute("SELECT time FROM start_times WHERE game = ?", (game,)).fetchone()
+        return row[0] if row else None
+
+    @_queued
+    def save_start_time(self, game: int, time: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO start_times VALUES (?, ?)", (game, time))
+
+    # threads
+
+    @_awaitable
+    def load_threads(self, game: int) -> List[tuple]:
+        """Returns (id, kind, player, created) of the threads registered for the game."""
+        return self.connection.execute("SELECT id, kind, player, created FROM threads WHERE game = ?",
+                                       (game,)).fetchall()
+
+    @_queued
+    def register_thread(self, game: int, thread: int, kind: str, player: Optional[int], created: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?, ?)",
+                                    (thread, game, kind, player, created))
+
+    @_queued
+    def forget_thread(self, thread: int):
+        with self.connection:
+            self.connection.execute("DELETE FROM threads WHERE id = ?", (thread,))
+
+    @_queued
+    def end_game(self, game: int):
+        """Removes the game's town square, reminders and registered threads in a single transaction."""
+        with self.connection:
+            self._delete_town_square(game)
+            self.connection.execute("DELETE FROM reminders WHERE game = ?", (game,))
+            self.connection.execute("DELETE FROM threads WHERE game = ?", (game,))
+
+
+def flush_all():
+    """Writes all pending changes. Called before Carat stops."""
+    for store in _write_behind_stores:
+        store.flush()
+    for store in _stores.values():
+        store.drain()
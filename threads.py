@@ -0,0 +1,264 @@
+import asyncio
+import datetime
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import nextcord
+
+import storage
+import utility
+
+st_thread_prefix = "ST Thread "
+
+
+def st_thread_name(name: str) -> str:
+    return f"{st_thread_prefix}{name}"[:100]
+
+
+# kinds of threads Carat creates
+st_thread = "st"
+whisper_thread = "whisper"
+nomination_thread = "nomination"
+log_thread = "log"
+
+
+def is_st_thread(thread: nextcord.Thread) -> bool:
+    return thread.name.lower().startswith(st_thread_prefix.lower())
+
+
+@dataclass
+class ThreadEntry:
+    thread_id: int
+    kind: str
+    player: Optional[int]
+    created: datetime.datetime
+
+
+class ThreadRegistry:
+    """The threads Carat created for a game, indexed by kind and by the player they belong to.
+    Unlike the channel's thread list it includes archived threads, and it is kept in the store across restarts.
+    """
+
+    def __init__(self, game: int, store: storage.Store):
+        self.game = game
+        self.store = store
+        self.entries: Dict[int, ThreadEntry] = {}
+        self.by_kind: Dict[str, Dict[int, ThreadEntry]] = {}
+        self.by_player: Dict[Tuple[str, int], ThreadEntry] = {}
+
+    async def load(self):
+        for thread_id, kind, player, created in await self.store.load_threads(self.game):
+            self._index(ThreadEntry(thread_id, kind, player, datetime.datetime.fromisoformat(created)))
+
+    def _index(self, entry: ThreadEntry):
+        self.entries[entry.thread_id] = entry
+        self.by_kind.setdefault(entry.kind, {})[entry.thread_id] = entry
+        if entry.player is not None:
+            self.by_player[(entry.kind, entry.player)] = entry
+
+    def add(self, thread: nextcord.Thread, kind: str, player: Optional[int] = None):
+        existing = self.entries.get(thread.id)
+        if existing is not None and existing.kind == kind and existing.player == player:
+            return
+        if existing is not None:
+            self._unindex(existing)
+        entry = ThreadEntry(thread.id, kind, player, thread.created_at)
+        self._index(entry)
+        self.store.register_thread(self.game, thread.id, kind, player, entry.created.isoformat())
+
+    def remove(self, thread_id: int):
+        entry = self.entries.get(thread_id)
+        if entry is not None:
+            self._unindex(entry)
+            self.store.forget_thread(thread_id)
+
+    def _unindex(self, entry: ThreadEntry):
+        del self.entries[entry.thread_id]
+        del self.by_kind[entry.kind][entry.thread_id]
+        if entry.player is not None and self.by_player.get((entry.kind, entry.player)) is entry:
+            del self.by_player[(entry.kind, entry.player)]
+
+    def of_kind(self, kind: str, since: Optional[datetime.datetime] = None) -> List[ThreadEntry]:
+        return [entry for entry in self.by_kind.get(kind, {}).values() if since is None or entry.created > since]
+
+    def for_player(self, kind: str, player: int) -> Optional[ThreadEntry]:
+        return self.by_player.get((kind, player))
+
+    def clear(self):
+        self.entries.clear()
+        self.by_kind.clear()
+        self.by_player.clear()
+
+
+async def game_threads(channel: nextcord.TextChannel, since: datetime.datetime) -> List[nextcord.Thread]:
+    """Returns the threads of the channel created since the given time, including archived private ones."""
+    threads = {thread.id: thread for thread in channel.threads if thread.created_at > since}
+    try:
+        async for thread in channel.archived_threads(private=True, limit=None):
+            # sorted by archive time, and a thread is archived after it is created
+            if thread.archive_timestamp < since:
+                break
+            if thread.created_at > since:
+                threads.setdefault(thread.id, thread)
+    except nextcord.HTTPException as e:
+        logging.warning(f"Could not fetch the archived threads of {channel}: {e}")
+    return list(threads.values())
+
+
+@dataclass
+class ThreadPlan:
+    """A player's ST thread and everyone who should be in it."""
+    name: str
+    members: List[nextcord.Member]
+    player: Optional[int] = None
+    thread: Optional[nextcord.Thread] = None
+    error: Optional[Exception] = None
+
+
+@dataclass
+class ProvisionResult:
+    created: int = 0
+    filled: int = 0
+    complete: int = 0
+    failures: List[ThreadPlan] = field(default_factory=list)
+
+
+class ThreadProvisioner:
+    """Creates the ST threads of a game, with at most concurrency threads being set up at once.
+    Threads which already exist are reused, so running it again only fills in what is missing.
+    """
+
+    def __init__(self, channel: nextcord.TextChannel, registry: ThreadRegistry, since: datetime.datetime,
+                 concurrency: int, setup_message: Optional[str] = None,
+                 progress: Optional[Callable[[], Awaitable[None]]] = None):
+        self.channel = channel
+        self.registry = registry
+        self.since = since
+        self.setup_message = setup_message
+        self.progress = progress
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.result = ProvisionResult()
+
+    async def provision(self, plans: List[ThreadPlan]) -> ProvisionResult:
+        by_id: Dict[int, nextcord.Thread] = {}
+        by_name: Dict[str, nextcord.Thread] = {}
+        for thread in sorted(await game_threads(self.channel, self.since), key=lambda t: t.created_at):
+            by_id[thread.id] = thread
+            # the newest thread of a name wins
+            by_name[thread.name] = thread
+        name_counts = Counter(plan.name for plan in plans)
+        claimed: Set[int] = set()
+        for plan in plans:
+            # the thread registered for the player, whatever it is called now
+            entry = self.registry.for_player(st_thread, plan.player) if plan.player is not None else None
+            plan.thread = by_id.get(entry.thread_id) if entry is not None else None
+            if plan.thread is not None:
+                claimed.add(plan.thread.id)
+        for plan in plans:
+            if plan.thread is not None or name_counts[plan.name] > 1:
+                # players sharing a name cannot tell whose unregistered thread is whose
+                continue
+            # threads made before the registry existed, never another player's
+            thread = by_name.get(plan.name)
+            if thread is not None and thread.id not in self.registry.entries and thread.id not in claimed:
+                plan.thread = thread
+                claimed.add(thread.id)
+        await asyncio.gather(*[self._provision_one(plan) for plan in plans])
+        return self.result
+
+    async def _provision_one(self, plan: ThreadPlan):
+        async with self._semaphore:
+            try:
+                if plan.thread is None:
+                    plan.thread = await self.channel.create_thread(
+                        name=plan.name,
+                        auto_archive_duration=60,  # 1 hr
+                        type=nextcord.ChannelType.private_thread,
+                        invitable=False,
+                        reason="Preparing livetext ST Threads"
+                    )
+                    self.result.created += 1
+                    self.registry.add(plan.thread, st_thread, plan.player)
+                    utility.thread_member_index.created(plan.thread)
+                    missing = plan.members
+                    send_setup = self.setup_message is not None
+                else:
+                    # also adopts threads made before the registry existed
+                    self.registry.add(plan.thread, st_thread, plan.player)
+                    missing = await self._missing_members(plan)
+                    # a thread without messages was created by an earlier run that stopped before the setup message
+                    send_setup = self.setup_message is not None and plan.thread.last_message_id is None
+                    if missing or send_setup:
+                        self.result.filled += 1
+                        if plan.thread.archived:
+                            plan.thread = await plan.thread.edit(archived=False)
+                requests = [utility.thread_member_index.add_user(plan.thread, member) for member in missing]
+                if send_setup:
+                    requests.append(plan.thread.send(self.setup_message))
+                for outcome in await asyncio.gather(*requests, return_exceptions=True):
+                    if isinstance(outcome, Exception):
+                        raise outcome
+                self.result.complete += 1
+            except nextcord.HTTPException as e:
+                plan.error = e
+                self.result.failures.append(plan)
+                logging.warning(f"Failed to set up {plan.name}: {e}")
+        if self.progress is not None:
+            await self.progress()
+
+    async def _missing_members(self, plan: ThreadPlan) -> List[nextcord.Member]:
+        member_ids = await utility.thread_member_index.member_ids(plan.thread)
+        return [member for member in plan.members if member.id not in member_ids]
+
+
+def summarize(result: ProvisionResult) -> str:
+    summary = f"Created {result.created} and completed {result.filled} existing ST threads."
+    if result.failures:
+        summary += f"\n{len(result.failures)} could not be set up, run the command again to retry them:\n" + \
+            "\n".join(f"{plan.name}: {plan.error}" for plan in result.failures)
+    return summary
+
+
+@dataclass
+class DeliveryReport:
+    delivered: int = 0
+    failures: List[Tuple[str, Exception]] = field(default_factory=list)
+
+
+async def broadcast(bot: nextcord.Client, registry: ThreadRegistry, entries: List[ThreadEntry],
+                    extra_threads: List[nextcord.Thread], content: str, concurrency: int) -> DeliveryReport:
+    """Sends the content to the registered threads and the extra threads, with at most concurrency messages in
+    flight. Archived threads are fetched and unarchive by being sent to. Threads which no longer exist are removed
+    from the registry.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    report = DeliveryReport()
+
+    async def deliver(thread_id: int, thread: Optional[nextcord.Thread]):
+        async with semaphore:
+            try:
+                if thread is None:
+                    thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
+                await thread.send(content)
+                report.delivered += 1
+            except nextcord.NotFound as e:
+                registry.remove(thread_id)
+                report.failures.append((str(thread_id), e))
+            except nextcord.HTTPException as e:
+                report.failures.append((thread.name if thread is not None else str(thread_id), e))
+                logging.warning(f"Failed to send to thread {thread_id}: {e}")
+
+    targets = {entry.thread_id: None for entry in entries}
+    targets.update({thread.id: thread for thread in extra_threads})
+    await asyncio.gather(*[deliver(thread_id, thread) for thread_id, thread in targets.items()])
+    return report
+
+
+def summarize_delivery(report: DeliveryReport) -> str:
+    summary = f"Sent the message to {report.delivered} thread{'s' if report.delivered != 1 else ''}."
+    if report.failures:
+        summary += f"\nCould not send it to {len(report.failures)}:\n" + \
+            "\n".join(f"{name}: {error}" for name, error in report.failures)
+    return summary
@@ -1,52 +1,405 @@
+import asyncio
 import logging
 import os
-from typing import Union, Optional
+import time
+from typing import Union, Optional, Callable, Dict, Iterable, List, Set, Tuple
 
 import nextcord
 from dotenv import load_dotenv
 from nextcord.ext import commands
-from nextcord.utils import get
+from nextcord.utils import get, utcnow, format_dt
+
+import dms
+import games
+import logsink
+import outbound
+import roles
 
 WorkingEmoji = '\U0001F504'
 CompletedEmoji = '\U0001F955'
 DeniedEmoji = '\U000026D4'
 
-async def dm_user(user: Union[nextcord.User, nextcord.Member], content: str) -> bool:
-    try:
-        await user.send(content)
-        return True
-    except nextcord.Forbidden:
-        logging.warning(f"Could not DM {user} - user has DMs disabled")
-        return False
-    except Exception as e:
-        logging.exception(f"Could not DM {user}: {e}")
+metric_providers: Dict[str, Callable[[], Dict[str, Union[int, float]]]] = {}
+
+
+def register_metrics(name: str, provider: Callable[[], Dict[str, Union[int, float]]]):
+    metric_providers[name] = provider
+
+
+def unregister_metrics(name: str):
+    metric_providers.pop(name, None)
+
+
+def format_metrics() -> str:
+    lines = []
+    for name, provider in sorted(metric_providers.items()):
+        values = ", ".join(f"{key}: {value}" for key, value in provider().items())
+        lines.append(f"{name} - {values}")
+    return "\n".join(lines) if lines else "No metrics recorded"
+
+
+class LoopMonitor:
+    """Measures how long the event loop is blocked, as the delay with which a task sleeping for a fixed interval
+    wakes up. Anything blocking the loop (like file access in a command) also delays gateway heartbeats.
+    """
+    interval = 0.1
+    stall_threshold = 0.1  # blocks at least this long (in seconds) are counted as stalls
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        register_metrics("event_loop", self.stats)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.stall_threshold:
+                self.stalls += 1
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"samples": self.samples,
+                "avg_lag_ms": round(self.total_lag * 1000 / self.samples, 2) if self.samples else 0,
+                "max_lag_ms": round(self.max_lag * 1000, 2),
+                "stalls": self.stalls}
+
+
+loop_monitor = LoopMonitor()
+
+
+class RoleIndex:
+    """Keeps the ids of the members having each of the roles Carat asks about, so that reading the members of a role
+    does not scan the guild's whole member cache like Role.members does. A role is indexed by a single scan the first
+    time it is asked for, and kept up to date from member update, join and leave events afterwards.
+    """
+
+    def __init__(self):
+        # (guild id, role id) -> member ids, in a dict to keep the order members were found or got the role in
+        self.members_by_role: Dict[Tuple[int, int], Dict[int, None]] = {}
+        self.listening = False
+        self.scans = 0
+        self.updates = 0
+        register_metrics("role_index", self.stats)
+
+    def listen(self, bot: commands.Bot):
+        if not self.listening:
+            bot.add_listener(self.on_member_update, "on_member_update")
+            bot.add_listener(self.on_member_join, "on_member_join")
+            bot.add_listener(self.on_member_remove, "on_member_remove")
+            bot.add_listener(self.on_guild_role_delete, "on_guild_role_delete")
+            bot.add_listener(self.on_ready, "on_ready")
+            self.listening = True
+
+    def member_ids(self, role: nextcord.Role) -> Dict[int, None]:
+        member_ids = self.members_by_role.get((role.guild.id, role.id))
+        if member_ids is None:
+            member_ids = {member.id: None for member in role.guild.members if member.get_role(role.id) is not None}
+            self.members_by_role[(role.guild.id, role.id)] = member_ids
+            self.scans += 1
+        return member_ids
+
+    def members(self, role: nextcord.Role) -> list[nextcord.Member]:
+        members = [role.guild.get_member(member_id) for member_id in self.member_ids(role)]
+        return [member for member in members if member is not None]
+
+    def update(self, member: nextcord.Member):
+        for (guild_id, role_id), member_ids in self.members_by_role.items():
+            if guild_id != member.guild.id:
+                continue
+            if member.get_role(role_id) is not None:
+                member_ids[member.id] = None
+            else:
+                member_ids.pop(member.id, None)
+        self.updates += 1
+
+    async def on_member_update(self, before: nextcord.Member, after: nextcord.Member):
+        if before.roles != after.roles:
+            self.update(after)
+
+    async def on_member_join(self, member: nextcord.Member):
+        self.update(member)
+
+    async def on_member_remove(self, member: nextcord.Member):
+        for (guild_id, _), member_ids in self.members_by_role.items():
+            if guild_id == member.guild.id:
+                member_ids.pop(member.id, None)
+
+    async def on_guild_role_delete(self, role: nextcord.Role):
+        self.members_by_role.pop((role.guild.id, role.id), None)
+
+    async def on_ready(self):
+        # events may have been missed while disconnected
+        self.members_by_role.clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"roles": len(self.members_by_role),
+                "members": sum(len(member_ids) for member_ids in self.members_by_role.values()),
+                "scans": self.scans,
+                "updates": self.updates}
+
+
+role_index = RoleIndex()
+
+
+class ThreadMemberIndex:
+    """Keeps the ids of the members of the threads Carat asks about, so that finding the threads a member is in does
+    not fetch the members of every thread. A thread is indexed by fetching its members the first time it is asked
+    for, and kept up to date from thread member events and Carat's own add_user calls afterwards.
+    """
+
+    def __init__(self):
+        self.members_by_thread: Dict[int, Set[int]] = {}
+        self.listening = False
+        self.fetches = 0
+        self.updates = 0
+        register_metrics("thread_members", self.stats)
+
+    def listen(self, bot: commands.Bot):
+        if not self.listening:
+            bot.add_listener(self.on_thread_member_join, "on_thread_member_join")
+            bot.add_listener(self.on_thread_member_remove, "on_thread_member_remove")
+            bot.add_listener(self.on_thread_delete, "on_thread_delete")
+            bot.add_listener(self.on_thread_remove, "on_thread_remove")
+            bot.add_listener(self.on_ready, "on_ready")
+            self.listening = True
+
+    async def member_ids(self, thread: nextcord.Thread) -> Set[int]:
+        member_ids = self.members_by_thread.get(thread.id)
+        if member_ids is None:
+            thread_members = await thread.fetch_members()
+            for thread_member in thread_members:
+                # cached by nextcord as well, so that it reports them leaving the thread
+                thread._add_member(thread_member)
+            member_ids = self.members_by_thread.setdefault(thread.id, set())
+            member_ids.update(thread_member.id for thread_member in thread_members)
+            self.fetches += 1
+        return member_ids
+
+    async def threads_with(self, member_id: int, threads: Iterable[nextcord.Thread],
+                           concurrency: int) -> List[nextcord.Thread]:
+        """Returns those of the threads the member is in, fetching the members of at most concurrency threads which
+        are not indexed yet at once.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def has_member(thread: nextcord.Thread) -> bool:
+            if thread.id not in self.members_by_thread:
+                async with semaphore:
+                    return member_id in await self.member_ids(thread)
+            return member_id in self.members_by_thread[thread.id]
+
+        threads = list(threads)
+        found = await asyncio.gather(*[has_member(thread) for thread in threads])
+        return [thread for thread, member in zip(threads, found) if member]
+
+    def created(self, thread: nextcord.Thread):
+        """Indexes a thread Carat just created, which has no members but its owner yet."""
+        self.members_by_thread[thread.id] = {thread.owner_id}
+
+    async def add_user(self, thread: nextcord.Thread, user: Union[nextcord.User, nextcord.Member]):
+        await thread.add_user(user)
+        member_ids = self.members_by_thread.get(thread.id)
+        if member_ids is not None:
+            member_ids.add(user.id)
+            self.updates += 1
+
+    async def on_thread_member_join(self, member: nextcord.ThreadMember):
+        member_ids = self.members_by_thread.get(member.thread_id)
+        if member_ids is not None:
+            member_ids.add(member.id)
+            self.updates += 1
+
+    async def on_thread_member_remove(self, member: nextcord.ThreadMember):
+        member_ids = self.members_by_thread.get(member.thread_id)
+        if member_ids is not None:
+            member_ids.discard(member.id)
+            self.updates += 1
+
+    async def on_thread_delete(self, thread: nextcord.Thread):
+        self.members_by_thread.pop(thread.id, None)
+
+    async def on_thread_remove(self, thread: nextcord.Thread):
+        # Carat no longer gets told about the members of a thread it left
+        self.members_by_thread.pop(thread.id, None)
+
+    async def on_ready(self):
+        # events may have been missed while disconnected
+        self.members_by_thread.clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"threads": len(self.members_by_thread),
+                "members": sum(len(member_ids) for member_ids in self.members_by_thread.values()),
+                "fetches": self.fetches,
+                "updates": self.updates}
+
+
+thread_member_index = ThreadMemberIndex()
+
+
+async def dm_user(user: Union[nextcord.User, nextcord.Member], content: Optional[str] = None,
+                  embed: Optional[nextcord.Embed] = None, priority: int = outbound.NORMAL) -> bool:
+    """Sends a DM to the user, together with any others sent to them at about the same time. Returns whether it was
+    delivered, failing at once for users known to have DMs disabled.
+    """
+    return await dms.sender.send(user, content, embed, priority)
+
+
+class WorkingIndicators:
+    """Adds the working reaction to the message of a command only once it has been processed for delay seconds, so
+    that commands finishing sooner neither add nor remove it.
+    """
+
+    def __init__(self):
+        self.delay = 0.75
+        self.pending: Dict[int, asyncio.TimerHandle] = {}
+        # the queued requests adding the reaction, by message
+        self.added: Dict[int, outbound.Request] = {}
+        self.indicators_added = 0
+        self.reactions_avoided = 0
+
+    def start(self, ctx: commands.Context):
+        if ctx.message.id in self.pending or ctx.message.id in self.added:
+            return
+        if self.delay <= 0:
+            self._add(ctx)
+        else:
+            self.pending[ctx.message.id] = asyncio.get_running_loop().call_later(self.delay, self._add, ctx)
+
+    def _add(self, ctx: commands.Context):
+        self.pending.pop(ctx.message.id, None)
+        self.indicators_added += 1
+        # the first reaction to go when Discord is busy
+        self.added[ctx.message.id] = outbound.scheduler.submit(
+            outbound.COSMETIC, lambda: ctx.message.add_reaction(WorkingEmoji), droppable=True, key=ctx.message.id)
+
+    def stop(self, ctx: commands.Context) -> bool:
+        """Stops the indicator of the command, returning whether the working reaction was added and has to be
+        removed.
+        """
+        handle = self.pending.pop(ctx.message.id, None)
+        if handle is not None:
+            handle.cancel()
+            self.reactions_avoided += 2
+            return False
+        request = self.added.pop(ctx.message.id, None)
+        if request is not None:
+            # the finishing reactions may be more urgent and run first, so an add still waiting must not run after them
+            if outbound.scheduler.cancel(request):
+                self.reactions_avoided += 2
+                return False
+            return not request.dropped
+        self.reactions_avoided += 1
         return False
 
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"delay_ms": int(self.delay * 1000),
+                "pending": len(self.pending),
+                "added": self.indicators_added,
+                "reactions_avoided": self.reactions_avoided}
+
+
+working_indicators = WorkingIndicators()
+
+
+async def _replace_reaction(message: nextcord.Message, user: nextcord.ClientUser, emoji: str, remove_working: bool):
+    if remove_working:
+        try:
+            await message.remove_reaction(WorkingEmoji, user)
+        except:
+            pass # don't care if it fails
+    await message.add_reaction(emoji)
+
+
+def command_log_fields(ctx: commands.Context) -> Dict[str, Union[str, int, None]]:
+    """The fields of a command logged in the JSON log format."""
+    game = games.current_game.get()
+    return {"command": ctx.command.name if ctx.command is not None else None,
+            "author_id": ctx.author.id,
+            "game": game.channel.id if game is not None else None,
+            # from the message being sent, so it includes Discord's delivery
+            "latency_ms": round((utcnow() - ctx.message.created_at).total_seconds() * 1000)}
+
 
 async def deny_command(ctx: commands.Context, reason: Optional[str]):
-    try:
-        await ctx.message.remove_reaction(WorkingEmoji, ctx.bot.user)
-    except:
-        pass # don't care if it fails
-    await ctx.message.add_reaction(DeniedEmoji)
+    remove_working = working_indicators.stop(ctx)
+    outbound.scheduler.submit(outbound.COSMETIC,
+                              lambda: _replace_reaction(ctx.message, ctx.bot.user, DeniedEmoji, remove_working),
+                              key=ctx.message.id)
     if reason is not None:
         await dm_user(ctx.author, reason)
-        logging.info(f"The {ctx.command.name} command was stopped against {ctx.author.name} because of {reason}")
+        logging.info(f"The {ctx.command.name} command was stopped against {ctx.author.name} because of {reason}",
+                     extra=command_log_fields(ctx))
     else:
-        logging.info(f"The {ctx.command.name} command was stopped against {ctx.author.name}")
+        logging.info(f"The {ctx.command.name} command was stopped against {ctx.author.name}",
+                     extra=command_log_fields(ctx))
 
 
-async def finish_processing(ctx: commands.Context):
-    try:
-        await ctx.message.remove_reaction(WorkingEmoji, ctx.bot.user)
-    except:
-        pass # don't care if it fails
-    await ctx.message.add_reaction(CompletedEmoji)
-    logging.info(f"The {ctx.command.name} command was used successfully by {ctx.author.name}")
+async def finish_processing(ctx: commands.Context, priority: int = outbound.COSMETIC):
+    remove_working = working_indicators.stop(ctx)
+    outbound.scheduler.submit(priority,
+                              lambda: _replace_reaction(ctx.message, ctx.bot.user, CompletedEmoji, remove_working),
+                              key=ctx.message.id)
+    logging.info(f"The {ctx.command.name} command was used successfully by {ctx.author.name}",
+                 extra=command_log_fields(ctx))
 
 
 async def start_processing(ctx: commands.Context):
-    await ctx.message.add_reaction(WorkingEmoji)
+    working_indicators.start(ctx)
+
+
+class ProgressReport:
+    """Keeps a DM to a user up to date with the progress of a long running command, editing it at most every
+    interval seconds.
+    """
+
+    def __init__(self, user: Union[nextcord.User, nextcord.Member], title: str, total: int, interval: float = 2.0):
+        self.user = user
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.message: Optional[nextcord.Message] = None
+        self._last_edit = 0.0
+
+    async def start(self):
+        try:
+            self.message = await self.user.send(self._content())
+            self._last_edit = time.monotonic()
+        except nextcord.HTTPException:
+            logging.warning(f"Could not DM progress of {self.title} to {self.user}")
+
+    async def advance(self):
+        self.done += 1
+        if self.message is not None and time.monotonic() - self._last_edit >= self.interval:
+            await self._edit(self._content())
+
+    async def finish(self, summary: str):
+        if self.message is None:
+            await dm_user(self.user, summary)
+        else:
+            await self._edit(f"{self._content()}\n{summary}"[:2000])
+
+    def _content(self) -> str:
+        return f"{self.title}: {self.done}/{self.total}"
+
+    async def _edit(self, content: str):
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit(content=content)
+        except nextcord.HTTPException:
+            logging.warning(f"Could not update progress of {self.title} for {self.user}")
 
 
 def is_mention(string: str) -> bool:
@@ -57,42 +410,108 @@ class Helper:
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         load_dotenv()
-        self.Guild = get(bot.guilds, id=int(os.environ['GUILD_ID']))
-        self.GameChannel = get(self.Guild.channels, id=int(os.environ['GAME_CHANNEL_ID']))
         #self.KibitzChannel = get(self.Guild.channels, id=int(os.environ['KIBITZ_CHANNEL_ID']))
-        self.STRole = get(self.Guild.roles, id=int(os.environ['ST_ROLE_ID']))
-        self.PlayerRole = get(self.Guild.roles, id=int(os.environ['PLAYER_ROLE_ID']))
         #self.KibitzRole = get(self.Guild.roles, id=int(os.environ['KIBITZ_ROLE_ID']))
-        self.ModRole = get(self.Guild.roles, id=int(os.environ['DOOMSAYER_ROLE_ID']))
         self.OwnerID = int(os.environ['OWNER_ID'])
         self.DevIDs = list(map(int, os.environ['DEVELOPERIDS'].split()))
-        self.LogChannel = get(self.Guild.channels, id=int(os.environ['LOG_CHANNEL_ID']))
         self.StorageLocation = os.environ['STORAGE_LOCATION']
-        if None in [self.Guild, self.GameChannel, self.STRole, self.PlayerRole, self.ModRole, 
-                    self.OwnerID, self.LogChannel, self.StorageLocation]:
-            logging.error("Failed to find required discord entity. Check .env file is correct and Guild is set up")
-            raise EnvironmentError
+        self.StorageFlushInterval = int(os.environ.get('STORAGE_FLUSH_INTERVAL_MS', 500)) / 1000
+        self.LogFlushInterval = int(os.environ.get('LOG_FLUSH_INTERVAL_MS', 2000)) / 1000
+        self.RoleChanges = roles.get_changer(int(os.environ.get('ROLE_CHANGE_CONCURRENCY', 4)))
+        self.ThreadConcurrency = int(os.environ.get('THREAD_CONCURRENCY', 4))
+        self.Games = games.registry
+        self.Games.load_configs(bot)
+        self.Roles = role_index
+        self.Roles.listen(bot)
+        self.ThreadMembers = thread_member_index
+        self.ThreadMembers.listen(bot)
+        register_metrics("games", self.Games.stats)
+        register_metrics("log_sinks", logsink.stats)
+        register_metrics("role_changes", self.RoleChanges.stats)
+        self.Outbound = outbound.scheduler
+        self.Outbound.configure(int(os.environ.get('OUTBOUND_CONCURRENCY', 4)),
+                                int(os.environ.get('OUTBOUND_COSMETIC_LIMIT', 20)),
+                                int(os.environ.get('OUTBOUND_MAX_DELAY_MS', 30000)) / 1000)
+        self.Outbound.listen(bot)
+        register_metrics("outbound", self.Outbound.stats)
+        working_indicators.delay = int(os.environ.get('WORKING_INDICATOR_DELAY_MS', 750)) / 1000
+        register_metrics("working_indicators", working_indicators.stats)
+        self.DMs = dms.sender
+        self.DMs.window = int(os.environ.get('DM_COALESCE_MS', 250)) / 1000
+        self.DMs.disabled_ttl = float(os.environ.get('DM_DISABLED_TTL_MINUTES', 10)) * 60
+        register_metrics("dms", self.DMs.stats)
+
+    # the Discord entities below belong to the game the current command or interaction is for
+
+    @property
+    def Game(self) -> games.GameConfig:
+        return self.Games.current()
+
+    @property
+    def Guild(self) -> nextcord.Guild:
+        return self.Game.guild
+
+    @property
+    def GameChannel(self) -> nextcord.TextChannel:
+        return self.Game.channel
+
+    @property
+    def STRole(self) -> nextcord.Role:
+        return self.Game.st_role
+
+    @property
+    def PlayerRole(self) -> nextcord.Role:
+        return self.Game.player_role
+
+    @property
+    def ModRole(self) -> nextcord.Role:
+        return self.Game.mod_role
+
+    @property
+    def LogChannel(self) -> nextcord.TextChannel:
+        return self.Game.log_channel
+
+    def game_state(self) -> games.GameState:
+        return self.Games.state()
+
+    def role_members(self, role: nextcord.Role) -> list[nextcord.Member]:
+        return self.Roles.members(role)
+
+    def get_member(self, user_id: int) -> Optional[nextcord.Member]:
+        return self.Guild.get_member(user_id)
 
     def authorize_st_command(self, author: Union[nextcord.Member, nextcord.User]):
         if isinstance(author, nextcord.User):
-            member = get(self.Guild.members, id=author.id)
+            member = self.get_member(author.id)
             if member is None:
                 logging.warning("Non guild member attempting to use ST command")
                 return False
         else:
             member = author
-        return (self.ModRole in member.roles) or (self.STRole in member.roles) \
+        return (member.get_role(self.ModRole.id) is not None) or (member.get_role(self.STRole.id) is not None) \
             or (member.id == self.OwnerID)
 
     def authorize_mod_command(self, author: Union[nextcord.Member, nextcord.User]):
         if isinstance(author, nextcord.User):
-            member = get(self.Guild.members, id=author.id)
+            member = self.get_member(author.id)
             if member is None:
                 logging.warning("Non guild member attempting to use mod command")
                 return False
         else:
             member = author
-        return (self.ModRole in author.roles) or (author.id == self.OwnerID)
+        return (member.get_role(self.ModRole.id) is not None) or (member.id == self.OwnerID)
+
+    async def change_roles(self, author: Union[nextcord.Member, nextcord.User],
+                           changes: Iterable[roles.RoleChange]) -> List[roles.RoleChangeFailure]:
+        """Applies the role changes, and DMs the author one summary of those which failed."""
+        failures = await self.RoleChanges.apply(changes)
+        if failures:
+            await dm_user(author, roles.summarize(failures)[:2000])
+        return failures
+
+    def log_sink(self, channel_id: int) -> logsink.LogSink:
+        return logsink.get_sink(self.bot, channel_id, self.LogFlushInterval)
 
     async def log(self, log_string: str):
-        await self.LogChannel.send(log_string)
\ No newline at end of file
+        # timestamped, as lines are sent in batches
+        self.log_sink(self.LogChannel.id).add(f"{format_dt(utcnow())}: {log_string}")
\ No newline at end of file